@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""Estimate taxon abundance from centrifuge per-read classifications"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# rows of a .sum file parsed per step when streaming
+CHUNK_ROWS = 1 << 20
+
+# EM stops once no abundance moves by more than this
+EM_TOLERANCE = 1e-10
+EM_MAX_ITER = 1000
+
+# --------------------------------------------------
+def get_args():
+    """get args"""
+    parser = argparse.ArgumentParser(
+        description='Estimate abundance from centrifuge classifications',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('sums',
+                        help='Centrifuge .sum file(s) or .sum.parquet store',
+                        metavar='FILE',
+                        nargs='+')
+
+    parser.add_argument('-m', '--method',
+                        help='Split multi-assigned reads by the unique reads '
+                        'of their taxa, or refine that with EM',
+                        metavar='str',
+                        type=str,
+                        choices=['unique', 'em'],
+                        default='unique')
+
+    parser.add_argument('-o', '--outfile',
+                        help='Output file',
+                        metavar='FILE',
+                        type=argparse.FileType('wt'),
+                        default=sys.stdout)
+
+    return parser.parse_args()
+
+# --------------------------------------------------
+def main():
+    """main"""
+    args = get_args()
+
+    estimator = AbundanceEstimator()
+    for sum_file in args.sums:
+        if not os.path.isfile(sum_file):
+            print('"{}" is not a file'.format(sum_file), file=sys.stderr)
+            sys.exit(1)
+        estimator.add_file(sum_file)
+
+    estimator.estimate(em=args.method == 'em').to_csv(args.outfile, sep='\t',
+                                                      index=False)
+
+# --------------------------------------------------
+def splitmix64(values):
+    """Scramble uint64 values, so sums of them make good set hashes"""
+    with np.errstate(over='ignore'):
+        z = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+
+    return z ^ (z >> np.uint64(31))
+
+# --------------------------------------------------
+class AbundanceEstimator:
+    """Count reads per set of assigned taxa, then estimate abundance
+
+    Reads are reduced to equivalence classes (the set of taxIDs a read was
+    assigned to) as the classifications stream past, so memory depends on
+    the number of distinct classes, not on the number of reads. Unclassified
+    reads (taxID 0) are left out.
+    """
+
+    def __init__(self, classes=None):
+        # set hash (as str, to survive JSON) -> [taxIDs, number of reads]
+        self.classes = classes if classes is not None else {}
+
+    def add(self, read_ids, tax_ids):
+        """Add classifications, all rows of a read must be in one call"""
+        read_ids = np.asarray(read_ids)
+        tax_ids = np.asarray(tax_ids, dtype=np.int64)
+        keep = tax_ids != 0
+        read_ids, tax_ids = read_ids[keep], tax_ids[keep]
+        if not len(tax_ids):
+            return
+
+        new_read = np.ones(len(read_ids), dtype=bool)
+        new_read[1:] = read_ids[1:] != read_ids[:-1]
+        read_num = np.cumsum(new_read) - 1
+
+        # one row per (read, taxID), sorted on taxID within each read
+        pairs = np.sort((read_num << 32) | tax_ids)
+        pairs = pairs[np.r_[True, pairs[1:] != pairs[:-1]]]
+        read_num, tax_ids = pairs >> 32, pairs & 0xFFFFFFFF
+        starts = np.flatnonzero(np.r_[True, read_num[1:] != read_num[:-1]])
+
+        with np.errstate(over='ignore'):
+            hashes = np.add.reduceat(splitmix64(tax_ids), starts)
+        keys, first, counts = np.unique(hashes, return_index=True,
+                                        return_counts=True)
+        ends = np.r_[starts[1:], len(tax_ids)]
+        for key, idx, count in zip(keys.tolist(), first.tolist(),
+                                   counts.tolist()):
+            key = str(key)
+            if key not in self.classes:
+                self.classes[key] = [
+                    tax_ids[starts[idx]:ends[idx]].tolist(), 0]
+            self.classes[key][1] += count
+
+    def add_frame(self, frames):
+        """Add data frames of consecutive .sum rows (readID, taxID)
+
+        The rows of the last read of a frame are held back until the next
+        frame, in case that read continues there.
+        """
+        carry = None
+        for frame in frames:
+            if not len(frame):
+                continue
+            if carry is not None:
+                frame = pd.concat([carry, frame], ignore_index=True)
+            read_ids = frame['readID'].to_numpy()
+            last = np.flatnonzero(read_ids != read_ids[-1])
+            cut = last[-1] + 1 if len(last) else 0
+            self.add(read_ids[:cut], frame['taxID'].to_numpy()[:cut])
+            carry = frame.iloc[cut:]
+
+        if carry is not None and len(carry):
+            self.add(carry['readID'].to_numpy(), carry['taxID'].to_numpy())
+
+    def add_rows(self, frame):
+        """Add the multi-assigned reads of a frame (readID, taxID,
+        numMatches) that have all their numMatches rows in it, return the
+        rows of the others"""
+        rows = frame.groupby('readID')['readID'].transform('size')
+        done = (rows >= frame['numMatches']).to_numpy()
+        complete = frame[done].sort_values('readID', kind='stable')
+        self.add(complete['readID'].to_numpy(), complete['taxID'].to_numpy())
+
+        return frame[~done]
+
+    def add_file(self, sum_file, chunk_rows=CHUNK_ROWS):
+        """Stream a centrifuge .sum file or a .sum.parquet store
+
+        The store is sorted on taxID rather than read, so a multi-assigned
+        read's rows are spread over it. Each batch is folded into the
+        classes as it is read: its unique reads, and every multi-assigned
+        read whose rows (numMatches of them) have all been seen. Only the
+        rows of reads still missing some are kept for the next batch.
+        """
+        if sum_file.endswith('.parquet'):
+            import pyarrow.parquet as pq
+
+            pending = None
+            store = pq.ParquetFile(sum_file)
+            for batch in store.iter_batches(batch_size=chunk_rows,
+                                            columns=['readID', 'taxID',
+                                                     'numMatches']):
+                frame = batch.to_pandas()
+                unique = frame['numMatches'] == 1
+                self.add(frame['readID'][unique].to_numpy(),
+                         frame['taxID'][unique].to_numpy())
+                multi = frame[~unique]
+                if pending is not None:
+                    multi = pd.concat([pending, multi], ignore_index=True)
+                pending = self.add_rows(multi)
+
+            # reads with fewer rows than numMatches says, as they are
+            if pending is not None and len(pending):
+                pending = pending.sort_values('readID', kind='stable')
+                self.add(pending['readID'].to_numpy(),
+                         pending['taxID'].to_numpy())
+        else:
+            self.add_frame(pd.read_csv(sum_file, sep='\t',
+                                       usecols=['readID', 'taxID'],
+                                       dtype={'readID': str, 'taxID': 'int64'},
+                                       keep_default_na=False,
+                                       chunksize=chunk_rows))
+
+    def estimate(self, em=False):
+        """Return a data frame of taxID, uniqueReads, reads and abundance
+
+        Each multi-assigned read is split over its taxa in proportion to
+        their unique reads (evenly if none of them has any). With em the
+        split is repeated with the resulting abundances until they converge.
+        reads is the estimated number of reads from a taxon, abundance its
+        share of all the classified reads.
+        """
+        flds = ['taxID', 'uniqueReads', 'reads', 'abundance']
+        if not self.classes:
+            return pd.DataFrame(columns=flds)
+
+        taxa = [np.array(tax_ids, dtype=np.int64)
+                for tax_ids, _ in self.classes.values()]
+        counts = np.array([count for _, count in self.classes.values()],
+                          dtype=np.float64)
+        sizes = np.array([len(t) for t in taxa])
+        tax_list, member = np.unique(np.concatenate(taxa), return_inverse=True)
+        cls = np.repeat(np.arange(len(taxa)), sizes)
+
+        unique = np.bincount(member[sizes[cls] == 1],
+                             weights=counts[cls][sizes[cls] == 1],
+                             minlength=len(tax_list))
+        total = counts.sum()
+
+        def assign(theta):
+            weights = theta[member]
+            denom = np.bincount(cls, weights=weights, minlength=len(taxa))
+            # classes with no weight at all are split evenly
+            weights = np.where(denom[cls] > 0, weights, 1.0)
+            denom = np.bincount(cls, weights=weights, minlength=len(taxa))
+            return np.bincount(member, weights=counts[cls] * weights /
+                               denom[cls], minlength=len(tax_list))
+
+        reads = assign(unique / total)
+        for _ in range(EM_MAX_ITER if em else 0):
+            new_reads = assign(reads / total)
+            done = np.abs(new_reads - reads).max() / total < EM_TOLERANCE
+            reads = new_reads
+            if done:
+                break
+
+        return pd.DataFrame({'taxID': tax_list,
+                             'uniqueReads': unique.astype(np.int64),
+                             'reads': reads,
+                             'abundance': reads / total})[flds]
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
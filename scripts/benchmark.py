@@ -0,0 +1,953 @@
+#!/usr/bin/env python3
+"""Benchmark radcot steps on synthetic data"""
+
+import argparse
+import contextlib
+import csv
+import filecmp
+import functools
+import glob
+import gzip
+import http.server
+import io
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile as tmp
+import threading
+import time
+
+import pandas as pd
+
+import abundance
+import catfasta
+import collapse
+import download
+import featurecount
+import fxsplit
+import representatives
+import scheduler
+
+# --------------------------------------------------
+def get_args():
+    """get args"""
+    parser = argparse.ArgumentParser(
+        description='Benchmark radcot steps on synthetic data',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-w', '--work_dir',
+                        help='Scratch directory for the synthetic data',
+                        metavar='str',
+                        type=str,
+                        default=tmp.gettempdir())
+
+    parser.add_argument('-s', '--seed',
+                        help='Random seed',
+                        metavar='int',
+                        type=int,
+                        default=1)
+
+    subparsers = parser.add_subparsers(dest='bench')
+
+    split = subparsers.add_parser('split',
+                                  help='fxsplit.py byte scanner vs SeqIO')
+    split.add_argument('-n', '--num_reads', metavar='int', type=int,
+                       default=1000000)
+    split.add_argument('-l', '--read_len', metavar='int', type=int,
+                       default=150)
+    split.add_argument('-X', '--max_seqs_per_file', metavar='int', type=int,
+                       default=100000)
+    split.add_argument('-f', '--format', metavar='str', type=str,
+                       default='fastq', choices=['fasta', 'fastq'])
+    split.add_argument('-z', '--gzip', action='store_true',
+                       help='Gzip the input')
+
+    clps = subparsers.add_parser('collapse',
+                                 help='collapse.py engine vs regex per report')
+    clps.add_argument('-n', '--num_reports', metavar='int', type=int,
+                      default=10000)
+    clps.add_argument('-S', '--num_samples', metavar='int', type=int,
+                      default=20)
+    clps.add_argument('-T', '--num_taxa', metavar='int', type=int,
+                      default=2000)
+    clps.add_argument('-r', '--rows', metavar='int', type=int,
+                      default=200, help='taxa per report')
+
+    store = subparsers.add_parser('sum_store',
+                                  help='collapsed .sum text vs parquet store')
+    store.add_argument('-n', '--num_reads', metavar='int', type=int,
+                       default=5000000)
+    store.add_argument('-c', '--num_chunks', metavar='int', type=int,
+                       default=10)
+    store.add_argument('-T', '--num_taxa', metavar='int', type=int,
+                       default=2000)
+
+    abund = subparsers.add_parser('abundance',
+                                  help='abundance.py estimator throughput')
+    abund.add_argument('-n', '--num_reads', metavar='int', type=int,
+                       default=5000000)
+    abund.add_argument('-T', '--num_taxa', metavar='int', type=int,
+                       default=2000)
+
+    share = subparsers.add_parser('index_sharing',
+                                  help='peak memory of concurrent index '
+                                  'loads, private copies vs memory-mapped')
+    share.add_argument('-n', '--num_jobs', metavar='int', type=int,
+                       default=8)
+    share.add_argument('-i', '--index_mb', metavar='int', type=int,
+                       default=256)
+    share.add_argument('-b', '--budget_mb', metavar='int', type=int,
+                       default=0, help='scheduler memory budget, 0 for none')
+    share.add_argument('--hold', metavar='float', type=float, default=2.0,
+                       help='seconds each job keeps the index loaded')
+
+    dload = subparsers.add_parser('download',
+                                  help='download.py from a local HTTP server '
+                                  'with latency, one worker vs many')
+    dload.add_argument('-g', '--num_genomes', metavar='int', type=int,
+                       default=50)
+    dload.add_argument('-k', '--kb', metavar='int', type=int, default=512,
+                       help='size of each .fna')
+    dload.add_argument('-W', '--workers', metavar='int', type=int, default=8)
+    dload.add_argument('-L', '--latency', metavar='float', type=float,
+                       default=0.05, help='seconds added to each request')
+
+    select = subparsers.add_parser('select',
+                                   help='reference size, bowtie2 index and '
+                                   'alignment time, all genomes vs '
+                                   'dereplicated')
+    select.add_argument('-c', '--num_clusters', metavar='int', type=int,
+                        default=5, help='distinct strains')
+    select.add_argument('-v', '--variants', metavar='int', type=int,
+                        default=10, help='near-identical genomes per strain')
+    select.add_argument('-k', '--kb', metavar='int', type=int, default=500,
+                        help='genome size')
+    select.add_argument('-m', '--mutation_rate', metavar='float', type=float,
+                        default=0.002, help='of a variant from its strain')
+    select.add_argument('-n', '--num_reads', metavar='int', type=int,
+                        default=200000)
+    select.add_argument('-t', '--threads', metavar='int', type=int, default=4)
+
+    cat = subparsers.add_parser('cat_fasta',
+                                help='catfasta.py byte copy vs SeqIO '
+                                'parse and write')
+    cat.add_argument('-g', '--num_genomes', metavar='int', type=int,
+                     default=100)
+    cat.add_argument('-k', '--kb', metavar='int', type=int, default=2000,
+                     help='genome size')
+    cat.add_argument('-c', '--contigs', metavar='int', type=int, default=20,
+                     help='contigs per genome')
+
+    count = subparsers.add_parser('count',
+                                  help='featurecount.py in batches vs '
+                                  'read by read vs htseq-count')
+    count.add_argument('-n', '--num_reads', metavar='int', type=int,
+                       default=500000)
+    count.add_argument('-c', '--contigs', metavar='int', type=int,
+                       default=50)
+    count.add_argument('-f', '--features', metavar='int', type=int,
+                       default=100, help='features per contig')
+    count.add_argument('-s', '--stranded', metavar='str', type=str,
+                       choices=featurecount.STRANDED, default='yes')
+    count.add_argument('-a', '--minaqual', metavar='int', type=int,
+                       default=10)
+    count.add_argument('--check', action='store_true',
+                       help='fail without htseq-count to compare against')
+
+    matrix = subparsers.add_parser('count_matrix',
+                                   help='a featurecount.py job per sample '
+                                   'vs all samples off one index')
+    matrix.add_argument('-S', '--samples', metavar='int', type=int,
+                        default=8)
+    matrix.add_argument('-n', '--num_reads', metavar='int', type=int,
+                        default=100000, help='per sample')
+    matrix.add_argument('-c', '--contigs', metavar='int', type=int,
+                        default=500)
+    matrix.add_argument('-f', '--features', metavar='int', type=int,
+                        default=200, help='features per contig')
+    matrix.add_argument('-P', '--procs', metavar='int', type=int,
+                        default=4)
+
+    return parser.parse_args()
+
+# --------------------------------------------------
+def warn(msg):
+    """Print a message to STDERR"""
+    print(msg, file=sys.stderr)
+
+# --------------------------------------------------
+def fake_reads(out_fh, file_format, num_reads, read_len):
+    """Write random reads, FASTA is wrapped at 60 to show off the copy"""
+    qual = 'I' * read_len
+    for i in range(num_reads):
+        seq = ''.join(random.choices('ACGT', k=read_len))
+        if file_format == 'fastq':
+            out_fh.write('@read{0} {0}/1\n{1}\n+\n{2}\n'.format(i, seq, qual))
+        else:
+            lines = [seq[j:j + 60] for j in range(0, read_len, 60)]
+            out_fh.write('>read{} sample\n{}\n'.format(i, '\n'.join(lines)))
+
+# --------------------------------------------------
+def timed(func, *args):
+    """Run func, return (seconds, result)"""
+    start = time.time()
+    result = func(*args)
+
+    return time.time() - start, result
+
+# --------------------------------------------------
+def bench_split(args, work_dir):
+    """Time each fxsplit engine over the same input"""
+    ext = '.' + args.format + ('.gz' if args.gzip else '')
+    infile = os.path.join(work_dir, 'reads' + ext)
+    opener = gzip.open if args.gzip else open
+    with opener(infile, 'wt') as out_fh:
+        fake_reads(out_fh, args.format, args.num_reads, args.read_len)
+
+    with fxsplit.open_input(infile) as in_fh:
+        size = sum(len(block) for block in iter(lambda: in_fh.read(1 << 22),
+                                                b''))
+
+    engines = [('bytes', fxsplit.split_bytes)]
+    try:
+        import Bio
+        engines.append(('seqio', fxsplit.split_seqio))
+    except ImportError:
+        warn('Biopython is not installed, skipping the seqio engine')
+
+    print('\t'.join(['engine', 'reads', 'MB', 'seconds', 'reads/s', 'MB/s']))
+    for name, func in engines:
+        out_dir = os.path.join(work_dir, name)
+        os.makedirs(out_dir)
+        chunk_name = lambda num: os.path.join(out_dir, '{}.fx'.format(num))
+
+        secs, chunks = timed(lambda: list(func(infile, args.format,
+                                               args.max_seqs_per_file,
+                                               chunk_name)))
+        reads = sum(chunk.records for chunk in chunks)
+        print('\t'.join([name, str(reads), '{:.1f}'.format(size / 1e6),
+                         '{:.2f}'.format(secs),
+                         '{:.0f}'.format(reads / secs),
+                         '{:.1f}'.format(size / 1e6 / secs)]))
+
+        if name == 'bytes':
+            with fxsplit.open_input(infile) as in_fh:
+                original = in_fh.read()
+            copied = b''.join(open(chunk.path, 'rb').read() for chunk in chunks)
+            if copied != original:
+                warn('bytes engine did not reproduce the input!')
+                sys.exit(1)
+
+# --------------------------------------------------
+def fake_reports(reports_dir, num_reports, num_samples, num_taxa, rows):
+    """Write chunk reports spread over the samples, return the inputs"""
+    inputs = ['sample{}.fastq'.format(i) for i in range(num_samples)]
+    hdr = 'name\ttaxID\ttaxRank\tgenomeSize\tnumReads\tnumUniqueReads\t' \
+        'abundance\n'
+    for num in range(num_reports):
+        sample = num % num_samples
+        path = os.path.join(reports_dir, 'sample{}.{}.fastq.tsv'.format(
+            sample, num // num_samples + 1))
+        with open(path, 'w') as out_fh:
+            out_fh.write(hdr)
+            for tax_id in random.sample(range(1, num_taxa + 1), rows):
+                reads = random.randint(1, 5000)
+                out_fh.write('species {0}\t{0}\tspecies\t{1}\t{2}\t{3}\t'
+                             '0.0\n'.format(tax_id, tax_id * 1000, reads,
+                                            random.randint(0, reads)))
+
+    return inputs
+
+# --------------------------------------------------
+def regex_collapse(input_files, reports, collapse_dir):
+    """The collapse this repo used to run: a regex per input and report,
+    folding the rows through csv.DictReader"""
+    num_flds = ['numReads', 'numUniqueReads']
+    for filename in input_files:
+        basename, ext = fxsplit.split_name(os.path.basename(filename))
+        splits = []
+        for report in reports:
+            regex = r'{}\.(\d+)\.{}\.(tsv|sum)'.format(basename, ext[1:])
+            match = re.match(regex, os.path.basename(report))
+            if match and match.group(2) == 'tsv':
+                splits.append((int(match.group(1)), report))
+
+        tax = dict()
+        for _, file in sorted(splits, key=lambda a: a[0]):
+            with open(file) as csvfile:
+                for row in csv.DictReader(csvfile, delimiter='\t'):
+                    tax_id = row['taxID']
+                    if not tax_id in tax:
+                        tax[tax_id] = dict()
+                        for fld in row.keys():
+                            tax[tax_id][fld] = int(row[fld]) \
+                                    if fld in num_flds else row[fld]
+                    else:
+                        for fld in num_flds:
+                            tax[tax_id][fld] += int(row[fld])
+
+        with open(os.path.join(collapse_dir, basename + '.tsv'), 'w') as out_fh:
+            out_fh.write('\t'.join(collapse.TSV_FLDS) + '\n')
+            total_reads = sum([tax[s]['numReads'] for s in tax])
+            for tax_id in sorted(tax.keys(), key=int):
+                species = tax[tax_id]
+                species['abundance'] = round(species['numReads'] / total_reads,
+                                             2)
+                out_fh.write('\t'.join([str(species[f])
+                                        for f in collapse.TSV_FLDS]) + '\n')
+
+# --------------------------------------------------
+def bench_collapse(args, work_dir):
+    """Time the collapse engine against the regex-per-report collapse"""
+    reports_dir = os.path.join(work_dir, 'reports')
+    os.makedirs(reports_dir)
+    inputs = fake_reports(reports_dir, args.num_reports, args.num_samples,
+                          args.num_taxa, args.rows)
+    reports = [os.path.join(reports_dir, f) for f in os.listdir(reports_dir)]
+
+    engines = [('engine', collapse.collapse_reports),
+               ('regex', regex_collapse)]
+
+    print('\t'.join(['engine', 'reports', 'samples', 'seconds',
+                     'reports/s']))
+    for name, func in engines:
+        out_dir = os.path.join(work_dir, name)
+        os.makedirs(out_dir)
+        with contextlib.redirect_stdout(io.StringIO()):
+            secs, _ = timed(func, inputs, reports, out_dir)
+        print('\t'.join([name, str(len(reports)), str(len(inputs)),
+                         '{:.2f}'.format(secs),
+                         '{:.0f}'.format(len(reports) / secs)]))
+
+    names = [os.path.splitext(f)[0] + '.tsv' for f in inputs]
+    _, mismatch, errors = filecmp.cmpfiles(os.path.join(work_dir, 'engine'),
+                                           os.path.join(work_dir, 'regex'),
+                                           names, shallow=False)
+    if mismatch or errors:
+        warn('collapse engine differs on: {}'.format(
+            ', '.join(mismatch + errors)))
+        sys.exit(1)
+
+# --------------------------------------------------
+def fake_sums(sum_dir, num_reads, num_chunks, num_taxa):
+    """Write chunk .sum files with skewed taxa and some multi-matches"""
+    hdr = 'readID\tseqID\ttaxID\tscore\t2ndBestScore\thitLength\t' \
+        'queryLength\tnumMatches\n'
+    weights = [1 / (rank + 1) for rank in range(num_taxa)]
+    files = []
+    per_chunk = -(-num_reads // num_chunks)
+    for num in range(num_chunks):
+        files.append(os.path.join(sum_dir, 'sample.{}.fastq.sum'.format(num + 1)))
+        with open(files[-1], 'w') as out_fh:
+            out_fh.write(hdr)
+            start = num * per_chunk
+            reads = range(start, min(num_reads, start + per_chunk))
+            taxa = random.choices(range(1, num_taxa + 1), weights, k=len(reads))
+            for read, tax_id in zip(reads, taxa):
+                hits = [tax_id] if read % 5 else [tax_id, tax_id % 7 + 1]
+                for hit in hits:
+                    out_fh.write('read{0}\tNZ_{1}.1\t{1}\t{2}\t0\t{3}\t150\t'
+                                 '{4}\n'.format(read, hit, 900 + read % 200,
+                                                 100 + read % 50, len(hits)))
+
+    return files
+
+# --------------------------------------------------
+def bench_sum_store(args, work_dir):
+    """Compare the collapsed .sum text to the parquet store"""
+    files = fake_sums(work_dir, args.num_reads, args.num_chunks, args.num_taxa)
+    text_file = os.path.join(work_dir, 'sample.sum')
+    store_file = os.path.join(work_dir, 'sample.sum.parquet')
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        with open(text_file, 'w') as out_fh:
+            text_secs, _ = timed(collapse.write_sum, files, out_fh)
+        store_secs, _ = timed(collapse.write_sum_store, files, store_file)
+
+    print('\t'.join(['format', 'MB', 'write_secs']))
+    for name, path, secs in [('text', text_file, text_secs),
+                             ('parquet', store_file, store_secs)]:
+        print('\t'.join([name, '{:.1f}'.format(os.path.getsize(path) / 1e6),
+                         '{:.2f}'.format(secs)]))
+
+    print('\t'.join(['taxID', 'rows', 'text_scan_secs', 'store_secs']))
+    for tax_id in [1, args.num_taxa // 2, args.num_taxa]:
+        scan_secs, scan = timed(
+            lambda: pd.concat(chunk[chunk['taxID'] == tax_id] for chunk in
+                              pd.read_csv(text_file, sep='\t',
+                                          chunksize=1 << 20)))
+        secs, rows = timed(collapse.read_sum_store, store_file, [tax_id])
+        if len(rows) != len(scan):
+            warn('store returned {} rows for {}, text has {}'.format(
+                len(rows), tax_id, len(scan)))
+            sys.exit(1)
+        print('\t'.join([str(tax_id), str(len(rows)),
+                         '{:.2f}'.format(scan_secs), '{:.3f}'.format(secs)]))
+
+# --------------------------------------------------
+def bench_abundance(args, work_dir):
+    """Time the abundance estimator over a synthetic .sum file"""
+    sum_file = fake_sums(work_dir, args.num_reads, 1, args.num_taxa)[0]
+    with open(sum_file) as in_fh:
+        rows = sum(1 for _ in in_fh) - 1
+
+    estimator = abundance.AbundanceEstimator()
+    secs, _ = timed(estimator.add_file, sum_file)
+    print('\t'.join(['step', 'rows', 'classes', 'seconds', 'rows/s']))
+    print('\t'.join(['stream', str(rows), str(len(estimator.classes)),
+                     '{:.2f}'.format(secs), '{:.0f}'.format(rows / secs)]))
+
+    for method in ['unique', 'em']:
+        secs, result = timed(estimator.estimate, method == 'em')
+        print('\t'.join([method, str(rows), str(len(estimator.classes)),
+                         '{:.3f}'.format(secs), '']))
+
+    if abs(result['abundance'].sum() - 1) > 1e-9:
+        warn('abundances sum to {}'.format(result['abundance'].sum()))
+        sys.exit(1)
+
+# stands in for a centrifuge run: load the index (read a private copy, or
+# map it and touch every page like --mm does), then hold it for a while
+INDEX_LOADER = '''
+import mmap, sys, time
+mode, index, hold = sys.argv[1], sys.argv[2], float(sys.argv[3])
+with open(index, 'rb') as in_fh:
+    if mode == 'private':
+        data = in_fh.read()
+    else:
+        data = mmap.mmap(in_fh.fileno(), 0, prot=mmap.PROT_READ)
+    sum(data[i] for i in range(0, len(data), mmap.PAGESIZE))
+    time.sleep(hold)
+'''
+
+# --------------------------------------------------
+def child_memory():
+    """Total RSS and PSS in KB of the child processes of this one"""
+    rss, pss = 0, 0
+    for pid in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            with open('/proc/{}/stat'.format(pid)) as stat_fh:
+                ppid = int(stat_fh.read().rsplit(')', 1)[1].split()[1])
+            if ppid != os.getpid():
+                continue
+            with open('/proc/{}/smaps_rollup'.format(pid)) as smaps_fh:
+                for line in smaps_fh:
+                    if line.startswith('Rss:'):
+                        rss += int(line.split()[1])
+                    elif line.startswith('Pss:'):
+                        pss += int(line.split()[1])
+        except (OSError, IndexError, ValueError):
+            pass
+
+    return rss, pss
+
+# --------------------------------------------------
+def bench_index_sharing(args, work_dir):
+    """Peak memory of N concurrent index loads, with and without sharing
+
+    RSS counts the mapped pages of a shared index in every job, PSS splits
+    them between the jobs, so the total PSS is what the node really spends.
+    """
+    index = os.path.join(work_dir, 'index.1.cf')
+    with open(index, 'wb') as out_fh:
+        for _ in range(args.index_mb):
+            out_fh.write(os.urandom(1 << 20))
+    size = os.path.getsize(index)
+
+    print('\t'.join(['mode', 'jobs', 'index_MB', 'budget_MB', 'concurrent',
+                     'seconds', 'peak_RSS_MB', 'peak_PSS_MB',
+                     'job_maxrss_MB']))
+    for mode in ['private', 'mmap']:
+        cmd = '{} -c "{}" {} {} {}'.format(sys.executable, INDEX_LOADER, mode,
+                                            index, args.hold)
+        if mode == 'mmap':
+            job = scheduler.Job(cmd, shared=(index, size))
+        else:
+            job = scheduler.Job(cmd, mem=size)
+
+        peak = {'rss': 0, 'pss': 0}
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(0.05):
+                rss, pss = child_memory()
+                peak['rss'] = max(peak['rss'], rss)
+                peak['pss'] = max(peak['pss'], pss)
+
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+        runner = scheduler.Scheduler(procs=args.num_jobs, cpus=args.num_jobs,
+                                     mem=args.budget_mb << 20)
+        secs, results = timed(runner.run, [job] * args.num_jobs)
+        done.set()
+        sampler.join()
+
+        if scheduler.failed(results):
+            warn('{} index loads failed'.format(len(scheduler.failed(results))))
+            sys.exit(1)
+
+        print('\t'.join([mode, str(args.num_jobs), str(args.index_mb),
+                         str(args.budget_mb or ''),
+                         str(max_concurrent(results)), '{:.1f}'.format(secs),
+                         '{:.0f}'.format(peak['rss'] / 1024),
+                         '{:.0f}'.format(peak['pss'] / 1024),
+                         '{:.0f}'.format(max(r.maxrss for r in results) /
+                                         1024)]))
+
+# --------------------------------------------------
+def max_concurrent(results):
+    """Most jobs that ran at the same time"""
+    events = sorted([(r.start, 1) for r in results] +
+                    [(r.start + r.secs, -1) for r in results])
+    running, most = 0, 0
+    for _, change in events:
+        running += change
+        most = max(most, running)
+
+    return most
+
+# --------------------------------------------------
+class SlowHandler(http.server.SimpleHTTPRequestHandler):
+    """Serve files with keep-alive after a delay, like a far-away server"""
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+# --------------------------------------------------
+def bench_download(args, work_dir):
+    """Fetch fake genomes and annotation globs with 1 and --workers threads"""
+    srv_dir = os.path.join(work_dir, 'genomes')
+    for num in range(args.num_genomes):
+        genome = '{0}.{0}'.format(num + 1)
+        os.makedirs(os.path.join(srv_dir, genome))
+        with open(os.path.join(srv_dir, genome, genome + '.fna'), 'wb') as fh:
+            fh.write(os.urandom(args.kb << 10))
+        for ext in ['gff', 'faa', 'ffn']:
+            with open(os.path.join(srv_dir, genome,
+                                   genome + '.RefSeq.' + ext), 'w') as fh:
+                fh.write('{} {}\n'.format(genome, ext) * 100)
+
+    handler = type('Handler', (SlowHandler,), {'latency': args.latency})
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), functools.partial(handler, directory=srv_dir))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    print('\t'.join(['workers', 'files', 'MB', 'seconds', 'MB/s']))
+    try:
+        for workers in [1, args.workers]:
+            out_dir = os.path.join(work_dir, 'out{}'.format(workers))
+            os.makedirs(out_dir)
+            requests = []
+            for num in range(args.num_genomes):
+                url = '{0}/{1}.{1}/{1}.{1}'.format(base, num + 1)
+                requests += [(url + '.fna', out_dir),
+                             (url + '.RefSeq*', out_dir)]
+
+            downloader = download.Downloader(workers=workers)
+            secs, results = timed(downloader.fetch_all, requests)
+            if any(result.error for result in results):
+                warn(download.throughput(results, secs))
+                sys.exit(1)
+            size = sum(result.bytes for result in results)
+            print('\t'.join([str(workers), str(len(results)),
+                             '{:.1f}'.format(size / 1e6),
+                             '{:.2f}'.format(secs),
+                             '{:.1f}'.format(size / 1e6 / secs)]))
+    finally:
+        server.shutdown()
+
+# --------------------------------------------------
+def mutate(seq, rate):
+    """seq with a share rate of its bases substituted"""
+    seq = list(seq)
+    for i in random.sample(range(len(seq)), int(rate * len(seq))):
+        seq[i] = random.choice('ACGT'.replace(seq[i], ''))
+
+    return ''.join(seq)
+
+# --------------------------------------------------
+def bench_select(args, work_dir):
+    """Index all near-identical genomes of a few strains, or one of each
+
+    Without bowtie2 on the PATH only the reference sizes and the time to
+    dereplicate are reported.
+    """
+    genome_dir = os.path.join(work_dir, 'genomes')
+    os.makedirs(genome_dir)
+    genomes, seqs = [], []
+    for strain in range(args.num_clusters):
+        base = ''.join(random.choices('ACGT', k=args.kb * 1000))
+        for variant in range(args.variants):
+            seq = mutate(base, args.mutation_rate) if variant else base
+            name = '{}.{}'.format(strain + 1, variant + 1)
+            path = os.path.join(genome_dir, name + '.fna')
+            with open(path, 'w') as out_fh:
+                out_fh.write('>{}\n{}\n'.format(name, seq))
+            genomes.append((name, path))
+            seqs.append(seq)
+
+    reads = os.path.join(work_dir, 'reads.fq')
+    with open(reads, 'w') as out_fh:
+        for i in range(args.num_reads):
+            seq = random.choice(seqs)
+            start = random.randrange(len(seq) - 100)
+            out_fh.write('@read{}\n{}\n+\n{}\n'.format(
+                i, seq[start:start + 100], 'I' * 100))
+
+    derep_secs, kept = timed(representatives.dereplicate, genomes)
+    bowtie2 = shutil.which('bowtie2') and shutil.which('bowtie2-build')
+    if not bowtie2:
+        warn('No bowtie2 on the PATH, not timing the index and alignments')
+
+    print('\t'.join(['reference', 'genomes', 'Mbp', 'select_seconds',
+                     'index_MB', 'build_seconds', 'align_seconds']))
+    for label, names, secs in [('all', [name for name, _ in genomes], 0.0),
+                               ('dereplicated', kept, derep_secs)]:
+        ref = os.path.join(work_dir, label)
+        with open(ref + '.fna', 'wb') as out_fh:
+            for name, path in genomes:
+                if name in names:
+                    with open(path, 'rb') as in_fh:
+                        shutil.copyfileobj(in_fh, out_fh)
+        row = [label, str(len(names)),
+               '{:.1f}'.format(os.path.getsize(ref + '.fna') / 1e6),
+               '{:.2f}'.format(secs)]
+
+        if bowtie2:
+            build_secs, _ = timed(subprocess.run, [
+                'bowtie2-build', '--threads', str(args.threads), '-q',
+                ref + '.fna', ref], check=True)
+            index_size = sum(os.path.getsize(index)
+                             for index in glob.glob(ref + '.*.bt2*'))
+            align_secs, _ = timed(subprocess.run, [
+                'bowtie2', '-p', str(args.threads), '-x', ref, '-U', reads,
+                '-S', os.devnull], check=True, stderr=subprocess.DEVNULL)
+            row += ['{:.1f}'.format(index_size / 1e6),
+                    '{:.1f}'.format(build_secs), '{:.1f}'.format(align_secs)]
+        else:
+            row += ['', '', '']
+        print('\t'.join(row))
+
+# --------------------------------------------------
+def seqio_cat(fastas, out_file):
+    """What runAll.py used to do, parse and re-write every record"""
+    from Bio import SeqIO
+
+    with open(out_file, 'w') as out_fh:
+        for fasta in fastas:
+            with open(fasta) as in_fh:
+                SeqIO.write(SeqIO.parse(in_fh, 'fasta'), out_fh, 'fasta')
+
+# --------------------------------------------------
+def bench_cat_fasta(args, work_dir):
+    """Concatenate fake genomes with catfasta.py (and .fai) or SeqIO"""
+    genome_dir = os.path.join(work_dir, 'genomes')
+    os.makedirs(genome_dir)
+    fastas = []
+    contig = args.kb * 1000 // args.contigs
+    # genomes are rotations of one random sequence, quicker to make
+    pool = ''.join(random.choices('ACGT', k=args.kb * 1000))
+    for num in range(args.num_genomes):
+        fasta = os.path.join(genome_dir, '{0}.{0}.fna'.format(num + 1))
+        turn = random.randrange(len(pool))
+        genome = pool[turn:] + pool[:turn]
+        with open(fasta, 'w') as out_fh:
+            for i in range(args.contigs):
+                seq = genome[i * contig:(i + 1) * contig]
+                out_fh.write('>accn|{}.{}.con.{}   contig {}\n{}'.format(
+                    num + 1, num + 1, i, i,
+                    ''.join(seq[j:j + 70] + '\n'
+                            for j in range(0, len(seq), 70))))
+        fastas.append(fasta)
+    size = sum(os.path.getsize(fasta) for fasta in fastas)
+
+    engines = [('bytes', lambda out_file: catfasta.cat_fasta(
+        fastas, out_file, out_file + '.fai', out_file + '.map'))]
+    try:
+        import Bio
+        engines.append(('seqio', lambda out_file: seqio_cat(fastas, out_file)))
+    except ImportError:
+        warn('Biopython is not installed, skipping SeqIO')
+
+    print('\t'.join(['engine', 'genomes', 'MB', 'seconds', 'MB/s']))
+    for name, func in engines:
+        out_file = os.path.join(work_dir, name + '.fna')
+        secs, _ = timed(func, out_file)
+        print('\t'.join([name, str(len(fastas)), '{:.1f}'.format(size / 1e6),
+                         '{:.2f}'.format(secs),
+                         '{:.1f}'.format(size / 1e6 / secs)]))
+
+    copied = os.path.join(work_dir, 'copied.fna')
+    with open(copied, 'wb') as out_fh:
+        for fasta in fastas:
+            with open(fasta, 'rb') as in_fh:
+                shutil.copyfileobj(in_fh, out_fh)
+    if not filecmp.cmp(copied, os.path.join(work_dir, 'bytes.fna'),
+                       shallow=False):
+        warn('catfasta.py did not reproduce the input!')
+        sys.exit(1)
+
+# --------------------------------------------------
+def fake_gff(gff, num_contigs, num_features, contig_len):
+    """Write CDSs, overlapping, some sharing an ID, and genes not to count;
+    the last contig has none"""
+    with open(gff, 'w') as out_fh:
+        out_fh.write('##gff-version 3\n')
+        for contig in range(num_contigs - 1):
+            for i in range(num_features):
+                start = random.randrange(1, contig_len - 3000)
+                end = start + random.randrange(100, 3000)
+                name = 'cds-{}-{}'.format(contig, i)
+                if i and random.random() < 0.05:
+                    name = 'cds-{}-{}'.format(contig, random.randrange(i))
+                for ftype in ['gene', 'CDS']:
+                    out_fh.write('\t'.join([
+                        'con{}'.format(contig), 'RefSeq', ftype, str(start),
+                        str(end), '.', random.choice('+-'), '0',
+                        'ID={};product=x'.format(name)]) + '\n')
+
+# --------------------------------------------------
+def fake_sam(sam, num_reads, num_contigs, contig_len, paired=False):
+    """Write reads as bowtie2 would, all single or all paired, with some
+    unaligned, multi-mapped, low quality, spliced and clipped
+
+    SEQ and QUAL are left out (*), as the counts do not need them.
+    """
+    cigars = ['100M', '100M', '100M', '40M300N60M', '20S80M', '48M2I50M',
+              '30M5D70M', '60M40S']
+    mate_unmapped, mate_reverse, proper = 0x8, 0x20, 0x2
+
+    def record(name, flag, place, mate_place, tags):
+        """A SAM line, place and mate_place are (contig, pos) or None"""
+        contig, pos = place or ('*', 0)
+        cigar, mapq = '*', 0
+        if not flag & featurecount.UNMAPPED:
+            cigar = random.choice(cigars)
+            mapq = random.choice([0, 1, 5, 23, 42, 42, 42, 42, 42, 42])
+        rnext, pnext = '*', 0
+        if mate_place:
+            rnext = '=' if mate_place[0] == contig else mate_place[0]
+            pnext = mate_place[1]
+
+        return '\t'.join(map(str, [
+            name, flag, contig, pos, mapq, cigar, rnext, pnext, 0, '*', '*',
+            tags])) + '\n'
+
+    with open(sam, 'w') as out_fh:
+        out_fh.write('@HD\tVN:1.0\tSO:unsorted\n')
+        for contig in range(num_contigs):
+            out_fh.write('@SQ\tSN:con{}\tLN:{}\n'.format(contig, contig_len))
+        for i in range(num_reads):
+            name = 'read{}'.format(i)
+            place = ('con{}'.format(random.randrange(num_contigs)),
+                     random.randrange(1, contig_len - 1000))
+            # a multi-mapped read says so on every record
+            tags = 'AS:i:0' + ('\tNH:i:2' if random.random() < 0.03 else '')
+            rev = random.choice([0, featurecount.REVERSE])
+            if not paired:
+                if random.random() < 0.05:
+                    out_fh.write(record(name, featurecount.UNMAPPED, None,
+                                        None, 'YT:Z:UU'))
+                else:
+                    out_fh.write(record(name, rev, place, None, tags))
+                continue
+
+            # which mates aligned: both mostly, one, or neither
+            aligned = random.choices([(True, True), (True, False),
+                                      (False, True), (False, False)],
+                                     [85, 5, 5, 5])[0]
+            places = [place, (place[0], place[1] + 200)]
+            revs = [rev, featurecount.REVERSE ^ rev]
+            flags = [featurecount.PAIRED | featurecount.FIRST_MATE,
+                     featurecount.PAIRED | featurecount.SECOND_MATE]
+            for mate in range(2):
+                other = 1 - mate
+                if not aligned[mate]:
+                    flags[mate] |= featurecount.UNMAPPED
+                    # an unaligned mate sits where its mate aligned
+                    places[mate] = places[other] if aligned[other] else None
+                else:
+                    flags[mate] |= revs[mate]
+                if not aligned[other]:
+                    flags[mate] |= mate_unmapped
+                elif revs[other]:
+                    flags[mate] |= mate_reverse
+                if all(aligned):
+                    flags[mate] |= proper
+            if not any(aligned):
+                tags = 'YT:Z:UP'
+            for mate in range(2):
+                out_fh.write(record(name, flags[mate], places[mate],
+                                    places[1 - mate], tags))
+
+# --------------------------------------------------
+def bench_count(args, work_dir):
+    """Count fake single and paired reads on fake CDSs with each engine,
+    the counts must be the same
+
+    With --check htseq-count must be on the PATH, so its counts are
+    always compared against.
+    """
+    contig_len = 200000
+    gff = os.path.join(work_dir, 'features.gff')
+    fake_gff(gff, args.contigs, args.features, contig_len)
+    features = featurecount.Features.from_gff(
+        gff, 'CDS', 'ID', stranded=args.stranded != 'no')
+    samtools = shutil.which('samtools')
+    htseq_count = shutil.which('htseq-count')
+    if not samtools:
+        warn('No samtools on the PATH, not counting from BAM')
+    if not htseq_count:
+        if args.check:
+            warn('No htseq-count on the PATH to check against')
+            sys.exit(1)
+        warn('No htseq-count on the PATH, skipping it')
+
+    def count(counter_class, in_file, is_bam, out_file):
+        """Count with featurecount.py"""
+        counter = counter_class(features, args.stranded, args.minaqual)
+        with featurecount.open_alignments(in_file, is_bam) as in_fh:
+            for line in in_fh:
+                counter.feed(line)
+        counter.finish()
+        with open(out_file, 'w') as out_fh:
+            counter.write(out_fh)
+
+    def htseq(in_file, in_format, out_file):
+        """Count with htseq-count"""
+        with open(out_file, 'w') as out_fh:
+            subprocess.run([
+                'htseq-count', '-f', in_format, '-r', 'name', '-m', 'union',
+                '-t', 'CDS', '-i', 'ID', '-a', str(args.minaqual), '-s',
+                args.stranded, in_file, gff], stdout=out_fh, check=True)
+
+    print('\t'.join(['engine', 'reads', 'seconds', 'reads/s']))
+    for layout in ['single', 'paired']:
+        sam = os.path.join(work_dir, layout + '.sam')
+        fake_sam(sam, args.num_reads, args.contigs, contig_len,
+                 paired=layout == 'paired')
+        engines = [
+            ('numpy', functools.partial(count, featurecount.FeatureCounter,
+                                        sam, False)),
+            ('python', functools.partial(count, featurecount.SimpleCounter,
+                                         sam, False))]
+        if samtools:
+            bam = os.path.join(work_dir, layout + '.bam')
+            subprocess.run(['samtools', 'view', '-b', '-o', bam, sam],
+                           check=True)
+            engines.append(('numpy_bam', functools.partial(
+                count, featurecount.FeatureCounter, bam, True)))
+        if htseq_count:
+            engines.append(('htseq', functools.partial(
+                htseq, bam, 'bam') if samtools else functools.partial(
+                    htseq, sam, 'sam')))
+
+        for name, func in engines:
+            secs, _ = timed(func, os.path.join(
+                work_dir, '{}.{}.counts'.format(layout, name)))
+            print('\t'.join(['{}_{}'.format(name, layout),
+                             str(args.num_reads), '{:.2f}'.format(secs),
+                             '{:.0f}'.format(args.num_reads / secs)]))
+
+        expected = engines[-1][0]
+        for name, _ in engines:
+            if not filecmp.cmp(
+                    os.path.join(work_dir, '{}.{}.counts'.format(layout,
+                                                                 name)),
+                    os.path.join(work_dir, '{}.{}.counts'.format(layout,
+                                                                 expected)),
+                    shallow=False):
+                warn('{} did not reproduce the counts of {} on {} '
+                     'reads!'.format(name, expected, layout))
+                sys.exit(1)
+
+# --------------------------------------------------
+def bench_count_matrix(args, work_dir):
+    """Count samples as count-deseq.py does: a job each, each indexing the
+    GFF, or --single-pass, indexing it once for workers that share it"""
+    contig_len = 200000
+    gff = os.path.join(work_dir, 'features.gff')
+    fake_gff(gff, args.contigs, args.features, contig_len)
+    sams = []
+    for sample in range(args.samples):
+        sams.append(os.path.join(work_dir, 'sample{}.sam'.format(sample)))
+        fake_sam(sams[-1], args.num_reads, args.contigs, contig_len,
+                 paired=sample % 2 == 1)
+    opts = ['-t', 'CDS', '-i', 'ID', '-a', '0', '-s', 'no']
+    script = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                          'featurecount.py')
+
+    def per_sample(out_dir):
+        """A featurecount.py job per sample"""
+        jobs = [scheduler.Job(' '.join([script] + opts + [
+            '-o', os.path.join(out_dir, os.path.basename(sam) + '.counts'),
+            gff, sam])) for sam in sams]
+        results = scheduler.run_jobs(jobs, msg='Counting samples',
+                                     procs=args.procs)
+        if scheduler.failed(results):
+            warn('featurecount.py failed')
+            sys.exit(1)
+
+    def single_pass(out_dir):
+        """One index, the samples counted in forked workers"""
+        features = featurecount.Features.from_gff(gff, 'CDS', 'ID',
+                                                  stranded=False)
+        featurecount.count_samples(
+            features, {os.path.join(out_dir, os.path.basename(sam) +
+                                    '.counts'): [sam] for sam in sams},
+            'no', 0, procs=args.procs)
+
+    print('\t'.join(['engine', 'samples', 'reads', 'seconds', 'reads/s']))
+    for name, func in [('per_sample', per_sample),
+                       ('single_pass', single_pass)]:
+        out_dir = os.path.join(work_dir, name)
+        os.makedirs(out_dir)
+        secs, _ = timed(func, out_dir)
+        reads = args.samples * args.num_reads
+        print('\t'.join([name, str(args.samples), str(reads),
+                         '{:.2f}'.format(secs), '{:.0f}'.format(reads / secs)]))
+
+    for sam in sams:
+        counts = os.path.basename(sam) + '.counts'
+        if not filecmp.cmp(os.path.join(work_dir, 'per_sample', counts),
+                           os.path.join(work_dir, 'single_pass', counts),
+                           shallow=False):
+            warn('single_pass did not reproduce the counts of {}!'.format(
+                sam))
+            sys.exit(1)
+
+# --------------------------------------------------
+def main():
+    """main"""
+    args = get_args()
+    random.seed(args.seed)
+    benches = {'split': bench_split, 'collapse': bench_collapse,
+               'sum_store': bench_sum_store, 'abundance': bench_abundance,
+               'index_sharing': bench_index_sharing,
+               'download': bench_download, 'select': bench_select,
+               'cat_fasta': bench_cat_fasta, 'count': bench_count,
+               'count_matrix': bench_count_matrix}
+
+    if args.bench not in benches:
+        warn('Choose a benchmark: {}'.format(', '.join(sorted(benches))))
+        sys.exit(1)
+
+    work_dir = tmp.mkdtemp(prefix='radcot-bench-', dir=args.work_dir)
+    try:
+        benches[args.bench](args, work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
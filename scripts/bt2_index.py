@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""Build bowtie2 indexes of a genome directory in shards, from a cache"""
+
+import argparse
+import contextlib
+import functools
+import glob
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+import catfasta
+import genome_store
+import scheduler
+from locking import FileLock
+
+# "" puts the cache next to the index, see default_cache
+DEFAULT_CACHE = os.getenv('RADCOT_INDEX_CACHE', '')
+
+# the cache's list of the manifests using it, what prune keeps
+REGISTRY = 'manifests.txt'
+
+# bowtie2-build options besides --threads, part of every cache key
+BUILD_OPTS = '-f'
+
+# --------------------------------------------------
+def get_args():
+    """get args"""
+    parser = argparse.ArgumentParser(
+        description='Build or update sharded bowtie2 indexes of genomes',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-g', '--genome_dir',
+                        help='Directory of genomes (*.fna)',
+                        metavar='DIR',
+                        type=str,
+                        required=True)
+
+    parser.add_argument('-x', '--bt2_idx',
+                        help='Index prefix',
+                        metavar='PREFIX',
+                        type=str,
+                        required=True)
+
+    parser.add_argument('-s', '--shards',
+                        help='Number of shards',
+                        metavar='int',
+                        type=int,
+                        default=1)
+
+    parser.add_argument('-c', '--cache',
+                        help='Directory of cached shard indexes (default '
+                        '$RADCOT_INDEX_CACHE, or bt2_index_cache next to '
+                        'the index)',
+                        metavar='DIR',
+                        type=str,
+                        default=DEFAULT_CACHE)
+
+    parser.add_argument('-t', '--threads',
+                        help='Threads per bowtie2-build',
+                        metavar='int',
+                        type=int,
+                        default=1)
+
+    parser.add_argument('-P', '--procs',
+                        help='Shards built at once',
+                        metavar='int',
+                        type=int,
+                        default=1)
+
+    return parser.parse_args()
+
+# --------------------------------------------------
+def main():
+    """main"""
+    args = get_args()
+
+    index = ShardedIndex(args.bt2_idx, args.shards, args.cache)
+    try:
+        built = index.update(args.genome_dir, args.threads, args.procs)
+    except ValueError as err:
+        print('Error: {}'.format(err), file=sys.stderr)
+        sys.exit(1)
+
+    print('Built {} shard{}, the rest were cached in "{}"'.format(
+        len(built), '' if len(built) == 1 else 's', index.cache_dir),
+          file=sys.stderr)
+    pruned = index.prune()
+    if pruned:
+        print('Pruned {} shard{} no index uses from the cache'.format(
+            len(pruned), '' if len(pruned) == 1 else 's'), file=sys.stderr)
+
+# --------------------------------------------------
+def default_cache(prefix):
+    """The cache of an index at prefix: bt2_index_cache in its directory,
+    so it is on the same file system and shared by the indexes there"""
+    return os.path.join(os.path.dirname(os.path.abspath(prefix)),
+                        'bt2_index_cache')
+
+# --------------------------------------------------
+def has_index(prefix):
+    """Whether a bowtie2 index (small or large) is at prefix"""
+    return os.path.isfile(prefix + '.1.bt2') or \
+        os.path.isfile(prefix + '.1.bt2l')
+
+# --------------------------------------------------
+def shard_of(genome, num_shards):
+    """The shard of a genome, fixed for as long as num_shards is"""
+    digest = hashlib.sha1(genome.encode()).digest()
+
+    return int.from_bytes(digest[:8], 'big') % num_shards
+
+# --------------------------------------------------
+@functools.lru_cache()
+def builder_version():
+    """bowtie2-build's version number, "" if it will not say
+
+    Only the number: the first line of --version also has the path of the
+    binary, which would give the same version installed elsewhere other
+    cache keys.
+    """
+    try:
+        out = subprocess.run(['bowtie2-build', '--version'],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             universal_newlines=True).stdout
+    except OSError:
+        return ''
+
+    match = re.search(r'version\s+(\S+)', out)
+
+    return match.group(1) if match else ''
+
+# --------------------------------------------------
+def cache_key(genomes):
+    """Cache key of an index of {genome: (size, mtime_ns, sha256)}
+
+    A hash of the genomes' names and contents, in sorted order, the
+    bowtie2-build version and BUILD_OPTS, so where the genomes are and when
+    they were downloaded do not matter.
+    """
+    sha = hashlib.sha256()
+    sha.update('{}\n{}\n'.format(builder_version(), BUILD_OPTS).encode())
+    for genome in sorted(genomes):
+        sha.update('{}\t{}\n'.format(genome, genomes[genome][2]).encode())
+
+    return sha.hexdigest()[:32]
+
+# --------------------------------------------------
+class ShardedIndex:
+    """A genome directory indexed as shards of genomes, from a cache
+
+    Genomes go to shards by a hash of their name, so adding or removing a
+    genome only changes the one shard it is in. Each shard's index lives in
+    cache_dir under the cache_key of its genomes: a shard of the same
+    genomes, from any genome directory or project sharing the cache, is
+    found there at once, and a shard whose genomes changed gets a new key,
+    so a stale index is never used. Missing shards are built in parallel,
+    each under a lock on its key that concurrent builders wait on (then
+    finding it built), into a .building directory that is renamed when
+    complete. Reads are aligned to all the shards, keeping the best hit
+    (see samerge.py).
+
+    The manifest, prefix.shards.tsv, records the cache and the key and
+    genomes of each shard. Each cached index has a .fna.fai of its
+    reference (the .fna itself is removed once built) and a .genomes.tsv
+    mapping its sequence IDs to genomes. The cache lists the manifests
+    using it in REGISTRY, and prune removes the shards none of them uses
+    any more, as when the genomes change.
+    """
+
+    def __init__(self, prefix, num_shards=1, cache_dir=DEFAULT_CACHE):
+        self.prefix = prefix
+        self.num_shards = num_shards
+        self.cache_dir = os.path.abspath(cache_dir or default_cache(prefix))
+        self.manifest_file = prefix + '.shards.tsv'
+        self.registry = os.path.join(self.cache_dir, REGISTRY)
+
+    @classmethod
+    def existing(cls, prefix):
+        """The index last built at prefix, as its manifest says"""
+        index = cls(prefix)
+        try:
+            with open(index.manifest_file) as in_fh:
+                for line in in_fh:
+                    flds = line.rstrip('\n').split('\t')
+                    if flds[0] == '#shards':
+                        index.num_shards = int(flds[1])
+                    elif flds[0] == '#cache':
+                        index.cache_dir = flds[1]
+        except (OSError, ValueError, IndexError):
+            pass
+
+        return index
+
+    def key_prefix(self, key):
+        """Index prefix of a cached shard"""
+        return os.path.join(self.cache_dir, key, 'index')
+
+    def prefixes(self):
+        """Index prefixes of the shards, [] if any of them is missing
+
+        An index built in one piece at prefix before there were manifests
+        is used as it is.
+        """
+        if not os.path.isfile(self.manifest_file) and has_index(self.prefix):
+            return [self.prefix]
+
+        keys, _ = self.load()
+
+        prefixes = [self.key_prefix(keys[shard]) for shard in sorted(keys)]
+        if not all(has_index(prefix) for prefix in prefixes):
+            return []
+
+        return prefixes
+
+    def plan(self, genome_dir):
+        """{shard: {genome: (size, mtime_ns, sha256)}} of a genome directory
+
+        Checksums are taken from the manifest for files of the same size
+        and mtime, so only new or changed genomes are read.
+        """
+        _, genomes = self.load()
+        known = {genome: fingerprint for shard in genomes.values()
+                 for genome, fingerprint in shard.items()}
+        plan = {shard: {} for shard in range(self.num_shards)}
+        for fasta in sorted(glob.glob(os.path.join(genome_dir, '*.fna'))):
+            genome = catfasta.genome_name(fasta)
+            stat = os.stat(fasta)
+            old = known.get(genome)
+            if old and old[:2] == (stat.st_size, stat.st_mtime_ns):
+                fingerprint = old
+            else:
+                fingerprint = (stat.st_size, stat.st_mtime_ns,
+                               genome_store.checksum(fasta))
+            plan[shard_of(genome, self.num_shards)][genome] = fingerprint
+
+        return plan
+
+    def update(self, genome_dir, threads=1, procs=1, retries=0):
+        """Point the manifest at the shards of genome_dir, building the
+        ones not in the cache in parallel; return the keys built"""
+        plan = {shard: genomes
+                for shard, genomes in self.plan(genome_dir).items() if genomes}
+        if not plan:
+            raise ValueError('No genomes (*.fna) in "{}"'.format(genome_dir))
+        keys = {shard: cache_key(genomes) for shard, genomes in plan.items()}
+
+        with contextlib.ExitStack() as locks:
+            # every key is locked until the manifest has it, so prune can
+            # not take it away; in key order, so two runs never wait on
+            # each other
+            jobs, building = [], []
+            for key in sorted(set(keys.values())):
+                locks.enter_context(FileLock(os.path.join(
+                    self.cache_dir, key + '.lock')))
+                if has_index(self.key_prefix(key)):
+                    continue
+
+                shard = min(shard for shard in keys if keys[shard] == key)
+                jobs.append(self.build_job(key, genome_dir, plan[shard],
+                                           threads))
+                building.append(key)
+
+            results = scheduler.run_jobs(jobs, msg='Building bowtie2 shards',
+                                         procs=procs, retries=retries)
+
+            if scheduler.failed(results):
+                raise ValueError('bowtie2-build failed for {} shard(s)'.format(
+                    len(scheduler.failed(results))))
+
+            self.save(keys, plan)
+            self.register()
+
+        return building
+
+    def register(self):
+        """Add the manifest to the cache's registry"""
+        manifest = os.path.abspath(self.manifest_file)
+        with FileLock(self.registry + '.lock'):
+            if manifest not in self.registered():
+                with open(self.registry, 'a') as out_fh:
+                    out_fh.write(manifest + '\n')
+
+    def registered(self):
+        """The manifests in the cache's registry"""
+        try:
+            with open(self.registry) as in_fh:
+                return [line.rstrip('\n') for line in in_fh if line.strip()]
+        except OSError:
+            return []
+
+    def referenced(self):
+        """The keys the registered manifests still use, dropping the
+        manifests that are gone or now use another cache"""
+        with FileLock(self.registry + '.lock'):
+            keys, manifests = set(), []
+            for manifest in self.registered():
+                if not manifest.endswith('.shards.tsv'):
+                    continue
+                index = ShardedIndex.existing(manifest[:-len('.shards.tsv')])
+                if os.path.isfile(manifest) and \
+                   index.cache_dir == self.cache_dir:
+                    keys |= set(index.load()[0].values())
+                    manifests.append(manifest)
+
+            tmp_file = '{}.{}.tmp'.format(self.registry, os.getpid())
+            with open(tmp_file, 'w') as out_fh:
+                out_fh.writelines(manifest + '\n' for manifest in manifests)
+            os.replace(tmp_file, self.registry)
+
+        return keys
+
+    def prune(self):
+        """Remove the cached shards no registered manifest uses, return
+        their keys
+
+        Each is removed under its key's lock, and only if no manifest has
+        taken it up meanwhile.
+        """
+        if not os.path.isdir(self.cache_dir):
+            return []
+
+        used = self.referenced()
+        pruned = []
+        for key in sorted(os.listdir(self.cache_dir)):
+            path = os.path.join(self.cache_dir, key)
+            if key in used or '.' in key or not os.path.isdir(path):
+                continue
+            with FileLock(path + '.lock'):
+                if key in self.referenced() or not os.path.isdir(path):
+                    continue
+                shutil.rmtree(path)
+            pruned.append(key)
+
+        return pruned
+
+    def build_job(self, key, genome_dir, genomes, threads):
+        """The scheduler Job building a shard into the cache
+
+        Its reference is written here, the index is built next to it in
+        key.building and the directory renamed to key once complete.
+        """
+        building = os.path.join(self.cache_dir, key + '.building')
+        # left by a build that was killed
+        for path in [building, os.path.join(self.cache_dir, key)]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        os.makedirs(building)
+        prefix = os.path.join(building, 'index')
+        catfasta.cat_fasta([os.path.join(genome_dir, genome + '.fna')
+                            for genome in sorted(genomes)],
+                           prefix + '.fna', fai_file=prefix + '.fna.fai',
+                           map_file=prefix + '.genomes.tsv')
+
+        return scheduler.Job(
+            'bowtie2-build --threads {0} {1} {2}.fna {2} && rm {2}.fna && '
+            'mv {3} {4}'.format(
+                threads, BUILD_OPTS, prefix, building,
+                os.path.join(self.cache_dir, key)),
+            name='bowtie2-build {}'.format(key), cpus=threads)
+
+    def load(self):
+        """The manifest: {shard: key} and
+        {shard: {genome: (size, mtime_ns, sha256)}}
+
+        A manifest of a different number of shards or another cache is no
+        use and is ignored.
+        """
+        keys, genomes = {}, {}
+        try:
+            with open(self.manifest_file) as in_fh:
+                for line in in_fh:
+                    flds = line.rstrip('\n').split('\t')
+                    if flds[0] == '#shards':
+                        if int(flds[1]) != self.num_shards:
+                            return {}, {}
+                    elif flds[0] == '#cache':
+                        if flds[1] != self.cache_dir:
+                            return {}, {}
+                    elif flds[0] == '#key':
+                        keys[int(flds[1])] = flds[2]
+                    else:
+                        shard, genome, size, mtime, digest = flds
+                        genomes.setdefault(int(shard), {})[genome] = (
+                            int(size), int(mtime), digest)
+        except (OSError, ValueError):
+            return {}, {}
+
+        return keys, genomes
+
+    def save(self, keys, genomes):
+        """Atomically replace the manifest"""
+        db_dir = os.path.dirname(self.manifest_file)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        tmp_file = '{}.{}.tmp'.format(self.manifest_file, os.getpid())
+        with open(tmp_file, 'w') as out_fh:
+            out_fh.write('#shards\t{}\n#cache\t{}\n'.format(
+                self.num_shards, self.cache_dir))
+            for shard in sorted(keys):
+                out_fh.write('#key\t{}\t{}\n'.format(shard, keys[shard]))
+            for shard in sorted(genomes):
+                for genome, (size, mtime, digest) in \
+                        sorted(genomes[shard].items()):
+                    out_fh.write('\t'.join(map(str, [shard, genome, size,
+                                                     mtime, digest])) + '\n')
+        os.replace(tmp_file, self.manifest_file)
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""Concatenate FASTA files byte for byte, checking the sequence IDs"""
+
+import argparse
+import os
+import sys
+from collections import namedtuple
+
+# bytes read per block, extended to the end of the line it stops in
+BLOCK_SIZE = 1 << 22
+
+# one line of a samtools .fai: bases, offset of the first base, bases per
+# line and bytes per line
+FaiEntry = namedtuple('FaiEntry', ['name', 'length', 'offset', 'linebases',
+                                   'linewidth'])
+
+# --------------------------------------------------
+def get_args():
+    """get args"""
+    parser = argparse.ArgumentParser(
+        description='Concatenate FASTA files without parsing them',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('fastas',
+                        help='FASTA files, the genome of a sequence is the '
+                        'file name minus its extension',
+                        metavar='FILE',
+                        nargs='+')
+
+    parser.add_argument('-o', '--outfile',
+                        help='Output file',
+                        metavar='FILE',
+                        type=str,
+                        required=True)
+
+    parser.add_argument('-f', '--fai',
+                        help='Also write a samtools faidx index to '
+                        'OUTFILE.fai',
+                        action='store_true')
+
+    parser.add_argument('-m', '--map',
+                        help='Also write sequence ID<TAB>genome to this file',
+                        metavar='FILE',
+                        type=str,
+                        default='')
+
+    return parser.parse_args()
+
+# --------------------------------------------------
+def main():
+    """main"""
+    args = get_args()
+
+    try:
+        entries = cat_fasta(args.fastas, args.outfile,
+                            args.outfile + '.fai' if args.fai else '',
+                            args.map)
+    except ValueError as err:
+        print('Error: {}'.format(err), file=sys.stderr)
+        sys.exit(1)
+
+    print('Wrote {} sequences ({} bases) of {} files to "{}"'.format(
+        len(entries), sum(entry.length for entry in entries),
+        len(args.fastas), args.outfile), file=sys.stderr)
+
+# --------------------------------------------------
+def genome_name(fasta):
+    """The genome of a FASTA file, 1234.5 for genomes/1234.5.fna"""
+    return os.path.splitext(os.path.basename(fasta))[0]
+
+# --------------------------------------------------
+def cat_fasta(fastas, out_file, fai_file='', map_file=''):
+    """Concatenate FASTA files into out_file, return a FaiEntry per sequence
+
+    The files are copied through block by block, never parsed into records.
+    The blocks are only scanned for the header lines, to make sure no
+    sequence ID (the header up to the first space, as bowtie2 and samtools
+    see it) is used twice, and to count the bases of each sequence. A file
+    that does not end in a newline gets one, so its last line does not run
+    into the next file's header.
+
+    fai_file is written if given, which needs every sequence to have lines
+    of the same length (bar its last), as samtools faidx does. map_file
+    gets the sequence ID and genome of every sequence. All the files are
+    written as .tmp and renamed once everything checks out.
+    """
+    try:
+        entries, genomes = copy_fastas(fastas, out_file + '.tmp',
+                                       check_lines=bool(fai_file))
+    except (ValueError, OSError):
+        if os.path.isfile(out_file + '.tmp'):
+            os.remove(out_file + '.tmp')
+        raise
+
+    if fai_file:
+        with open(fai_file + '.tmp', 'w') as out_fh:
+            for entry in entries:
+                out_fh.write('\t'.join(map(str, entry)) + '\n')
+
+    if map_file:
+        with open(map_file + '.tmp', 'w') as out_fh:
+            for entry, genome in zip(entries, genomes):
+                out_fh.write('{}\t{}\n'.format(entry.name, genome))
+
+    for path in [fai_file, map_file, out_file]:
+        if path:
+            os.rename(path + '.tmp', path)
+
+    return entries
+
+# --------------------------------------------------
+def copy_fastas(fastas, out_file, check_lines=False):
+    """Copy FASTA files into out_file, return (FaiEntries, genomes)"""
+    entries, genomes, seen = [], [], {}
+    offset = 0
+    with open(out_file, 'wb') as out_fh:
+        for fasta in fastas:
+            genome = genome_name(fasta)
+            scanner = FastaScanner(fasta, offset)
+            with open(fasta, 'rb') as in_fh:
+                while True:
+                    block = in_fh.read(BLOCK_SIZE)
+                    if not block:
+                        break
+                    if not block.endswith(b'\n'):
+                        block += in_fh.readline()
+                    if not block.endswith(b'\n'):
+                        block += b'\n'
+                    scanner.scan(block)
+                    out_fh.write(block)
+                    offset += len(block)
+
+            for entry in scanner.finish(check_lines):
+                if entry.name in seen:
+                    raise ValueError('Sequence ID "{}" is in both "{}" and '
+                                     '"{}"'.format(entry.name,
+                                                   seen[entry.name], fasta))
+                seen[entry.name] = fasta
+                entries.append(entry)
+                genomes.append(genome)
+
+    return entries, genomes
+
+# --------------------------------------------------
+class FastaScanner:
+    """Find the sequences in the blocks of one FASTA file
+
+    Blocks must end at the end of a line. offset is where the file starts
+    in the concatenated output, for the .fai offsets.
+    """
+
+    def __init__(self, fasta, offset=0):
+        self.fasta = fasta
+        self.offset = offset
+        self.entries = []
+        # name, offset, bases, linebases, linewidth of the sequence being
+        # read, whether its last line so far was short and whether its
+        # lines are of uneven length
+        self.current = None
+
+    def scan(self, block):
+        """Take the next block of the file"""
+        pos = 0
+        while pos < len(block):
+            if block[pos] == ord('>'):
+                end = block.index(b'\n', pos)
+                self.close()
+                name = block[pos + 1:end].split(None, 1)
+                if not name:
+                    raise ValueError('"{}" has a header with no sequence '
+                                     'ID'.format(self.fasta))
+                self.current = [name[0].decode(), self.offset + end + 1, 0, 0,
+                                0, False, False]
+                pos = end + 1
+                continue
+
+            if self.current is None:
+                raise ValueError('"{}" does not start with a ">" header, is '
+                                 'it FASTA?'.format(self.fasta))
+
+            # the sequence lines up to the next header or the end
+            stop = block.find(b'\n>', pos)
+            stop = len(block) if stop == -1 else stop + 1
+            current = self.current
+            if not current[4]:
+                first = block.index(b'\n', pos)
+                current[4] = first - pos + 1
+                current[3] = current[4] - 1 - (block[first - 1:first] == b'\r')
+            newlines = block.count(b'\n', pos, stop)
+            current[2] += stop - pos - newlines - block.count(b'\r', pos, stop)
+
+            # lines are even if every linewidth-th byte is a newline and
+            # there is at most one short line, the very last
+            width = current[4]
+            ends = block[pos + width - 1:stop:width]
+            short = (stop - pos) % width != 0
+            if current[5] or ends.count(b'\n') != len(ends) or \
+               newlines != len(ends) + short:
+                current[6] = True
+            current[5] = short
+            pos = stop
+
+        self.offset += len(block)
+
+    def close(self):
+        """Done with the sequence being read"""
+        if self.current is not None:
+            self.entries.append(self.current)
+            self.current = None
+
+    def finish(self, check_lines=False):
+        """FaiEntries of the file's sequences
+
+        With check_lines a sequence with lines of different lengths (other
+        than a shorter last one) is an error.
+        """
+        self.close()
+        entries = []
+        for name, offset, bases, linebases, linewidth, _, uneven in \
+                self.entries:
+            if check_lines and uneven:
+                raise ValueError('Sequence "{}" of "{}" has lines of uneven '
+                                 'length, it can not be indexed'.format(
+                                     name, self.fasta))
+            entries.append(FaiEntry(name, bases, offset, linebases, linewidth))
+
+        return entries
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -11,12 +11,18 @@ import errno
 from plumbum import local
 import pandas as pd
 
+import download
+import genome_store
+import patric
+import representatives
+from locking import FileLock
+
 #make programs easily accessible in python using plumbum!
-p3_all_genomes = local['p3-all-genomes']
-#by default we do not need to download things twice!
-wget = local['wget']['--no-clobber']
 wc = local['wc']
 
+#lock files of the downloads, relative to the output directory
+LOCK_DIR = '.locks'
+
 #digest those arguments
 if __name__ == "__main__":
     parser = \
@@ -37,6 +43,55 @@ if __name__ == "__main__":
             "NOTE: Choosing \"refseq\" will discard genomes that only have PATRIC annotaion. " \
             "NOTE2: patric annotations will generally include refseq genes. " \
             "Default is \"refseq\" as it is generally better curated.")
+    parser.add_argument("-u", "--base_url", \
+            default="ftp://ftp.patricbrc.org/genomes", \
+            help="Where to download the genomes from, genome_id/genome_id.fna " \
+            "and its annotation are fetched from under it")
+    parser.add_argument("-w", "--workers", action="store", \
+            help="Number of concurrent downloads", \
+            default=8, type=int)
+    parser.add_argument("--retries", action="store", \
+            help="Times to retry a failed download", \
+            default=3, type=int)
+    parser.add_argument("--id_cache", action="store", \
+            help="File caching the PATRIC genome id's of each taxID " \
+            "for all runs, \"\" to always ask PATRIC", \
+            default=patric.DEFAULT_CACHE)
+    parser.add_argument("--id_cache_days", action="store", \
+            help="Days before a cached taxID is looked up again", \
+            default=30, type=float)
+    parser.add_argument("--genome_ids", action="store", \
+            help="Take the genome id's from this taxID<TAB>genome_id file " \
+            "instead of asking PATRIC (for testing offline)", \
+            default='')
+    parser.add_argument("--genome_store", action="store", \
+            help="Genome store shared by all runs, genomes in it are " \
+            "linked into --output instead of downloaded, \"\" for none, " \
+            "best on the file system of --output (default " \
+            "$RADCOT_GENOME_STORE, or none)", \
+            default=genome_store.DEFAULT_STORE)
+    parser.add_argument("--store_max_gb", action="store", \
+            help="Size of the genome store before the least recently " \
+            "used genomes are evicted, 0 for no cap", \
+            default=genome_store.DEFAULT_MAX_GB, type=float)
+    parser.add_argument("-s", "--select", \
+            default="all", choices=representatives.POLICIES, \
+            help="Which genomes of a taxID to get: all of them, the " \
+            "PATRIC reference/representative ones, the --top_n most " \
+            "complete, or the best --max_candidates dereplicated to one " \
+            "per cluster closer than --max_dist. Fewer genomes make a " \
+            "smaller bowtie2 index and faster alignments.")
+    parser.add_argument("-n", "--top_n", action="store", \
+            help="Genomes per taxID for --select complete", \
+            default=5, type=int)
+    parser.add_argument("--max_candidates", action="store", \
+            help="Genomes per taxID to download and compare for " \
+            "--select dereplicate, 0 for all", \
+            default=100, type=int)
+    parser.add_argument("--max_dist", action="store", \
+            help="Mash distance (about 1 - ANI) under which --select " \
+            "dereplicate considers two genomes the same", \
+            default=representatives.MAX_DIST, type=float)
         
     args = parser.parse_args()
 
@@ -54,121 +109,221 @@ def filter_report(report):
 
 def download_genomes(filtered_list):
     
+    store = None
+    if args.genome_store:
+        store = genome_store.GenomeStore(os.path.abspath(args.genome_store),
+                                         int(args.store_max_gb * 1e9))
+
     #change working directory
     try:
         os.chdir(args.output)
     except FileNotFoundError as e:
         print("{}, creating {} for you".format(e, args.output))
-        os.mkdir(args.output)
+        #another run may be creating it as well
+        os.makedirs(args.output, exist_ok=True)
         os.chdir(args.output)
 
     print("Now trying to get the PATRIC id's from p3.theseed.org")
+    resolver = patric.make_resolver(args.genome_ids, args.id_cache,
+                                    args.id_cache_days)
+    try:
+        genomes = resolver.resolve([int(taxID) for taxID in filtered_list])
+    except IOError as e:
+        print(e)
+        print("Contact patricbrc.org")
+        print("Exiting...")
+        sys.exit(1)
+
+    patricIDs = []
+    selected = {}
     for taxID in filtered_list:
-        for i in range(0,3):
-            try:
-                print("Attempt {} of 3".format(i+1))
-                list_of_patricIDs = p3_all_genomes('-e', 'taxon_id'+','+str(taxID))
-    #                '-e', 'genome_status,Complete')
-                list_of_patricIDs = list_of_patricIDs.split('\n') 
-                list_of_patricIDs = [x for x in list_of_patricIDs if x != '' and x != 'genome.genome_id']
-                print("These are the PATRIC id's I got from {}: {}".format(taxID,list_of_patricIDs))
-            
-            except Exception as e:
-                if i == 2:
-                    print("patricbrc.org or p3.theseed.org might be down")
-                    print("Contact patricbrc.org")
-                    print("Exiting...")
-                    sys.exit(1)
-                else:
-                    print("Something went wrong with the PATRIC cli. Error: {}".format(e))
-                    print("Can not continue without PATRIC cli, retrying after 5 seconds")
-                    time.sleep(5)
-                    continue
-
-            break
-
-        for patricID in list_of_patricIDs:
-            if patricID != '' and patricID != 'genome.genome_id':
-                if args.annotation_type == 'refseq':
-                    print('Getting PATRIC genome_id {}'.format(patricID))
-
-                    try:
-                        print('Getting the genome nucleotide sequence ".fna"')
-                        wget('ftp://ftp.patricbrc.org/genomes/' + patricID + '/' + patricID + '.fna')
-                    except Exception as e:
-                        print("Something went wrong with downloading the .fna. Error {}".format(e))
-                        
-                    try:
-                        print('Getting all the RefSeq annotation for {}'.format(patricID))
-                        wget('ftp://ftp.patricbrc.org/genomes/' + patricID + '/' + \
-                            patricID + '.RefSeq*')
-                    except Exception as e:
-                        print("Something went wrong with downloading the Refseq annotation Error {}".format(e))
-
-                    #check to make sure its not a bogus refseq.gff
-                    if os.path.isfile(patricID + '.RefSeq.gff'):
-                        line_count = int(wc('-l', patricID + '.RefSeq.gff').strip().split()[0])
-                        if line_count < 5:
-                            print('The RefSeq.gff is less than 5 lines, it is probably bogus.')
-                            [os.remove(x) for x in glob.glob(patricID + '*')]
-    #                        os.remove(patricID + '.RefSeq*')
-    #                        os.remove(patricID + '.fna' )
-                    else:
-                        print('There was no RefSeq.gff for genome_id {}, therfore deleting the genome'.format(patricID))
-                        try: 
-                            [os.remove(x) for x in glob.glob(patricID + '*')]
-                        except FileNotFoundError as err:
-                            print("FileNotFoundError error: {0}".format(err))
-                            print("Assuming file is already deleted, continuing...")
-
-
-                elif args.annotation_type == 'patric':
-                    print('Getting PATRIC genome_id {}'.format(patricID))
-
-                    try:
-                        print('Getting the genome nucleotide sequence ".fna"')
-                        wget('ftp://ftp.patricbrc.org/genomes/' + patricID + '/' + patricID + '.fna')
-                    except Exception as e:
-                        print("Something went wrong with downloading the .fna. Error {}".format(e))
-                     
-                    try:
-                        print('Getting all the PATRIC annotation for {}'.format(patricID))
-                        wget('ftp://ftp.patricbrc.org/genomes/' + patricID + '/' + \
-                        patricID + '.PATRIC*')
-                    except Exception as e:
-                        print("Something went wrong with downloading the PATRIC annotation Error {}".format(e))
-
-                else:
-                    print("The annotation type {} does not compute".format(args.annotation_type))
-                    sys.exit(1)
-                    
+        list_of_patricIDs = [genome.genome_id for genome in genomes[int(taxID)]]
+        print("These are the PATRIC id's I got from {}: {}".format(taxID,list_of_patricIDs))
+        selected[taxID] = [genome.genome_id for genome in representatives.select(
+            genomes[int(taxID)], args.select, args.top_n, args.max_candidates)]
+        if args.select != 'all':
+            print("Selected ({}) for {}: {}".format(args.select, taxID, selected[taxID]))
+        patricIDs.extend(selected[taxID])
+
+    if args.annotation_type == 'refseq':
+        annotation = '.RefSeq*'
+    elif args.annotation_type == 'patric':
+        annotation = '.PATRIC*'
+    else:
+        print("The annotation type {} does not compute".format(args.annotation_type))
+        sys.exit(1)
+
+    #each genome is linked from the store or downloaded, checked and stored
+    #under its own lock, which other runs sharing this directory take too,
+    #so none of them sees it half done or removes it meanwhile
+    run = os.path.abspath(args.report)
+    linked = []
+
+    def before(patricID):
+        #this run uses the genome, no other run's dereplication may remove it
+        add_claim(patricID, run)
+        if store and store.get(patricID, args.annotation_type, '.') is not None:
+            linked.append(patricID)
+            return True
+        return False
+
+    def after(patricID, downloads):
+        for result in downloads:
+            if result.error:
+                print("Something went wrong with downloading {}. Error {}".format(
+                    result.url, result.error))
+        if args.annotation_type == 'refseq':
+            check_refseq(patricID)
+        if store and os.path.isfile(patricID + '.fna'):
+            #what was downloaded of the genome and survived the checks
+            files = [result.path for result in downloads
+                     if result.path and os.path.isfile(result.path)]
+            for key in store.put(patricID, args.annotation_type, files):
+                print('Evicted {} from the genome store'.format(key))
+
+    #the nucleotide sequence ".fna" and all the annotation of every genome at once
+    print('Getting the ".fna" and {} annotation of {} genomes'.format(
+        args.annotation_type, len(patricIDs)))
+    groups = {}
+    for patricID in patricIDs:
+        url = '{}/{}/{}'.format(args.base_url.rstrip('/'), patricID, patricID)
+        groups[patricID] = [(url + '.fna', '.'), (url + annotation, '.')]
+
+    downloader = download.Downloader(workers=args.workers, retries=args.retries,
+                                     lock_dir=LOCK_DIR)
+    start = time.time()
+    results = downloader.fetch_groups(groups, before, after)
+    if store:
+        print('Linked {} of {} genomes from the genome store {}'.format(
+            len(linked), len(patricIDs), store.root))
+    print(download.throughput([result for downloads in results.values()
+                               for result in downloads], time.time() - start))
+
+    if args.select == 'dereplicate':
+        for taxID in filtered_list:
+            #the candidates that made it, best first
+            candidates = [(patricID, patricID + '.fna') for patricID in selected[taxID]
+                          if os.path.isfile(patricID + '.fna')]
+            kept = representatives.dereplicate(candidates, args.max_dist)
+            print("Kept {} of {} genomes of {} after dereplication: {}".format(
+                len(kept), len(candidates), taxID, kept))
+            for patricID, _ in candidates:
+                if patricID not in kept:
+                    with FileLock(os.path.join(LOCK_DIR, patricID + '.lock')):
+                        others = drop_claim(patricID, run)
+                        if others:
+                            print("Keeping {}, {} other run(s) use it".format(
+                                patricID, len(others)))
+                        else:
+                            remove_files(genome_files(patricID))
+            selected[taxID] = kept
+
+    report_selection(genomes, selected)
+
+def report_selection(genomes, selected):
+    #how much of the reference (and so the bowtie2 index) the selection saved
+    all_genomes = [genome for taxID in selected for genome in genomes[int(taxID)]]
+    kept = [patricID for patricIDs in selected.values() for patricID in patricIDs
+            if os.path.isfile(patricID + '.fna')]
+    all_bp = sum(genome.length for genome in all_genomes)
+    kept_bp = sum(os.path.getsize(patricID + '.fna') for patricID in kept)
+    if all_bp:
+        print("Reference: {} of {} genomes, about {:.1f} of {:.1f} Mbp, the "
+              "bowtie2 index will be about {:.1%} of the size of an index of "
+              "them all".format(len(kept), len(all_genomes), kept_bp / 1e6,
+                               all_bp / 1e6, kept_bp / all_bp))
+    else:
+        print("Reference: {} of {} genomes, {:.1f} Mbp".format(
+            len(kept), len(all_genomes), kept_bp / 1e6))
+
+def genome_files(patricID):
+    #only this genome's files, "1234.5*" would take "1234.56.fna" as well,
+    #and not a download in progress
+    return [path for path in glob.glob(patricID + '.*')
+            if not path.endswith(('.part', '.lock'))]
+
+def claims_file(patricID):
+    return os.path.join(LOCK_DIR, patricID + '.claims')
+
+def read_claims(patricID):
+    #the runs (by report) using a genome, under its lock
+    try:
+        with open(claims_file(patricID)) as claims:
+            return set(line.rstrip('\n') for line in claims if line.strip())
+    except FileNotFoundError:
+        return set()
+
+def write_claims(patricID, runs):
+    if not runs:
+        if os.path.isfile(claims_file(patricID)):
+            os.remove(claims_file(patricID))
+        return
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    tmp = '{}.{}.tmp'.format(claims_file(patricID), os.getpid())
+    with open(tmp, 'w') as claims:
+        claims.writelines(run + '\n' for run in sorted(runs))
+    os.replace(tmp, claims_file(patricID))
+
+def add_claim(patricID, run):
+    runs = read_claims(patricID)
+    if run not in runs:
+        write_claims(patricID, runs | {run})
+
+def drop_claim(patricID, run):
+    #the other runs still using the genome
+    runs = read_claims(patricID) - {run}
+    write_claims(patricID, runs)
+    return runs
+
+def check_refseq(patricID):
+    #check to make sure its not a bogus refseq.gff
+    if os.path.isfile(patricID + '.RefSeq.gff'):
+        line_count = int(wc('-l', patricID + '.RefSeq.gff').strip().split()[0])
+        if line_count < 5:
+            print('The RefSeq.gff is less than 5 lines, it is probably bogus.')
+            remove_files(genome_files(patricID))
+    else:
+        print('There was no RefSeq.gff for genome_id {}, therfore deleting the genome'.format(patricID))
+        remove_files(genome_files(patricID))
+
+def remove_files(files):
+    for x in files:
+        try:
+            os.remove(x)
+        except FileNotFoundError as err:
+            print("FileNotFoundError error: {0}".format(err))
+            print("Assuming file is already deleted, continuing...")
+
 def get_reports(report_file_or_dir):
     
-    if os.path.isfile(args.report):
-
-        report = pd.read_table(args.report,delimiter='\t')
-        list_of_taxids = filter_report(report)
-        download_genomes(list_of_taxids)
+    if os.path.isfile(report_file_or_dir):
+        tsv_files = [report_file_or_dir]
 
-    elif os.path.isdir(args.report):
+    elif os.path.isdir(report_file_or_dir):
         tsv_files = []
-        for root, _, filenames in os.walk(args.report):
-            for filename in filenames:
+        for root, _, filenames in os.walk(report_file_or_dir):
+            for filename in sorted(filenames):
                 if 'tsv' == filename.split('.')[-1]:
                     tsv_files.append(os.path.join(root, filename))
-            if len(tsv_files) < 1:
-                print('Found no files in --report {}'.format(args.report))
-                sys.exit(1)
-            else:
-                for tsv in tsv_files:
-                    report = pd.read_table(tsv,delimiter='\t')
-                    list_of_taxids = filter_report(report)
-                    download_genomes(list_of_taxids)
+        if len(tsv_files) < 1:
+            print('Found no files in --report {}'.format(report_file_or_dir))
+            sys.exit(1)
 
     else:
-        print('{} does not seem to be a file or a directory!'.format(args.report))
+        print('{} does not seem to be a file or a directory!'.format(report_file_or_dir))
         sys.exit(1)
 
+    #plan first: the taxIDs of all the reports, each once, in one download
+    all_taxids = []
+    for tsv in tsv_files:
+        report = pd.read_table(tsv,delimiter='\t')
+        for taxID in filter_report(report):
+            if taxID not in all_taxids:
+                all_taxids.append(taxID)
+
+    print("{} reports share {} NCBI genome id's".format(len(tsv_files), len(all_taxids)))
+    download_genomes(all_taxids)
+
 #All the program besides the functions and setup
 print("Start! {:s}".format(time.ctime()))
 
@@ -6,9 +6,26 @@
 
 import argparse
 import csv
+import io
+import json
 import os
 import re
 import sys
+from collections import defaultdict
+
+import pandas as pd
+
+import abundance
+import fxsplit
+
+# chunk reports are named like "basename.N.ext.tsv" by fxsplit.chunk_namer
+REPORT_NAME = re.compile(r'(.+)\.(\d+)\.([^.]+)\.(tsv|sum)$')
+NUM_FLDS = ['numReads', 'numUniqueReads']
+# the per-read columns kept by the .sum store
+STORE_FLDS = ['readID', 'taxID', 'score', 'hitLength', 'numMatches']
+STORE_BUCKETS = 64
+TSV_FLDS = ['name', 'taxID', 'taxRank', 'genomeSize'] + NUM_FLDS + \
+    ['abundance']
 
 # --------------------------------------------------
 def get_args():
@@ -21,8 +38,18 @@ def get_args():
     parser.add_argument('-r', '--reports_dir', help='Centrifuge reports dir',
                         type=str, metavar='STR', required=True)
     parser.add_argument('-o', '--out_dir', help='Output directory',
-                        type=str, metavar='DIR', 
+                        type=str, metavar='DIR',
                         default=os.path.join(os.getcwd(), 'collapsed'))
+    parser.add_argument('-s', '--sum_format', help='Format of the collapsed '
+                        'per-read classifications, parquet needs pyarrow',
+                        type=str, metavar='STR', default='text',
+                        choices=['text', 'parquet'])
+    parser.add_argument('-a', '--abundance', help='How to compute the '
+                        'abundance column: share of numReads (rounded, as '
+                        'before), or from the .sum files by unique reads or '
+                        'EM (see abundance.py)',
+                        type=str, metavar='STR', default='unique',
+                        choices=['reads', 'unique', 'em'])
     return parser.parse_args()
 
 # --------------------------------------------------
@@ -76,72 +103,158 @@ def main():
         print('Found no files in --reports_dir {}'.format(reports_dir))
         sys.exit(1)
 
-    for i, fasta in enumerate(fasta_files):
-        basename = os.path.basename(fasta)
+    collapse_reports(fasta_files,
+                     [os.path.join(reports_dir, f) for f in split_files],
+                     out_dir, sum_format=args.sum_format,
+                     method=args.abundance)
+
+    print('Done, see output dir "{}"'.format(out_dir))
+
+# --------------------------------------------------
+def group_reports(reports):
+    """Parse each report name once, return {(basename, ext): {type: files}}
+
+    The files of each type are sorted on their chunk number.
+    """
+    groups = defaultdict(lambda: {'tsv': [], 'sum': []})
+    for report in reports:
+        match = REPORT_NAME.match(os.path.basename(report))
+        if match:
+            basename, num, ext, type_ext = match.groups()
+            # storing a tuple with the num first for sorting
+            groups[(basename, ext)][type_ext].append((int(num), report))
+
+    return {key: {file_type: [a[1] for a in sorted(splits[file_type])]
+                  for file_type in splits}
+            for key, splits in groups.items()}
+
+# --------------------------------------------------
+def collapse_reports(input_files, reports, collapse_dir, sum_format='text',
+                     method='unique'):
+    """Collapse the split reports of each input into collapse_dir
+
+    With sum_format "parquet" the .sum files go into a "basename.sum.parquet"
+    store (see write_sum_store) instead of one big text file. method says
+    how the abundance column is computed, see estimate_abundance.
+    """
+    groups = group_reports(reports)
+
+    for i, filename in enumerate(input_files):
+        basename = os.path.basename(filename)
         print('{:4}: {}'.format(i + 1, basename))
-        basename, ext = os.path.splitext(os.path.basename(fasta))
-        if ext == '.gz':
-            basename, ext = os.path.splitext(basename)
-        splits = {'tsv': [], 'sum': []}
-        for split in split_files:
-            regex = r'({})\.(\d+)\.({})\.(tsv|sum)'.format(basename, ext[1:])
-            match = re.match(regex, split)
-            if not match is None:
-                _, num, _, type_ext = match.groups()
-                if type_ext in splits:
-                    # storing a tuple with the num first for sorting
-                    splits[type_ext].append((int(num), os.path.join(reports_dir, split)))
+        basename, ext = fxsplit.split_name(basename)
+        splits = groups.get((basename, ext[1:]), {'tsv': [], 'sum': []})
 
         for file_type in splits:
-            # sort on the fst of the tuple but take the snd
-            files = [a[1] for a in sorted(splits[file_type], key=lambda a: a[0])]
+            files = splits[file_type]
 
             if len(files) < 1:
                 msg = 'WARNING: No files ending with "{}" for "{}"'
                 print(msg.format(file_type, basename))
             else:
-                out_path = os.path.join(out_dir, basename + '.' + file_type)
+                out_path = os.path.join(collapse_dir,
+                                        basename + '.' + file_type)
+                store = file_type == 'sum' and sum_format == 'parquet'
+                if store:
+                    out_path += '.parquet'
+
                 if os.path.isfile(out_path):
                     print('      "{}" exists, skipping'.format(out_path))
+                elif store:
+                    print('      Writing to "{}"'.format(out_path))
+                    write_sum_store(files, out_path)
+                elif file_type == 'tsv':
+                    print('      Writing to "{}"'.format(out_path))
+                    estimates = estimate_abundance(splits['sum'], method)
+                    with open(out_path, 'w') as out_fh:
+                        write_tsv(files, out_fh, estimates)
                 else:
                     print('      Writing to "{}"'.format(out_path))
-                    func = write_tsv if file_type == 'tsv' else write_sum
-                    func(files, open(out_path, 'w'))
+                    with open(out_path, 'w') as out_fh:
+                        write_sum(files, out_fh)
 
-    print('Done, see output dir "{}"'.format(out_dir))
+    return collapse_dir
 
 # --------------------------------------------------
-def write_tsv(files, out_fh):
-    """collapse tsv files"""
-    tax = dict()
-    num_flds = ['numReads', 'numUniqueReads']
+def read_reports(files):
+    """Read centrifuge report files into one data frame
 
+    The bodies are joined and parsed in a single read_csv call, which is
+    much cheaper than opening a parser per file when there are thousands
+    of small chunk reports.
+    """
+    hdr, bodies = None, []
     for fnum, file in enumerate(files):
         print('    {:4}: {}'.format(fnum + 1, os.path.basename(file)))
-        with open(file) as csvfile:
-            reader = csv.DictReader(csvfile, delimiter='\t')
-            for row in reader:
-                tax_id = row['taxID']
-                if not tax_id in tax:
-                    tax[tax_id] = dict()
-                    for fld in row.keys():
-                        tax[tax_id][fld] = int(row[fld]) if fld in num_flds else row[fld]
-                else:
-                    for fld in num_flds:
-                        tax[tax_id][fld] += int(row[fld])
+        with open(file, 'rb') as in_fh:
+            first = in_fh.readline()
+            body = in_fh.read()
+        hdr = hdr or first
+        if body and not body.endswith(b'\n'):
+            body += b'\n'
+        bodies.append(body)
 
-    # Write the headers
-    flds = ['name', 'taxID', 'taxRank', 'genomeSize'] + num_flds + ['abundance']
-    out_fh.write("\t".join(flds) + '\n')
+    return pd.read_csv(io.BytesIO((hdr or b'') + b''.join(bodies)),
+                       sep='\t', usecols=TSV_FLDS[:-1], keep_default_na=False,
+                       dtype={'name': str, 'taxID': 'int64', 'taxRank': str,
+                              'genomeSize': str, 'numReads': 'int64',
+                              'numUniqueReads': 'int64'})
+
+# --------------------------------------------------
+def collapse_tsv(files):
+    """Sum numReads/numUniqueReads of the reports for each taxID
+
+    The other columns are taken from the first report with the taxID, the
+    rows are sorted on taxID.
+    """
+    reports = read_reports(files)
+    first = reports.drop_duplicates('taxID').set_index('taxID')
+    sums = reports.groupby('taxID', sort=True)[NUM_FLDS].sum()
+    tax = first[['name', 'taxRank', 'genomeSize']].join(sums, how='right')
+
+    return tax.reset_index()[TSV_FLDS[:-1]]
+
+# --------------------------------------------------
+def write_tsv(files, out_fh, estimates=None):
+    """collapse tsv files"""
+    write_table(collapse_tsv(files), out_fh, estimates)
+
+# --------------------------------------------------
+def estimate_abundance(sum_files, method):
+    """Estimate abundance from .sum files, see abundance.AbundanceEstimator
 
-    total_reads = sum([tax[s]['numReads'] for s in tax])
+    Returns None for method "reads" or without any .sum files, so the
+    abundance is the rounded share of numReads as it always was.
+    """
+    if method == 'reads' or not sum_files:
+        return None
 
-    for tax_id in sorted(tax.keys(), key=int):
-        species = tax[tax_id]
+    estimator = abundance.AbundanceEstimator()
+    for sum_file in sum_files:
+        estimator.add_file(sum_file)
 
-        species['abundance'] = round(species['numReads'] / total_reads, 2)
+    return estimator.estimate(em=method == 'em')
 
-        out_fh.write('\t'.join([str(species[f]) for f in flds]) + '\n')
+# --------------------------------------------------
+def write_table(tax, out_fh, estimates=None):
+    """Write collapsed taxa with their abundance
+
+    The abundance comes from the estimates of abundance.py if given,
+    otherwise it is the share of numReads rounded to two places.
+    """
+    # Write the headers
+    out_fh.write("\t".join(TSV_FLDS) + '\n')
+
+    if estimates is None:
+        total_reads = int(tax['numReads'].sum())
+        tax['abundance'] = [round(num / total_reads, 2)
+                            for num in tax['numReads'].tolist()]
+    else:
+        share = estimates.set_index('taxID')['abundance']
+        tax['abundance'] = tax['taxID'].map(share).fillna(0.0).astype(float)
+
+    for row in zip(*[tax[f].tolist() for f in TSV_FLDS]):
+        out_fh.write('\t'.join(map(str, row)) + '\n')
 
 # --------------------------------------------------
 def write_sum(files, out_fh):
@@ -156,6 +269,239 @@ def write_sum(files, out_fh):
         for line in in_fh:
             out_fh.write(line)
 
+# --------------------------------------------------
+def write_sum_store(files, out_file, buckets=STORE_BUCKETS,
+                    row_group_size=1 << 20):
+    """Write the .sum files to a compressed, dictionary-encoded parquet file
+
+    Only the STORE_FLDS columns are kept, plus a "bucket" column that is the
+    taxID modulo buckets. The rows are written bucket by bucket, sorted on
+    taxID, so every row group holds one bucket and a narrow taxID range and
+    read_sum_store can skip all the row groups but the few that can hold a
+    taxID. The files are streamed through one temporary Arrow file per
+    bucket, so memory is bounded by the largest bucket, not the sample.
+    """
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.csv as pv
+    import pyarrow.parquet as pq
+
+    types = {'readID': pa.string(), 'taxID': pa.int64(), 'score': pa.int64(),
+             'hitLength': pa.int64(), 'numMatches': pa.int64()}
+    schema = pa.schema([(fld, types[fld]) for fld in STORE_FLDS] +
+                       [('bucket', pa.int16())])
+    parse = pv.ParseOptions(delimiter='\t', quote_char=False)
+    convert = pv.ConvertOptions(column_types=types,
+                                include_columns=STORE_FLDS)
+
+    tmp_dir = out_file + '.buckets'
+    os.makedirs(tmp_dir, exist_ok=True)
+    bucket_files = [os.path.join(tmp_dir, '{}.arrow'.format(b))
+                    for b in range(buckets)]
+    options = pa.ipc.IpcWriteOptions(compression='lz4')
+    writers = [pa.ipc.new_stream(f, schema, options=options)
+               for f in bucket_files]
+
+    for fnum, file in enumerate(files):
+        print('    {:4}: {}'.format(fnum + 1, os.path.basename(file)))
+        for batch in pv.open_csv(file, parse_options=parse,
+                                 convert_options=convert):
+            bucket = batch.column('taxID').to_numpy() % buckets
+            order = np.argsort(bucket, kind='stable')
+            bounds = np.searchsorted(bucket[order], np.arange(buckets + 1))
+            table = pa.Table.from_batches([batch]).take(order)
+            table = table.append_column(
+                'bucket', pa.array(bucket[order], type=pa.int16()))
+            for b in np.flatnonzero(np.diff(bounds)):
+                writers[b].write_table(
+                    table.slice(bounds[b], bounds[b + 1] - bounds[b]))
+
+    for writer in writers:
+        writer.close()
+
+    with pq.ParquetWriter(out_file + '.tmp', schema, compression='zstd',
+                          use_dictionary=True) as writer:
+        for bucket_file in bucket_files:
+            with pa.ipc.open_stream(bucket_file) as reader:
+                table = reader.read_all().sort_by('taxID')
+            if table.num_rows:
+                writer.write_table(table, row_group_size=row_group_size)
+            os.remove(bucket_file)
+    os.rmdir(tmp_dir)
+    os.replace(out_file + '.tmp', out_file)
+
+# --------------------------------------------------
+def read_sum_store(store, tax_ids=None, columns=None, buckets=STORE_BUCKETS):
+    """Read the rows of a .sum store, only those of tax_ids if given"""
+    import pyarrow.parquet as pq
+
+    filters = None
+    if tax_ids is not None:
+        tax_ids = sorted(set(int(tax_id) for tax_id in tax_ids))
+        filters = [('bucket', 'in', sorted(set(t % buckets for t in tax_ids))),
+                   ('taxID', 'in', tax_ids)]
+
+    return pq.read_table(store, columns=columns,
+                         filters=filters).to_pandas()
+
+# --------------------------------------------------
+class RunningCollapse:
+    """Fold chunk reports into the collapsed reports as the chunks finish
+
+    Once every expected chunk of a sample has been added its collapsed
+    .tsv and .sum are written, they are the same as collapse_reports would
+    make. The running totals are checkpointed in state_dir after every
+    chunk, so a restarted run only folds the chunks it has not seen yet.
+    """
+
+    def __init__(self, collapse_dir, state_dir, sum_format='text',
+                 method='unique'):
+        self.collapse_dir = collapse_dir
+        self.state_dir = state_dir
+        self.sum_format = sum_format
+        self.method = method
+        self.expected = {}
+        self.states = {}
+
+    def expect(self, names):
+        """Register the report names ("basename.N.ext") of the chunks"""
+        for name in names:
+            match = REPORT_NAME.match(name + '.tsv')
+            if match:
+                basename, num, ext, _ = match.groups()
+                self.expected.setdefault(basename, (ext, set()))[1].add(
+                    int(num))
+
+    def add(self, tsv_file):
+        """Fold in a finished chunk, return True once its sample is done"""
+        match = REPORT_NAME.match(os.path.basename(tsv_file))
+        if not match or match.group(1) not in self.expected:
+            return False
+
+        basename, num = match.group(1), int(match.group(2))
+        if os.path.isfile(os.path.join(self.collapse_dir, basename + '.tsv')):
+            return True
+
+        state = self.load(basename)
+        if num in state['folded']:
+            return False
+
+        with open(tsv_file) as csvfile:
+            for row in csv.DictReader(csvfile, delimiter='\t'):
+                # like collapse_tsv the names come from the first chunk
+                info = [num, row['name'], row['taxRank'], row['genomeSize']]
+                tax = state['tax'].setdefault(row['taxID'], info + [0, 0])
+                if num < tax[0]:
+                    tax[:4] = info
+                tax[4] += int(row['numReads'])
+                tax[5] += int(row['numUniqueReads'])
+
+        sum_file = tsv_file[:-len('.tsv')] + '.sum'
+        if self.method != 'reads' and os.path.isfile(sum_file):
+            abundance.AbundanceEstimator(state['classes']).add_file(sum_file)
+
+        state['folded'].append(num)
+        self.append_sums(basename, os.path.dirname(tsv_file), state)
+        self.save(basename, state)
+
+        _, nums = self.expected[basename]
+        if nums.issubset(state['folded']):
+            self.finish(basename, state)
+            return True
+
+        return False
+
+    def path(self, basename, ext):
+        """Path of a checkpoint file"""
+        return os.path.join(self.state_dir, basename + ext)
+
+    def load(self, basename):
+        """Return the running state of a sample, resuming a checkpoint"""
+        if basename not in self.states:
+            state = {'folded': [], 'tax': {}, 'sum_next': 0, 'sum_bytes': 0,
+                     'classes': {}}
+            checkpoint = self.path(basename, '.json')
+            if os.path.isfile(checkpoint):
+                with open(checkpoint) as in_fh:
+                    state = json.load(in_fh)
+                # drop whatever was appended after the last checkpoint
+                if os.path.isfile(self.path(basename, '.sum')):
+                    os.truncate(self.path(basename, '.sum'),
+                                state['sum_bytes'])
+            self.states[basename] = state
+
+        return self.states[basename]
+
+    def save(self, basename, state):
+        """Checkpoint the running state of a sample"""
+        os.makedirs(self.state_dir, exist_ok=True)
+        checkpoint = self.path(basename, '.json')
+        with open(checkpoint + '.tmp', 'w') as out_fh:
+            json.dump(state, out_fh)
+        os.replace(checkpoint + '.tmp', checkpoint)
+
+    def append_sums(self, basename, reports_dir, state):
+        """Append the .sum files of the folded chunks that are next in order
+
+        Like write_sum the header of the first chunk is kept and the chunks
+        go in in chunk order, so a chunk that finishes early waits on disk.
+        """
+        ext, nums = self.expected[basename]
+        order = sorted(nums)
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(self.path(basename, '.sum'), 'ab') as out_fh:
+            while state['sum_next'] < len(order) and \
+                    order[state['sum_next']] in state['folded']:
+                sum_file = os.path.join(reports_dir, '{}.{}.{}.sum'.format(
+                    basename, order[state['sum_next']], ext))
+                if os.path.isfile(sum_file):
+                    with open(sum_file, 'rb') as in_fh:
+                        hdr = in_fh.readline()
+                        if state['sum_next'] == 0:
+                            out_fh.write(hdr)
+                        for block in iter(lambda: in_fh.read(1 << 22), b''):
+                            out_fh.write(block)
+                state['sum_next'] += 1
+            state['sum_bytes'] = out_fh.tell()
+
+    def finish(self, basename, state):
+        """Write the collapsed reports of a sample, drop its checkpoint
+
+        The .tsv goes first: if the .sum is lost to a crash in between,
+        collapse_reports still writes it from the chunk .sum files.
+        """
+        out_path = os.path.join(self.collapse_dir, basename)
+        print('      Writing to "{}"'.format(out_path + '.tsv'))
+        tax = pd.DataFrame([[int(tax_id)] + vals[1:]
+                            for tax_id, vals in state['tax'].items()],
+                           columns=['taxID', 'name', 'taxRank', 'genomeSize'] +
+                           NUM_FLDS)
+        tax = tax.sort_values('taxID', kind='stable')[TSV_FLDS[:-1]]
+
+        os.makedirs(self.collapse_dir, exist_ok=True)
+        estimates = None
+        if self.method != 'reads' and state['classes']:
+            estimates = abundance.AbundanceEstimator(
+                state['classes']).estimate(em=self.method == 'em')
+
+        with open(out_path + '.tsv.tmp', 'w') as out_fh:
+            write_table(tax, out_fh, estimates)
+        os.replace(out_path + '.tsv.tmp', out_path + '.tsv')
+
+        if state['sum_bytes'] and self.sum_format == 'parquet':
+            write_sum_store([self.path(basename, '.sum')],
+                            out_path + '.sum.parquet')
+            os.remove(self.path(basename, '.sum'))
+        elif state['sum_bytes']:
+            os.replace(self.path(basename, '.sum'), out_path + '.sum')
+        elif os.path.isfile(self.path(basename, '.sum')):
+            os.remove(self.path(basename, '.sum'))
+
+        os.remove(self.path(basename, '.json'))
+        del self.states[basename]
+        if not os.listdir(self.state_dir):
+            os.rmdir(self.state_dir)
+
 # --------------------------------------------------
 if __name__ == '__main__':
     main()
@@ -36,12 +36,15 @@ __status__ = "Development"
 
 import glob
 import os
+import shlex
 import sys
-import subprocess
 import argparse
 from pprint import pprint
 import pandas as pd
-import tempfile as tmp
+
+import featurecount
+import runner
+import scheduler
 
 #WORK env var will be present on TACC
 #But may not be set when testing locally
@@ -103,6 +106,29 @@ gen_opts.add_argument('-s', '--skip-counting', action='store_true',
         "or gff_dir/file, BUT the out_dir must be created and contain\n"
         "the counts as specified in the metadata.txt.")
 
+gen_opts.add_argument('--fused-counts', dest='fused_counts',
+        action='store_true',
+        help="The reads were counted while they were aligned\n"
+        "(patric_bowtie2.py --counts), into [bam_files].counts in\n"
+        "the bams_dir. Sum those into the count_files instead of\n"
+        "running htseq-count, no bams are needed.")
+
+gen_opts.add_argument('--single-pass', dest='single_pass',
+        action='store_true',
+        help="Count every sample's bams in one run that indexes the\n"
+        "gff once, --procs samples at a time, and also write\n"
+        "count_matrix.tsv (feature x sample) in the out_dir.")
+
+gen_opts.add_argument('--counter', dest='counter',
+        choices=['numpy', 'htseq'], default='numpy',
+        help="What counts the reads per feature, with the htseq-count\n"
+        "options: featurecount.py (numpy), which sums the bams of a\n"
+        "condition and replicate, or htseq-count itself (htseq).\n"
+        "--single-pass needs numpy. [ Default = numpy ]")
+
+gen_opts.add_argument('--gff-only', dest='gff_only', action='store_true',
+        help="Only make the filtered gff to count on, then exit.")
+
 gen_opts.add_argument('-d', '--debug', action='store_true',
         help="Extra logging messages.") 
 
@@ -118,6 +144,12 @@ gen_opts.add_argument('-P', '--procs',
                         type=int,
                         default=1)
 
+gen_opts.add_argument('--retries',
+                        help='Times to rerun a failed job before giving up',
+                        metavar='int',
+                        type=int,
+                        default=1)
+
 program_opts = parser.add_argument_group('Specific program options')
 
 program_opts.add_argument('-v', '--varInt',
@@ -167,33 +199,6 @@ def die(msg='Something went wrong'):
     sys.stderr.flush
     sys.exit(1)
 
-# --------------------------------------------------
-def line_count(fname):
-    """Count the number of lines in a file"""
-    n = 0
-    for _ in open(fname):
-        n += 1
-
-    return n
-
-# --------------------------------------------------
-def run_job_file(jobfile, msg='Running job', procs=1):
-    """Run a job file if there are jobs"""
-    num_jobs = line_count(jobfile)
-    warn('{} (# jobs = {})'.format(msg, num_jobs))
-#--halt now,fail=1 causes parallel to exit with code 1 if any subjobs exit with code 1
-    if num_jobs > 0:
-        cmd = 'parallel --halt now,fail=1 -P {} < {}'.format(procs, jobfile)
-        warn(cmd)
-        completed_process = subprocess.run(cmd, shell=True)
-    else:
-        warn('No jobs to run!')
-        return 0
-
-    os.remove(jobfile)
-
-    return completed_process.returncode
-
 #really basic checker, check that options file exists and then check that each line begins with a '-', then parse
 def parse_options_text(options_txt_path):
     if not (os.path.isfile(options_txt_path)):
@@ -214,19 +219,13 @@ def parse_options_text(options_txt_path):
 
     return options_string
 
-def execute(command):
+def log_file(step):
+    """Where a step logs its output, rotated as it grows"""
+    log_dir = os.path.join(args.out_dir, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
 
-    print('Executing {}'.format(command) + os.linesep)
-    process = subprocess.Popen(command,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=True)
-    (stdout, stderr) = process.communicate()
-    print(stdout.decode() + os.linesep)
-    print(stderr.decode() + os.linesep)
+    return os.path.join(log_dir, step + '.log')
 
-    return process.returncode
 #############################
 # Script-specific Functions #
 #############################
@@ -247,7 +246,8 @@ def filter_gff(gff_in,gff_out):
 
     processCall = 'bash filtering-gffs.sh {} > {}'.format(gff_in,gff_out)
 
-    return_code = execute(processCall)
+    return_code = runner.run(processCall,
+                             log_file=log_file('filtering-gffs')).returncode
 
     if return_code != 0:
         die("Something went wrong with filtering-gffs.sh")
@@ -282,55 +282,151 @@ def read_targets(metadata):
 
     return bams_and_counts
 
+def count_opts():
+
+    #featurecount.py counts as htseq-count -m union does, with the same
+    #options, without parsing each read into python objects
+    try:
+        return featurecount.htseq_options(
+            parse_options_text(args.htseq_count_opt_txt))
+    except ValueError as err:
+        die(str(err))
+
 def htseq_count(gff, metadata, procs):
-    
-    htseq_count_options = parse_options_text(args.htseq_count_opt_txt)
 
-    jobfile = tmp.NamedTemporaryFile(delete=False, mode='wt')
+    if args.counter == 'htseq':
+        htseq_count_options = parse_options_text(args.htseq_count_opt_txt)
+    else:
+        opts = count_opts()
+        count_options = '-t {} -i {} -a {} -s {}'.format(
+            shlex.quote(opts['feature_type']), shlex.quote(opts['id_attr']),
+            opts['minaqual'], opts['stranded'])
+    bin_dir = os.path.dirname(os.path.realpath(__file__))
+
+    jobs = []
     
     metadata = parse_metadata(metadata)
     reps = metadata.groupby(['condition','replicate'])
 
+#featurecount.py [options] gff_file alignment_files
+#the bams of a condition and replicate are summed into one count file
 #htseq-count [options] alignment_file gff_file
     for c in metadata['condition'].unique():
         for r in metadata['replicate'].unique():
-            if len(reps.get_group((c,r))) > 1:
-                bam_string = ''
-                for bam in reps.get_group((c,r))['bam_files']:
-                    bam_string += os.path.join(args.bams_dir,
-                            bam)
-                    bam_string += ' '
-                count_path = os.path.join(args.out_dir,
-                        reps.get_group((c,r))['count_files'].unique()[0])
-                tmpl = 'htseq-count -f bam {0} {1} {2} > {3}\n'
-                if not os.path.isfile(count_path): #dont overwrite
-                    jobfile.write(tmpl.format(htseq_count_options, 
-                    bam_string, 
-                    gff, 
-                    count_path))
+            group = reps.get_group((c,r))
+            bam_string = ' '.join(os.path.join(args.bams_dir, bam)
+                    for bam in group['bam_files'])
+            count_path = os.path.join(args.out_dir,
+                    group['count_files'].unique()[0])
+            if os.path.isfile(count_path): #dont overwrite
+                continue
+            if args.counter == 'numpy':
+                tmpl = '{0}/featurecount.py {1} -f bam -@ {2} -o {3}.tmp {4} {5} && mv {3}.tmp {3}'
+                jobs.append(scheduler.Job(tmpl.format(bin_dir,
+                count_options, 
+                args.threads, 
+                count_path, 
+                gff, 
+                bam_string), cpus=args.threads + 1))
+            elif len(group) > 1:
+                tmpl = 'htseq-count -f bam {0} {1} {2} > {3}'
+                jobs.append(scheduler.Job(tmpl.format(htseq_count_options, 
+                bam_string, 
+                gff, 
+                count_path)))
             else:
-                bam_path = os.path.join(args.bams_dir, 
-                        reps.get_group((c,r))['bam_files'].unique()[0])
-                count_path = os.path.join(args.out_dir,
-                        reps.get_group((c,r))['count_files'].unique()[0])
-                tmpl = 'samtools view -@ {} -h {} | htseq-count {} - {} > {}\n'
-                if not os.path.isfile(count_path):
-                    jobfile.write(tmpl.format(args.threads, 
-                    bam_path, 
-                    htseq_count_options, 
-                    gff, 
-                    count_path))
-    
-    jobfile.close()
+                tmpl = 'samtools view -@ {} -h {} | htseq-count {} - {} > {}'
+                jobs.append(scheduler.Job(tmpl.format(args.threads, 
+                bam_string, 
+                htseq_count_options, 
+                gff, 
+                count_path), cpus=args.threads + 1))
  
     if args.debug:
         print("These are the commands I'm running:\n")
-        execute('cat {}'.format(jobfile.name))
+        for job in jobs:
+            print(job.cmd)
         
-    return_code = run_job_file(jobfile=jobfile.name, msg='Running htseq count', procs=procs)
+    results = scheduler.run_jobs(jobs, msg='Counting reads per feature', procs=procs,
+                                 retries=args.retries)
     
-    if return_code != 0:
-        die("Something went wrong with running htseq_count")
+    if scheduler.failed(results):
+        die("Something went wrong with counting reads per feature")
+
+def count_matrix(gff, metadata, procs):
+
+    #one pass over every sample: the gff is indexed once, here, and procs
+    #workers forked from this process share it, each counting a condition
+    #and replicate's bams into its count file; then the gene x sample
+    #matrix of them all
+    opts = count_opts()
+    try:
+        features = featurecount.Features.from_gff(gff, opts['feature_type'],
+                opts['id_attr'], stranded=opts['stranded'] != 'no')
+    except ValueError as err:
+        die(str(err))
+
+    metadata = parse_metadata(metadata)
+    reps = metadata.groupby(['condition','replicate'])
+
+    samples = {}
+    for c in metadata['condition'].unique():
+        for r in metadata['replicate'].unique():
+            group = reps.get_group((c,r))
+            count_path = os.path.join(args.out_dir,
+                    group['count_files'].unique()[0])
+            samples[count_path] = [os.path.join(args.bams_dir, bam)
+                    for bam in group['bam_files']]
+
+    if args.debug:
+        print("Counting these bams into these count files:\n")
+        pprint(samples)
+
+    try:
+        results = featurecount.count_samples(features, samples,
+                opts['stranded'], opts['minaqual'], procs=procs,
+                threads=args.threads)
+    except (OSError, ValueError) as err:
+        die("Something went wrong with counting reads per feature: "
+            "{}".format(err))
+
+    matrix = os.path.join(args.out_dir, 'count_matrix.tsv')
+    featurecount.write_matrix(matrix,
+            [(os.path.splitext(os.path.basename(count_path))[0],
+              results[count_path][0]) for count_path in samples])
+    print("Wrote the counts of {} samples to {}\n".format(len(samples),
+        matrix))
+
+def sum_counts(metadata):
+
+    #the counts made while aligning, summed as htseq_count would have
+    #counted the bams of a condition and replicate together
+    metadata = parse_metadata(metadata)
+    reps = metadata.groupby(['condition','replicate'])
+
+    for c in metadata['condition'].unique():
+        for r in metadata['replicate'].unique():
+            group = reps.get_group((c,r))
+            count_path = os.path.join(args.out_dir,
+                    group['count_files'].unique()[0])
+            if os.path.isfile(count_path): #dont overwrite
+                continue
+
+            totals = {}
+            for bam in group['bam_files']:
+                counts_file = os.path.join(args.bams_dir, bam) + '.counts'
+                if not os.path.isfile(counts_file):
+                    die("No counts {} of {}, was it aligned with "
+                        "--fused-counts?".format(counts_file, bam))
+                with open(counts_file) as counts:
+                    for line in counts:
+                        feature, count = line.rstrip('\n').split('\t')
+                        totals[feature] = totals.get(feature, 0) + int(count)
+
+            with open(count_path + '.tmp', 'w') as out:
+                for feature, count in totals.items():
+                    out.write('{}\t{}\n'.format(feature, count))
+            os.rename(count_path + '.tmp', count_path)
 
 def run_deseq():
 
@@ -347,7 +443,7 @@ def run_deseq():
                     args.condRef, 
                     deseq2_options)
 
-    return_code = execute(processCall)
+    return_code = runner.run(processCall, log_file=log_file('deseq2')).returncode
 
     if return_code != 0:
         die("Something went wrong with running deseq2")
@@ -407,7 +503,19 @@ if __name__ == '__main__':
         else:
             print("Using the previously filtered {}\n".format(gff_new_name))
 
-        htseq_count(gff_out, args.metadata, args.procs)
+        if args.gff_only:
+            print('Program Complete, Hopefully it Worked!')
+            sys.exit(0)
+
+        if args.fused_counts:
+            sum_counts(args.metadata)
+        elif args.single_pass:
+            if args.counter != 'numpy':
+                die("--single-pass counts with featurecount.py, it can not "
+                    "be used with --counter {}".format(args.counter))
+            count_matrix(gff_out, args.metadata, args.procs)
+        else:
+            htseq_count(gff_out, args.metadata, args.procs)
 
         run_deseq()
 
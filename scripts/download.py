@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""Download files over FTP or HTTP(S) concurrently"""
+
+import argparse
+import contextlib
+import fnmatch
+import ftplib
+import http.client
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+from locking import FileLock
+
+# bytes copied from a connection to the file per read
+BLOCK_SIZE = 1 << 20
+
+# how a download went: path is None and error says why if it failed,
+# missing is True when the server says there is no such file
+Download = namedtuple('Download', ['url', 'path', 'bytes', 'secs', 'attempts',
+                                   'missing', 'error'])
+
+# links in an HTTP directory listing
+HREF = re.compile(r'href="([^"?#]+)"', re.IGNORECASE)
+
+# --------------------------------------------------
+def get_args():
+    """get args"""
+    parser = argparse.ArgumentParser(
+        description='Download files over FTP or HTTP(S) concurrently',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('urls',
+                        help='URLs, the file name may be a glob like '
+                        'genomes/1234.5/1234.5.RefSeq*',
+                        metavar='URL',
+                        nargs='+')
+
+    parser.add_argument('-o', '--out_dir',
+                        help='Output directory',
+                        metavar='DIR',
+                        type=str,
+                        default='.')
+
+    parser.add_argument('-w', '--workers',
+                        help='Concurrent downloads',
+                        metavar='int',
+                        type=int,
+                        default=8)
+
+    parser.add_argument('-r', '--retries',
+                        help='Times to retry a failed download',
+                        metavar='int',
+                        type=int,
+                        default=3)
+
+    return parser.parse_args()
+
+# --------------------------------------------------
+def main():
+    """main"""
+    args = get_args()
+
+    downloader = Downloader(workers=args.workers, retries=args.retries)
+    start = time.time()
+    results = downloader.fetch_all(
+        [(url, args.out_dir) for url in args.urls])
+    print(throughput(results, time.time() - start), file=sys.stderr)
+
+    if any(result.error and not result.missing for result in results):
+        sys.exit(1)
+
+# --------------------------------------------------
+class PermanentError(Exception):
+    """A download that would fail the same way if retried"""
+
+# --------------------------------------------------
+class Downloader:
+    """Fetch files with a pool of threads that each keep their connections
+
+    Every thread holds one open FTP or HTTP connection per host, so fetching
+    many files from one server does not log in or connect for each of them.
+    A failed download is retried with exponential backoff (plus jitter) on a
+    fresh connection, unless the server says the file is not there. Files
+    are written next to their destination as .part and renamed when
+    complete, so a file that exists is always whole; existing files are
+    not fetched again. With a lock_dir each file is fetched under a lock
+    named after it there, so runs sharing an output directory fetch a file
+    once and never see it half-written; fetch_groups instead locks a group
+    of files (a genome's) as one, for as long as it takes to fetch and
+    check them.
+    """
+
+    def __init__(self, workers=8, retries=3, backoff=1.0, timeout=60,
+                 lock_dir=None):
+        self.workers = workers
+        self.lock_dir = lock_dir
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def fetch_all(self, requests):
+        """Fetch (url, out_dir) pairs, return their Downloads
+
+        A URL whose file name is a glob is first expanded against a listing
+        of its directory, into one Download per matching file (a single
+        missing Download if nothing matches).
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            listed = list(pool.map(lambda req: self.expand(*req), requests))
+            files = [file for expanded in listed for file in expanded]
+            found = [file for file in files
+                     if not isinstance(file, Download)]
+            fetched = iter(pool.map(lambda req: self.fetch(*req), found))
+
+            return [file if isinstance(file, Download) else next(fetched)
+                    for file in files]
+
+    def expand(self, url, out_dir):
+        """[(url, path)] of the files a URL names, or [a failed Download]"""
+        name = url.rsplit('/', 1)[-1]
+        if not any(char in name for char in '*?['):
+            return [(url, os.path.join(out_dir, name))]
+
+        base = url[:-len(name)]
+        try:
+            names = self.attempt(lambda: self.listing(base))
+        except Exception as err:
+            missing = isinstance(err, PermanentError)
+            return [Download(url, None, 0, 0.0, 1, missing, str(err))]
+
+        matches = sorted(fnmatch.filter(names, name))
+        if not matches:
+            return [Download(url, None, 0, 0.0, 1, True, 'no match')]
+
+        return [(base + match, os.path.join(out_dir, match))
+                for match in matches]
+
+    def fetch_groups(self, groups, before=None, after=None):
+        """Fetch {key: [(url, out_dir)]} a group per thread at a time,
+        return {key: [Downloads]}
+
+        With a lock_dir each group is fetched under the lock key.lock there,
+        and the lock is held across before(key), which skips the group if it
+        returns True (no Downloads), the downloads and after(key, Downloads),
+        so other runs locking the same key never see the group half done.
+        """
+        def fetch_group(key):
+            with self.lock(key):
+                if before is not None and before(key):
+                    return []
+                downloads = []
+                for request in groups[key]:
+                    for file in self.expand(*request):
+                        downloads.append(file if isinstance(file, Download)
+                                         else self.fetch_locked(*file))
+                if after is not None:
+                    after(key, downloads)
+
+            return downloads
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return dict(zip(groups, pool.map(fetch_group, groups)))
+
+    def lock(self, name):
+        """The lock name.lock in lock_dir, none without a lock_dir"""
+        if not self.lock_dir:
+            return contextlib.nullcontext()
+
+        return FileLock(os.path.join(self.lock_dir, name + '.lock'))
+
+    def fetch(self, url, path):
+        """Download url to path unless it is there, return a Download"""
+        with self.lock(os.path.basename(path)):
+            return self.fetch_locked(url, path)
+
+    def fetch_locked(self, url, path):
+        """fetch, once any lock on path is held"""
+        if os.path.isfile(path):
+            return Download(url, path, 0, 0.0, 0, False, None)
+
+        part = path + '.part'
+        start = time.time()
+        attempts = [0]
+
+        def once():
+            attempts[0] += 1
+            with open(part, 'wb') as out_fh:
+                self.retrieve(url, out_fh)
+            os.rename(part, path)
+
+        try:
+            self.attempt(once)
+        except Exception as err:
+            if os.path.isfile(part):
+                os.remove(part)
+            return Download(url, None, 0, time.time() - start, attempts[0],
+                            isinstance(err, PermanentError), str(err))
+
+        return Download(url, path, os.path.getsize(path), time.time() - start,
+                        attempts[0], False, None)
+
+    def attempt(self, func):
+        """Call func, retrying with backoff, dropping connections on error"""
+        for attempt in range(self.retries + 1):
+            try:
+                return func()
+            except PermanentError:
+                raise
+            except Exception:
+                self.close()
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt *
+                           (1 + random.random()))
+
+    def connection(self, url):
+        """This thread's open connection to the server of url"""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        conns = self.local.__dict__.setdefault('conns', {})
+        if key not in conns:
+            if parts.scheme == 'ftp':
+                conn = ftplib.FTP(timeout=self.timeout)
+                conn.connect(parts.hostname, parts.port or 21)
+                conn.login(parts.username or 'anonymous',
+                           parts.password or 'anonymous@')
+                conn.voidcmd('TYPE I')
+            elif parts.scheme == 'https':
+                conn = http.client.HTTPSConnection(parts.hostname, parts.port,
+                                                   timeout=self.timeout)
+            elif parts.scheme == 'http':
+                conn = http.client.HTTPConnection(parts.hostname, parts.port,
+                                                  timeout=self.timeout)
+            else:
+                raise PermanentError('Can not download "{}"'.format(url))
+            conns[key] = conn
+
+        return conns[key]
+
+    def close(self):
+        """Drop this thread's connections, the next use reconnects"""
+        for conn in self.local.__dict__.pop('conns', {}).values():
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def retrieve(self, url, out_fh):
+        """Copy the file at url into out_fh"""
+        conn = self.connection(url)
+        path = urlsplit(url).path
+        if isinstance(conn, ftplib.FTP):
+            try:
+                conn.retrbinary('RETR ' + path, out_fh.write, BLOCK_SIZE)
+            except ftplib.error_perm as err:
+                raise PermanentError(str(err))
+            return
+
+        response = self.get(conn, path)
+        while True:
+            block = response.read(BLOCK_SIZE)
+            if not block:
+                break
+            out_fh.write(block)
+
+    def listing(self, base):
+        """Names of the files in the directory URL base"""
+        conn = self.connection(base)
+        path = urlsplit(base).path
+        if isinstance(conn, ftplib.FTP):
+            try:
+                return [name.rsplit('/', 1)[-1] for name in conn.nlst(path)]
+            except ftplib.error_perm as err:
+                # an empty directory is an error to some servers
+                if str(err).startswith('550'):
+                    raise PermanentError(str(err))
+                raise
+
+        body = self.get(conn, path).read().decode('utf-8', 'replace')
+        links = [urljoin(base, href) for href in HREF.findall(body)]
+
+        return [link[len(base):] for link in links
+                if link.startswith(base) and '/' not in link[len(base):]]
+
+    @staticmethod
+    def get(conn, path):
+        """GET path on a kept-alive HTTP connection, return the response"""
+        conn.request('GET', path)
+        response = conn.getresponse()
+        if response.status != 200:
+            response.read()
+            msg = 'HTTP {} {} for {}'.format(response.status,
+                                              response.reason, path)
+            if response.status in (403, 404, 410):
+                raise PermanentError(msg)
+            raise IOError(msg)
+
+        return response
+
+# --------------------------------------------------
+def throughput(results, secs):
+    """One line summing up Downloads that took secs altogether"""
+    got = [result for result in results if result.path and result.attempts]
+    total = sum(result.bytes for result in got)
+
+    return 'Downloaded {} file{} ({:.1f} MB) in {:.1f}s, {:.2f} MB/s; ' \
+        '{} already there, {} missing, {} failed'.format(
+            len(got), '' if len(got) == 1 else 's', total / 1e6, secs,
+            total / 1e6 / secs if secs else 0.0,
+            sum(1 for result in results if result.path and
+                not result.attempts),
+            sum(1 for result in results if result.missing),
+            sum(1 for result in results if result.error and
+                not result.missing))
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,826 @@
+#!/usr/bin/env python3
+"""Count the reads on each feature of a GFF, as htseq-count -m union does"""
+
+import argparse
+import bisect
+import contextlib
+import itertools
+import multiprocessing
+import operator
+import os
+import re
+import shlex
+import subprocess
+import sys
+from collections import defaultdict
+
+import numpy as np
+
+# what htseq-count counts besides the features, in the order it writes them
+SPECIAL = ['__no_feature', '__ambiguous', '__too_low_aQual', '__not_aligned',
+           '__alignment_not_unique']
+
+STRANDED = ['yes', 'no', 'reverse']
+
+# htseq-count's defaults, for the options a run leaves out
+DEFAULTS = {'feature_type': 'exon', 'id_attr': 'gene_id', 'minaqual': 10,
+            'stranded': 'yes'}
+
+# alignment flags
+PAIRED = 0x1
+UNMAPPED = 0x4
+REVERSE = 0x10
+FIRST_MATE = 0x40
+SECOND_MATE = 0x80
+NOT_PRIMARY = 0x100 | 0x800
+
+CIGAR = re.compile(r'(\d+)([MIDNSHP=X])')
+
+# SAM records counted at once
+BATCH_SIZE = 1 << 17
+
+# bits of a position in a segment key, the rest is the sequence and strand
+POS_BITS = 40
+
+# CIGAR operations that place read bases on the reference, the ones that
+# can overlap a feature, and the ones that move along the reference
+MATCH_OPS = 'M=X'
+REF_OPS = 'MDN=X'
+
+# --------------------------------------------------
+def get_args():
+    """get args"""
+    parser = argparse.ArgumentParser(
+        description='Count reads per feature from SAM, like htseq-count '
+        '-m union',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('gff',
+                        help='GFF of the features',
+                        metavar='GFF')
+
+    parser.add_argument('sams',
+                        help='SAM or BAM files with the mates of a pair '
+                        'next to each other (sorted by name, or as bowtie2 '
+                        'writes them), - for stdin; the counts of all of '
+                        'them are summed',
+                        metavar='SAM',
+                        nargs='+')
+
+    parser.add_argument('-t', '--type',
+                        help='Feature type (3rd GFF column) to count',
+                        metavar='str',
+                        type=str,
+                        default=DEFAULTS['feature_type'])
+
+    parser.add_argument('-i', '--idattr',
+                        help='GFF attribute naming the feature',
+                        metavar='str',
+                        type=str,
+                        default=DEFAULTS['id_attr'])
+
+    parser.add_argument('-a', '--minaqual',
+                        help='Skip reads with a lower alignment quality',
+                        metavar='int',
+                        type=int,
+                        default=DEFAULTS['minaqual'])
+
+    parser.add_argument('-s', '--stranded',
+                        help='Whether reads are on the strand of their '
+                        'feature',
+                        metavar='str',
+                        type=str,
+                        choices=STRANDED,
+                        default=DEFAULTS['stranded'])
+
+    parser.add_argument('-f', '--format',
+                        help='Format of the alignments, auto is BAM for '
+                        '*.bam and SAM otherwise',
+                        metavar='str',
+                        type=str,
+                        choices=['auto', 'sam', 'bam'],
+                        default='auto')
+
+    parser.add_argument('-@', '--threads',
+                        help='Threads of samtools decompressing a BAM',
+                        metavar='int',
+                        type=int,
+                        default=1)
+
+    parser.add_argument('-o', '--outfile',
+                        help='Output file',
+                        metavar='FILE',
+                        type=argparse.FileType('wt'),
+                        default=sys.stdout)
+
+    return parser.parse_args()
+
+# --------------------------------------------------
+def main():
+    """main"""
+    args = get_args()
+
+    try:
+        features = Features.from_gff(args.gff, args.type, args.idattr,
+                                     stranded=args.stranded != 'no')
+    except ValueError as err:
+        print('Error: {}'.format(err), file=sys.stderr)
+        sys.exit(1)
+
+    counter = FeatureCounter(features, args.stranded, args.minaqual)
+    for sam in args.sams:
+        is_bam = args.format == 'bam' or \
+            (args.format == 'auto' and sam.endswith('.bam'))
+        try:
+            with open_alignments(sam, is_bam, args.threads) as in_fh:
+                for line in in_fh:
+                    counter.feed(line)
+        except (OSError, ValueError) as err:
+            print('Error: {}'.format(err), file=sys.stderr)
+            sys.exit(1)
+    counter.finish()
+    counter.write(args.outfile)
+
+# --------------------------------------------------
+@contextlib.contextmanager
+def open_alignments(sam, is_bam=False, threads=1):
+    """The SAM lines of a file (- for stdin), a BAM read through samtools
+    view"""
+    if not is_bam:
+        with open(sys.stdin.fileno(), closefd=False) if sam == '-' \
+                else open(sam) as in_fh:
+            yield in_fh
+        return
+
+    proc = subprocess.Popen(['samtools', 'view', '-@', str(threads), sam],
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    with proc.stdout:
+        yield proc.stdout
+    if proc.wait():
+        raise ValueError('samtools view failed on "{}"'.format(sam))
+
+# --------------------------------------------------
+def htseq_options(options):
+    """The counting options of an htseq-count command line
+
+    Returns keyword arguments for Features.from_gff and FeatureCounter,
+    htseq-count's defaults for the options not given. Only -m union, the
+    default, is supported; the format and order options do not matter here.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-t', '--type', dest='feature_type',
+                        default=DEFAULTS['feature_type'])
+    parser.add_argument('-i', '--idattr', dest='id_attr',
+                        default=DEFAULTS['id_attr'])
+    parser.add_argument('-a', '--minaqual', type=int,
+                        default=DEFAULTS['minaqual'])
+    parser.add_argument('-s', '--stranded', choices=STRANDED,
+                        default=DEFAULTS['stranded'])
+    parser.add_argument('-m', '--mode', default='union')
+    parser.add_argument('-f', '--format')
+    parser.add_argument('-r', '--order')
+    parser.add_argument('-q', '--quiet', action='store_true')
+
+    opts, unknown = parser.parse_known_args(shlex.split(options or '',
+                                                        comments=True))
+    if unknown:
+        raise ValueError('htseq-count options {} are not supported'.format(
+            ' '.join(unknown)))
+    if opts.mode != 'union':
+        raise ValueError('Only htseq-count -m union is supported, not '
+                         '"{}"'.format(opts.mode))
+
+    return {'feature_type': opts.feature_type, 'id_attr': opts.id_attr,
+            'minaqual': opts.minaqual, 'stranded': opts.stranded}
+
+# --------------------------------------------------
+def gff_attributes(text):
+    """{name: value} of a GFF3 (ID=x;Name=y) or GTF (gene_id "x";) column"""
+    attrs = {}
+    for field in text.strip().split(';'):
+        field = field.strip()
+        if not field:
+            continue
+        if '=' in field:
+            name, _, value = field.partition('=')
+        else:
+            name, _, value = field.partition(' ')
+        attrs[name.strip()] = value.strip().strip('"')
+
+    return attrs
+
+# --------------------------------------------------
+class Features:
+    """The features of a GFF, by reference sequence, for overlap queries
+
+    Each sequence has its features as (start, end, strand, id) sorted by
+    start, with GFF's 1-based inclusive coordinates made 0-based half open,
+    and the length of its longest feature to bound a search.
+
+    For counting many reads at once every sequence and strand is also cut
+    into segments at each feature start and end, as htseq-count's genomic
+    array of sets is. A segment starts at a key, its sequence and strand
+    number above POS_BITS and its position below, so the segments of all
+    the sequences are one sorted array to search. Each segment has the
+    number of distinct features on it and, if that is one, which.
+    """
+
+    def __init__(self, by_chrom, ids, stranded=True):
+        self.stranded = stranded
+        self.ids = ids
+        self.chroms = {}
+        for chrom, features in by_chrom.items():
+            features.sort()
+            self.chroms[chrom] = (
+                [feature[0] for feature in features], features,
+                max(feature[1] - feature[0] for feature in features))
+
+        self.names = sorted(ids)
+        self.contigs = {chrom: i for i, chrom in enumerate(sorted(by_chrom))}
+        self.segments()
+
+    def segments(self):
+        """Build the segment arrays: bounds, the running count of segments
+        with two or more features, and the feature of each segment with
+        one (len(names) for the others)"""
+        index = {name: i for i, name in enumerate(self.names)}
+        strands = '+-' if self.stranded else '.'
+        bounds, multi, single = [], [], []
+        for chrom, i in sorted(self.contigs.items(), key=lambda item: item[1]):
+            features = self.chroms[chrom][1]
+            for j, strand in enumerate(strands):
+                base = (i * len(strands) + j) << POS_BITS
+                these = [feature for feature in features
+                         if not self.stranded or feature[2] == strand]
+                starts = np.array([f[0] for f in these], dtype=np.int64) + base
+                ends = np.array([f[1] for f in these], dtype=np.int64) + base
+                ids = np.array([index[f[3]] for f in these], dtype=np.int64)
+
+                cuts = np.unique(np.concatenate([[base], starts, ends]))
+                first = np.searchsorted(cuts, starts)
+                spans = np.searchsorted(cuts, ends) - first
+
+                # every (segment, feature) pair, each once
+                seg = np.repeat(first - np.cumsum(spans) + spans, spans) + \
+                    np.arange(spans.sum())
+                pairs = np.unique(seg * len(self.names) +
+                                  np.repeat(ids, spans))
+                seg, ids = pairs // len(self.names), pairs % len(self.names)
+
+                num = np.bincount(seg, minlength=len(cuts))
+                one = np.full(len(cuts), len(self.names), dtype=np.int64)
+                one[seg[num[seg] == 1]] = ids[num[seg] == 1]
+
+                bounds.append(cuts)
+                multi.append(num > 1)
+                single.append(one)
+
+        self.bounds = np.concatenate(bounds or [np.zeros(0, dtype=np.int64)])
+        self.multi = np.concatenate([[0], np.cumsum(
+            np.concatenate(multi or [np.zeros(0, dtype=bool)]))])
+        self.single = np.concatenate(single or [np.zeros(0, dtype=np.int64)])
+
+    def keys(self, contigs, reverse, positions):
+        """Segment keys of positions on contigs (numbers) and strands"""
+        if self.stranded:
+            cs = contigs * 2 + reverse
+        else:
+            cs = contigs
+
+        return (cs << POS_BITS) + positions
+
+    def resolve(self, contigs, reverse, starts, ends):
+        """What the blocks starts-ends overlap: whether two or more features
+        and the lowest and highest feature ID alone on a segment
+        (len(names) and -1 if none)"""
+        lows = np.searchsorted(self.bounds, self.keys(contigs, reverse, starts),
+                               'right') - 1
+        highs = np.searchsorted(self.bounds, self.keys(contigs, reverse, ends),
+                                'left')
+        several = self.multi[highs] > self.multi[lows]
+
+        none = len(self.names)
+        first = np.full(len(starts), none, dtype=np.int64)
+        last = np.full(len(starts), -1, dtype=np.int64)
+        spans = highs - lows
+        for step in range(spans.max() if len(spans) else 0):
+            on = np.flatnonzero(spans > step)
+            ids = self.single[lows[on] + step]
+            first[on] = np.minimum(first[on], ids)
+            last[on] = np.maximum(last[on], np.where(ids == none, -1, ids))
+
+        return several, first, last
+
+    @classmethod
+    def from_gff(cls, gff, feature_type='exon', id_attr='gene_id',
+                 stranded=True):
+        """The features of one type in a GFF, named by id_attr
+
+        As htseq-count, a feature without the attribute, or without a strand
+        when counting stranded, is an error.
+        """
+        by_chrom, ids = defaultdict(list), set()
+        with open(gff) as in_fh:
+            for line in in_fh:
+                if line.startswith('#') or not line.strip():
+                    continue
+                flds = line.rstrip('\n').split('\t')
+                if len(flds) < 9:
+                    raise ValueError('"{}" has a line of {} columns, not '
+                                     '9'.format(gff, len(flds)))
+                if flds[2] != feature_type:
+                    continue
+
+                attrs = gff_attributes(flds[8])
+                if id_attr not in attrs:
+                    raise ValueError('Feature at {}:{} of "{}" has no "{}" '
+                                     'attribute'.format(flds[0], flds[3], gff,
+                                                        id_attr))
+                if stranded and flds[6] not in '+-':
+                    raise ValueError('Feature {} has no strand, count it '
+                                     'unstranded'.format(attrs[id_attr]))
+                by_chrom[flds[0]].append((int(flds[3]) - 1, int(flds[4]),
+                                          flds[6], attrs[id_attr]))
+                ids.add(attrs[id_attr])
+
+        if not ids:
+            print('Warning: no features of type "{}" in "{}"'.format(
+                feature_type, gff), file=sys.stderr)
+
+        return cls(by_chrom, ids, stranded)
+
+    def overlapping(self, chrom, start, end, strand):
+        """IDs of the features overlapping start-end of chrom on strand
+
+        None if no feature is on chrom at all.
+        """
+        if chrom not in self.chroms:
+            return None
+
+        starts, features, longest = self.chroms[chrom]
+        found = set()
+        first = bisect.bisect_left(starts, start - longest)
+        for i in range(first, bisect.bisect_left(starts, end)):
+            f_start, f_end, f_strand, f_id = features[i]
+            if f_end > start and (not self.stranded or f_strand == strand):
+                found.add(f_id)
+
+        return found
+
+# --------------------------------------------------
+class Alignment:
+    """The fields of one SAM record that counting needs"""
+
+    __slots__ = ['flag', 'chrom', 'pos', 'mapq', 'cigar', 'nh']
+
+    def __init__(self, line):
+        flds = line.split('\t')
+        self.flag = int(flds[1])
+        self.chrom = flds[2]
+        self.pos = int(flds[3]) - 1
+        self.mapq = int(flds[4])
+        self.cigar = flds[5]
+        self.nh = 1
+        for tag in flds[11:]:
+            if tag.startswith('NH:i:'):
+                self.nh = int(tag[5:])
+                break
+
+    @property
+    def aligned(self):
+        """Whether the record is an alignment"""
+        return not self.flag & UNMAPPED
+
+    def blocks(self, flip=False):
+        """(chrom, start, end, strand) of the aligned blocks"""
+        reverse = bool(self.flag & REVERSE) != flip
+        strand = '-' if reverse else '+'
+        pos = self.pos
+        for size, op in CIGAR.findall(self.cigar):
+            size = int(size)
+            if op in MATCH_OPS and size:
+                yield self.chrom, pos, pos + size, strand
+            if op in REF_OPS:
+                pos += size
+
+# --------------------------------------------------
+class SimpleCounter:
+    """Count the reads (or pairs) of a SAM stream on features, one by one
+
+    Lines are fed one at a time; the records of a read are gathered until
+    the read name changes, so the mates of a pair must be next to each
+    other, as in a name-sorted file or bowtie2's own output. A read counts
+    for a feature if all its aligned blocks overlap that feature and no
+    other (htseq-count -m union), or else for __no_feature or __ambiguous.
+    Unaligned reads, reads with an NH tag above 1 and reads with a mate
+    below minaqual are counted apart, as htseq-count does. Secondary and
+    supplementary records are left out; bowtie2 writes none by default.
+
+    FeatureCounter counts the same, many reads at a time; this is what it
+    is checked against (benchmark.py count).
+    """
+
+    def __init__(self, features, stranded='yes', minaqual=10):
+        self.features = features
+        self.stranded = stranded
+        self.minaqual = minaqual
+        self.counts = dict.fromkeys(features.ids, 0)
+        self.special = dict.fromkeys(SPECIAL, 0)
+        self.name = None
+        self.records = []
+
+    def feed(self, line):
+        """Take the next line of SAM"""
+        if line.startswith('@'):
+            return
+        name = line.split('\t', 1)[0]
+        if name != self.name:
+            self.finish()
+            self.name = name
+        self.records.append(line)
+
+    def finish(self):
+        """Count the read being gathered, call once the stream ends"""
+        if not self.records:
+            return
+
+        first, second = None, None
+        for line in self.records:
+            record = Alignment(line)
+            if record.flag & NOT_PRIMARY:
+                continue
+            if not record.flag & PAIRED:
+                self.count_read(record, None)
+            elif record.flag & FIRST_MATE:
+                first = first or record
+            elif record.flag & SECOND_MATE:
+                second = second or record
+        if first or second:
+            self.count_read(first, second)
+
+        self.name, self.records = None, []
+
+    def count_read(self, first, second):
+        """Count a read, or the mates of a pair (either may be None)"""
+        mates = [mate for mate in [first, second] if mate is not None]
+        if not any(mate.aligned for mate in mates):
+            self.special['__not_aligned'] += 1
+            return
+        if any(mate.nh > 1 for mate in mates):
+            self.special['__alignment_not_unique'] += 1
+            return
+        if any(mate.mapq < self.minaqual for mate in mates):
+            self.special['__too_low_aQual'] += 1
+            return
+
+        # the second mate is on the other strand of the fragment
+        reverse = self.stranded == 'reverse'
+        blocks = []
+        if first is not None and first.aligned:
+            blocks += first.blocks(flip=reverse)
+        if second is not None and second.aligned:
+            blocks += second.blocks(flip=not reverse)
+
+        found = set()
+        for chrom, start, end, strand in blocks:
+            overlap = self.features.overlapping(chrom, start, end, strand)
+            if overlap is None:
+                found = set()
+                break
+            found |= overlap
+
+        if not found:
+            self.special['__no_feature'] += 1
+        elif len(found) > 1:
+            self.special['__ambiguous'] += 1
+        else:
+            self.counts[found.pop()] += 1
+
+    def write(self, out_fh):
+        """Write the counts as htseq-count does"""
+        write_counts(out_fh, self.counts, self.special)
+
+# --------------------------------------------------
+def write_counts(out_fh, counts, special):
+    """Write {feature: count} sorted by feature, then the SPECIAL counts"""
+    for feature_id in sorted(counts):
+        out_fh.write('{}\t{}\n'.format(feature_id, counts[feature_id]))
+    for name in SPECIAL:
+        out_fh.write('{}\t{}\n'.format(name, special[name]))
+
+# --------------------------------------------------
+class CigarTable(dict):
+    """{CIGAR: number} of the CIGARs seen, with their aligned blocks
+
+    The blocks of CIGAR number i are offsets[first[i]:first[i] + num[i]]
+    from the alignment start, of lengths[...]. There are few distinct
+    CIGARs in a run, so each is parsed once.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lists = ([], [], [], [])
+
+    def __missing__(self, cigar):
+        first, num, offsets, lengths = self.lists
+        first.append(len(offsets))
+        pos = 0
+        for size, op in CIGAR.findall(cigar):
+            size = int(size)
+            if op in MATCH_OPS and size:
+                offsets.append(pos)
+                lengths.append(size)
+            if op in REF_OPS:
+                pos += size
+        num.append(len(offsets) - first[-1])
+        self[cigar] = len(first) - 1
+
+        return self[cigar]
+
+    def arrays(self):
+        """first, num, offsets and lengths as arrays"""
+        return [np.array(values, dtype=np.int64) for values in self.lists]
+
+# --------------------------------------------------
+class FeatureCounter:
+    """Count the reads (or pairs) of a SAM stream on features, in batches
+
+    Counts what SimpleCounter does, and the same lines may be fed, but
+    records are gathered into batches of BATCH_SIZE (never splitting a
+    read's records) and each batch is counted with array operations: the
+    fields are parsed column by column, the aligned blocks of all reads
+    are looked up in the Features' segments at once, and a read gets the
+    union of what its blocks overlap.
+    """
+
+    def __init__(self, features, stranded='yes', minaqual=10):
+        self.features = features
+        self.stranded = stranded
+        self.minaqual = minaqual
+        self.totals = np.zeros(len(features.names), dtype=np.int64)
+        self.special = dict.fromkeys(SPECIAL, 0)
+        self.cigars = CigarTable()
+        self.lines = []
+
+    @property
+    def counts(self):
+        """{feature: count}"""
+        return dict(zip(self.features.names, self.totals.tolist()))
+
+    def feed(self, line):
+        """Take the next line of SAM"""
+        if line[0] != '@':
+            self.lines.append(line)
+            if len(self.lines) >= BATCH_SIZE:
+                self.flush(keep_last=True)
+
+    def finish(self):
+        """Count the reads being gathered, call once the stream ends"""
+        self.flush()
+
+    def flush(self, keep_last=False):
+        """Count the lines gathered, but for the last read's if keep_last,
+        as more of its records may follow"""
+        lines, self.lines = self.lines, []
+        if keep_last:
+            name = lines[-1].split('\t', 1)[0] + '\t'
+            cut = len(lines)
+            while cut and lines[cut - 1].startswith(name):
+                cut -= 1
+            if cut:
+                lines, self.lines = lines[:cut], lines[cut:]
+        if lines:
+            self.count(lines)
+
+    def count(self, lines):
+        """Count the reads of SAM record lines"""
+        flds = [line.split('\t', 6) for line in lines]
+        num = len(flds)
+        names, flags, chroms, starts, mapqs, cigars, rest = [
+            [f[i] for f in flds] for i in range(7)]
+
+        # one past the end, a missing mate: unaligned, unique, good quality
+        flag = np.append(np.fromiter(map(int, flags), np.int64, num),
+                         UNMAPPED)
+        contig = np.fromiter(map(self.features.contigs.get, chroms,
+                                 itertools.repeat(-1)), np.int64, num)
+        pos = np.fromiter(map(int, starts), np.int64, num) - 1
+        mapq = np.append(np.fromiter(map(int, mapqs), np.int64, num),
+                         self.minaqual)
+        cigar = np.fromiter(map(self.cigars.__getitem__, cigars), np.int64,
+                            num)
+        nh = np.ones(num + 1, dtype=np.int64)
+        for i, tags in enumerate(rest):
+            if '\tNH:i:' in tags:
+                nh[i] = int(tags.split('\tNH:i:', 1)[1].split('\t', 1)[0])
+
+        # reads: each primary unpaired record, and the first primary first
+        # and second mate of each name
+        new_name = np.fromiter(map(operator.ne, names, names[1:]), bool,
+                               num - 1)
+        group = np.concatenate([[0], np.cumsum(new_name)])
+        primary = flag[:num] & NOT_PRIMARY == 0
+        paired = primary & (flag[:num] & PAIRED != 0)
+        unpaired = np.flatnonzero(primary & ~paired)
+        mate1 = np.flatnonzero(paired & (flag[:num] & FIRST_MATE != 0))
+        mate2 = np.flatnonzero(paired & (flag[:num] & FIRST_MATE == 0) &
+                               (flag[:num] & SECOND_MATE != 0))
+        groups1, at1 = np.unique(group[mate1], return_index=True)
+        groups2, at2 = np.unique(group[mate2], return_index=True)
+        pairs = np.union1d(groups1, groups2)
+        first = np.full(len(pairs), -1, dtype=np.int64)
+        second = np.full(len(pairs), -1, dtype=np.int64)
+        first[np.searchsorted(pairs, groups1)] = mate1[at1]
+        second[np.searchsorted(pairs, groups2)] = mate2[at2]
+        first = np.concatenate([unpaired, first])
+        second = np.concatenate([np.full(len(unpaired), -1, dtype=np.int64),
+                                 second])
+
+        aligned = flag & UNMAPPED == 0
+        not_aligned = ~(aligned[first] | aligned[second])
+        not_unique = ~not_aligned & ((nh[first] > 1) | (nh[second] > 1))
+        low = ~not_aligned & ~not_unique & \
+            ((mapq[first] < self.minaqual) | (mapq[second] < self.minaqual))
+        counted = ~(not_aligned | not_unique | low)
+        self.special['__not_aligned'] += int(not_aligned.sum())
+        self.special['__alignment_not_unique'] += int(not_unique.sum())
+        self.special['__too_low_aQual'] += int(low.sum())
+
+        # the aligned mates of the reads counted, the second on the other
+        # strand of the fragment
+        reads = np.flatnonzero(counted)
+        flip = self.stranded == 'reverse'
+        use1 = reads[aligned[first[reads]]]
+        use2 = reads[aligned[second[reads]]]
+        records = np.concatenate([first[use1], second[use2]])
+        read_of = np.concatenate([use1, use2])
+        flips = np.concatenate([np.full(len(use1), flip),
+                                np.full(len(use2), not flip)])
+
+        # their blocks
+        cig_first, cig_num, offsets, lengths = self.cigars.arrays()
+        per = cig_num[cigar[records]]
+        total = per.sum()
+        rec_of = np.repeat(np.arange(len(records)), per)
+        block = np.repeat(cig_first[cigar[records]] - np.cumsum(per) + per,
+                          per) + np.arange(total)
+        starts = pos[records][rec_of] + offsets[block]
+        ends = starts + lengths[block]
+        contigs = contig[records][rec_of]
+        reverse = (flag[records][rec_of] & REVERSE != 0) ^ flips[rec_of]
+        block_read = read_of[rec_of]
+
+        # a block off the features' sequences makes the read __no_feature
+        unknown = np.zeros(len(first), dtype=bool)
+        unknown[block_read[contigs < 0]] = True
+        known = contigs >= 0
+        several, low_id, high_id = self.features.resolve(
+            contigs[known], reverse[known].astype(np.int64), starts[known],
+            ends[known])
+
+        none = len(self.features.names)
+        multi = np.zeros(len(first), dtype=bool)
+        multi[block_read[known][several]] = True
+        lows = np.full(len(first), none, dtype=np.int64)
+        highs = np.full(len(first), -1, dtype=np.int64)
+        np.minimum.at(lows, block_read[known], low_id)
+        np.maximum.at(highs, block_read[known], high_id)
+
+        no_feature = counted & (unknown | (~multi & (lows == none)))
+        ambiguous = counted & ~unknown & (multi | ((lows != none) &
+                                                   (lows != highs)))
+        hits = counted & ~no_feature & ~ambiguous
+        self.special['__no_feature'] += int(no_feature.sum())
+        self.special['__ambiguous'] += int(ambiguous.sum())
+        self.totals += np.bincount(lows[hits], minlength=none)
+
+    def write(self, out_fh):
+        """Write the counts as htseq-count does"""
+        write_counts(out_fh, self.counts, self.special)
+
+    def save(self, out_file):
+        """Write the counts to out_file, atomically"""
+        tmp_file = '{}.{}.tmp'.format(out_file, os.getpid())
+        with open(tmp_file, 'w') as out_fh:
+            self.write(out_fh)
+        os.replace(tmp_file, out_file)
+
+# --------------------------------------------------
+class CountingWriter:
+    """A file-like sink for SAM lines that feeds them to a FeatureCounter
+
+    and writes them on to out_fh, if there is one. Closing it counts the
+    last read and closes out_fh.
+    """
+
+    def __init__(self, counter, out_fh=None):
+        self.counter = counter
+        self.out_fh = out_fh
+
+    def write(self, line):
+        """Take one line"""
+        self.writelines([line])
+
+    def writelines(self, lines):
+        """Take lines"""
+        for line in lines:
+            self.counter.feed(line)
+            if self.out_fh is not None:
+                self.out_fh.write(line)
+
+    def close(self):
+        """Done: count the last read, close out_fh"""
+        self.counter.finish()
+        if self.out_fh is not None:
+            self.out_fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# --------------------------------------------------
+def read_counts(count_file):
+    """{feature: count} and {special: count} of a file write_counts wrote"""
+    counts, special = {}, dict.fromkeys(SPECIAL, 0)
+    with open(count_file) as in_fh:
+        for line in in_fh:
+            feature, count = line.rstrip('\n').split('\t')
+            if feature in special:
+                special[feature] = int(count)
+            else:
+                counts[feature] = int(count)
+
+    return counts, special
+
+# --------------------------------------------------
+# the Features the workers of count_samples count on, set before they are
+# forked so they share its arrays instead of each loading the GFF
+_FEATURES = None
+
+def count_sample(task):
+    """Count the alignment files of a sample with _FEATURES, save the counts
+    to its count file and return them"""
+    count_file, files, stranded, minaqual, threads = task
+    counter = FeatureCounter(_FEATURES, stranded, minaqual)
+    for sam in files:
+        with open_alignments(sam, sam.endswith('.bam'), threads) as in_fh:
+            for line in in_fh:
+                counter.feed(line)
+    counter.finish()
+    counter.save(count_file)
+
+    return counter.counts, counter.special
+
+# --------------------------------------------------
+def count_samples(features, samples, stranded='yes', minaqual=10, procs=1,
+                  threads=1):
+    """Count each sample of {count_file: [SAM or BAM files]} into its count
+    file, procs samples at a time; return {count_file: (counts, special)}
+
+    The features are loaded once, by the caller, and the workers are forked
+    from this process so they all read the same index (copy on write: its
+    arrays are never written, so never copied). A sample whose count file
+    is already there is read from it instead of counted again.
+    """
+    global _FEATURES
+    _FEATURES = features
+
+    results, tasks = {}, []
+    for count_file, files in samples.items():
+        if os.path.isfile(count_file):
+            results[count_file] = read_counts(count_file)
+        else:
+            tasks.append((count_file, files, stranded, minaqual, threads))
+
+    if tasks:
+        context = multiprocessing.get_context('fork')
+        with context.Pool(min(procs, len(tasks))) as pool:
+            for task, result in zip(tasks, pool.imap(count_sample, tasks)):
+                print('Counted {}'.format(task[0]), file=sys.stderr)
+                results[task[0]] = result
+
+    return results
+
+# --------------------------------------------------
+def write_matrix(out_file, columns):
+    """Write a feature x sample matrix of counts, atomically
+
+    columns are (sample, {feature: count}); the rows are the features of
+    any of them, sorted as htseq-count sorts them.
+    """
+    features = sorted(set().union(*(counts for _, counts in columns)))
+    tmp_file = '{}.{}.tmp'.format(out_file, os.getpid())
+    with open(tmp_file, 'w') as out_fh:
+        out_fh.write('\t'.join(['feature'] + [name for name, _ in columns]) +
+                     '\n')
+        for feature in features:
+            out_fh.write('\t'.join([feature] + [str(counts.get(feature, 0))
+                                                for _, counts in columns]) +
+                         '\n')
+    os.replace(tmp_file, out_file)
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,18 @@ import gzip
 import sys
 import argparse
 import os
-from Bio import SeqIO
+import re
+from collections import namedtuple
+
+# bytes read from the input per refill of the record scanner
+BLOCK_SIZE = 1 << 22
+
+# one line of a split index: read bytes [start, end) of path to get the chunk
+Chunk = namedtuple('Chunk', ['name', 'path', 'start', 'end', 'records',
+                             'bases'])
+
+# read name minus the ">"/"@", any description and any /1 or /2 mate suffix
+READ_NAME = re.compile(rb'[>@](\S*?)(?:/[12])?(?:\s|$)')
 
 # --------------------------------------------------
 def get_args():
@@ -19,15 +30,47 @@ def get_args():
     parser.add_argument("-i", "--infile", help="Input file",
                         type=str, metavar="FILE", required=True)
 
+    parser.add_argument("-2", "--mate",
+                        help="Reverse reads to split in lockstep with the "
+                        "--infile forward reads, checking the read names",
+                        type=str, metavar="FILE", default="")
+
     parser.add_argument("-f", "--format", help="Format (fasta, fastq)",
                         type=str, metavar="FILE", default="fasta")
 
     parser.add_argument("-n", "--num", help="Number of records per file",
                         type=int, metavar="NUM", default=50)
 
+    parser.add_argument("-b", "--bases",
+                        help="Also end a file once it holds this many bases "
+                        "(both mates count), 0 to only use --num",
+                        type=int, metavar="NUM", default=0)
+
     parser.add_argument("-o", "--out_dir", help="Output directory",
                         type=str, metavar="DIR", default="split-files")
 
+    parser.add_argument("-e", "--engine",
+                        help="Splitter to use: bytes copies whole records "
+                        "straight from the input, seqio re-writes them "
+                        "with Biopython",
+                        type=str, metavar="STR", default="bytes",
+                        choices=["bytes", "seqio"])
+
+    parser.add_argument("-x", "--index",
+                        help="Also write a tab-separated index of the chunks "
+                        "(name, path, start, end, records, bases) to this "
+                        "file",
+                        type=str, metavar="FILE", default="")
+
+    parser.add_argument("-v", "--virtual",
+                        help="Do not write chunk files, only the --index "
+                        "of record-aligned byte ranges in the input",
+                        action="store_true")
+
+    parser.add_argument("-X", "--mate_index",
+                        help="Index of the --mate chunks",
+                        type=str, metavar="FILE", default="")
+
     return parser.parse_args()
 
 # --------------------------------------------------
@@ -42,8 +85,9 @@ def main():
         print('--infile "{}" is not valid'.format(infile))
         sys.exit(1)
 
-    if not os.path.isdir(out_dir):
-        os.mkdir(out_dir)
+    if args.mate and not os.path.isfile(args.mate):
+        print('--mate "{}" is not valid'.format(args.mate))
+        sys.exit(1)
 
     if max_per < 1:
         print("--num cannot be less than one")
@@ -53,25 +97,378 @@ def main():
         print("--format ({}) must be fasta/q".format(file_format))
         sys.exit(1)
 
-    i = 0
-    nseq = 0
-    nfile = 0
-    out_fh = None
-    basename, ext = os.path.splitext(os.path.basename(infile))
+    if (args.mate or args.bases) and args.engine != "bytes":
+        print("--mate and --bases only work with --engine bytes")
+        sys.exit(1)
+
+    if args.virtual:
+        if not args.index or (args.mate and not args.mate_index):
+            print("--virtual needs an --index (and --mate_index) to write")
+            sys.exit(1)
+        if any(f.endswith(".gz") for f in [infile, args.mate]) or \
+                args.engine != "bytes":
+            print("--virtual only works on uncompressed input with "
+                  "--engine bytes")
+            sys.exit(1)
+    elif not os.path.isdir(out_dir):
+        os.mkdir(out_dir)
+
+    chunk_name = chunk_namer(infile, out_dir)
+
+    if args.mate:
+        pairs = split_pair_bytes(infile, args.mate, file_format, max_per,
+                                 chunk_name, chunk_namer(args.mate, out_dir),
+                                 write=not args.virtual, max_bases=args.bases)
+    elif args.engine == 'seqio':
+        pairs = ((chunk, None) for chunk in
+                 split_seqio(infile, file_format, max_per, chunk_name))
+    else:
+        pairs = ((chunk, None) for chunk in
+                 split_bytes(infile, file_format, max_per, chunk_name,
+                             write=not args.virtual, max_bases=args.bases))
+
+    index, mate_index = [], []
+    try:
+        for chunk, mate_chunk in pairs:
+            index.append(chunk)
+            if mate_chunk:
+                mate_index.append(mate_chunk)
+            for fx_chunk in filter(None, [chunk, mate_chunk]):
+                if args.virtual:
+                    print("Indexed {:d} records ({:d} bases) as {:s} "
+                          "(bytes {:d}-{:d})".format(
+                              fx_chunk.records, fx_chunk.bases, fx_chunk.name,
+                              fx_chunk.start, fx_chunk.end))
+                else:
+                    print("Wrote {:d} records ({:d} bases) to {:s}".format(
+                        fx_chunk.records, fx_chunk.bases, fx_chunk.path))
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+
+    if args.index:
+        write_index(index, args.index)
+
+    if args.mate_index:
+        write_index(mate_index, args.mate_index)
+
+# --------------------------------------------------
+def chunk_namer(infile, out_dir):
+    """Function giving the path of chunk number num of infile"""
+    basename, ext = split_name(infile)
 
-    handle = None
+    return lambda num: os.path.join(out_dir, basename + '.' + str(num) + ext)
+
+# --------------------------------------------------
+def split_name(infile):
+    """Basename and extension of the chunks, minus any .gz"""
+    basename, ext = os.path.splitext(os.path.basename(infile))
     if ext == ".gz":
-        handle = gzip.open(infile, "rt")
         basename, ext = os.path.splitext(basename)
-    else:
-        handle = open(infile, "rt")
-
-    record_iter = SeqIO.parse(handle, file_format)
-    for i, batch in enumerate(batch_iterator(record_iter, max_per)):
-        filename = os.path.join(out_dir, basename + '.' + str(i+1) + ext)
-        with open(filename, "w") as handle:
-            count = SeqIO.write(batch, handle, file_format)
-        print("Wrote {:d} records to {:s}".format(count, filename))
+
+    return basename, ext
+
+# --------------------------------------------------
+def open_input(infile, mode="rb"):
+    """Open a plain or gzipped input file"""
+    if infile.endswith(".gz"):
+        return gzip.open(infile, mode)
+
+    return open(infile, mode)
+
+# --------------------------------------------------
+def estimate_bases(infile, file_format, sample=BLOCK_SIZE):
+    """Guess the bases in a file from those in its first sample bytes"""
+    with open_input(infile) as handle:
+        reader = RecordReader(handle, file_format, block_size=sample)
+        data, count = reader.read(sys.maxsize)
+        bases = reader.bases(data)
+        if reader.eof or not count:
+            return bases
+
+        # bytes of the file on disk that held those records
+        used = reader.offset
+        if hasattr(handle, "fileobj"):
+            used *= handle.fileobj.tell() / handle.tell()
+
+    return int(bases * os.path.getsize(infile) / used)
+
+# --------------------------------------------------
+def write_index(chunks, index_file):
+    """Write the chunks to a tab-separated index, atomically"""
+    tmp_file = index_file + '.tmp'
+    with open(tmp_file, 'w') as out_fh:
+        for chunk in chunks:
+            out_fh.write('\t'.join(map(str, chunk)) + '\n')
+
+    os.replace(tmp_file, index_file)
+
+# --------------------------------------------------
+def read_index(index_file):
+    """Read the chunks from an index written by write_index"""
+    chunks = []
+    with open(index_file) as in_fh:
+        for line in in_fh:
+            name, path, start, end, records, bases = \
+                line.rstrip('\n').split('\t')
+            chunks.append(Chunk(name, path, int(start), int(end),
+                                int(records), int(bases)))
+
+    return chunks
+
+# --------------------------------------------------
+def split_bytes(infile, file_format, max_per, chunk_name, write=True,
+                max_bases=0):
+    """Copy every max_per records into a new file, yield a Chunk for each
+
+    Without write the input is only scanned and each Chunk points at its
+    byte range in the input itself. With max_bases a chunk also ends at
+    the first record that takes it to max_bases bases.
+    """
+    for chunk, in split_readers([infile], [chunk_name], file_format,
+                                max_per, max_bases, write):
+        yield chunk
+
+# --------------------------------------------------
+def split_pair_bytes(infile, mate, file_format, max_per, chunk_name,
+                     mate_name, write=True, max_bases=0):
+    """Split forward and reverse reads in lockstep, yield Chunk pairs
+
+    Each reverse chunk gets exactly the records that pair with its forward
+    chunk, and the read names are checked as they go by. max_bases counts
+    the bases of both mates.
+    """
+    return split_readers([infile, mate], [chunk_name, mate_name],
+                         file_format, max_per, max_bases, write)
+
+# --------------------------------------------------
+def split_readers(infiles, chunk_names, file_format, max_per, max_bases,
+                  write):
+    """Split one file, or a pair in lockstep, yield a tuple of Chunks"""
+    handles = [open_input(infile) for infile in infiles]
+    readers = [RecordReader(handle, file_format) for handle in handles]
+    lead = readers[0]
+    seen_bases = 0
+    num = 0
+    try:
+        while True:
+            need = max_per
+            starts = [reader.offset for reader in readers]
+            bases = [0 for _ in readers]
+            out_fhs = None
+            while need and not (max_bases and sum(bases) >= max_bases):
+                ask = need
+                if max_bases:
+                    # guess how many more records make up the bases wanted
+                    per_record = seen_bases / lead.records if lead.records \
+                        else 0
+                    left = max_bases - sum(bases)
+                    ask = min(need, max(1, int(left / per_record))
+                              if per_record else 1000)
+
+                data, count = lead.read(ask)
+                if not count:
+                    break
+
+                blocks = [data]
+                for mate, infile in zip(readers[1:], infiles[1:]):
+                    blocks.append(mate.read_exactly(count, infile))
+                    check_mates(lead.names(data), mate.names(blocks[-1]),
+                                lead.records - count)
+
+                if write and out_fhs is None:
+                    out_fhs = [open(name(num + 1), "wb")
+                               for name in chunk_names]
+                for i, block in enumerate(blocks):
+                    block_bases = readers[i].bases(block)
+                    bases[i] += block_bases
+                    seen_bases += block_bases
+                    if write:
+                        out_fhs[i].write(block)
+                need -= count
+
+            if need == max_per:
+                for mate, infile in zip(readers[1:], infiles[1:]):
+                    if mate.read(1)[1]:
+                        raise ValueError('"{}" has more reads than "{}"'.format(
+                            infile, infiles[0]))
+                break
+
+            num += 1
+            chunks = []
+            for i, reader in enumerate(readers):
+                path = chunk_names[i](num)
+                if write:
+                    out_fhs[i].close()
+                    chunks.append(Chunk(os.path.basename(path), path, 0,
+                                        reader.offset - starts[i],
+                                        max_per - need, bases[i]))
+                else:
+                    chunks.append(Chunk(os.path.basename(path), infiles[i],
+                                        starts[i], reader.offset,
+                                        max_per - need, bases[i]))
+
+            yield tuple(chunks)
+    finally:
+        for handle in handles:
+            handle.close()
+
+# --------------------------------------------------
+def check_mates(fwd_names, rev_names, first):
+    """Die on the first pair of reads whose names do not agree"""
+    if fwd_names == rev_names:
+        return
+
+    for i, (fwd_name, rev_name) in enumerate(zip(fwd_names, rev_names)):
+        if fwd_name != rev_name:
+            raise ValueError('Mates out of sync at read {}: "{}" vs "{}"'.format(
+                first + i + 1, fwd_name.decode(), rev_name.decode()))
+
+# --------------------------------------------------
+def split_seqio(infile, file_format, max_per, chunk_name):
+    """Parse and re-write every record with Biopython"""
+    from Bio import SeqIO
+
+    with open_input(infile, "rt") as handle:
+        record_iter = SeqIO.parse(handle, file_format)
+        for i, batch in enumerate(batch_iterator(record_iter, max_per)):
+            filename = chunk_name(i + 1)
+            with open(filename, "w") as out_fh:
+                count = SeqIO.write(batch, out_fh, file_format)
+            yield Chunk(os.path.basename(filename), filename, 0,
+                        os.path.getsize(filename), count,
+                        sum(len(rec) for rec in batch))
+
+# --------------------------------------------------
+class RecordReader:
+    """Read whole FASTA/Q records from a binary handle without parsing them.
+
+    The buffer is only ever searched for record separators, a newline
+    before a ">" for FASTA or every fourth newline for FASTQ (so FASTQ
+    must be the usual four lines per record), and the records are handed
+    back as the original bytes.
+    """
+
+    def __init__(self, handle, file_format, block_size=BLOCK_SIZE):
+        self.handle = handle
+        self.path = getattr(handle, "name", "")
+        self.block_size = block_size
+        self.buf = b""
+        self.pos = 0
+        self.offset = 0
+        self.records = 0
+        self.eof = False
+        if file_format == "fastq":
+            self.sep, self.lines = b"\n", 4
+        else:
+            self.sep, self.lines = b"\n>", 1
+
+    def fill(self):
+        """Append another block from the handle to the buffer"""
+        block = self.handle.read(self.block_size)
+        if block:
+            self.buf = self.buf[self.pos:] + block
+            self.pos = 0
+        else:
+            self.eof = True
+
+    def read(self, max_records):
+        """Return (bytes, count) for up to max_records whole records.
+
+        Only what is already buffered is returned, so a call hands back at
+        most about one block. Returns (b"", 0) at the end of the input.
+        """
+        while True:
+            found, end = find_nth(self.buf, self.sep,
+                                  max_records * self.lines, self.pos)
+            count = found // self.lines
+            if found % self.lines:
+                found, end = find_nth(self.buf, self.sep,
+                                      count * self.lines, self.pos)
+            if count:
+                break
+            if self.eof:
+                # the last record has no separator after it
+                end = len(self.buf)
+                count = 1 if self.buf[self.pos:end].strip() else 0
+                break
+            self.fill()
+
+        data = self.buf[self.pos:end] if count else b""
+        self.offset += end - self.pos
+        self.records += count
+        self.pos = end
+
+        return data, count
+
+    def read_exactly(self, num, label=""):
+        """Return the bytes of exactly num records, or die trying"""
+        parts = []
+        while num:
+            data, count = self.read(num)
+            if not count:
+                raise ValueError('"{}" ran out of reads at {}'.format(
+                    label or self.path, self.records))
+            parts.append(data)
+            num -= count
+
+        return b"".join(parts)
+
+    def bases(self, data):
+        """The number of bases in some bytes returned by read"""
+        if self.lines == 4:
+            return sum(map(len, data.split(b"\n")[1::4]))
+
+        headers = re.findall(rb"^>.*", data, re.M)
+
+        return len(data) - sum(map(len, headers)) - data.count(b"\n")
+
+    def names(self, data):
+        """The read names in some bytes returned by read"""
+        if self.lines == 4:
+            headers = data.split(b"\n")[0::4]
+            if not headers[-1]:
+                headers.pop()
+        else:
+            headers = re.findall(rb"^>.*", data, re.M)
+
+        names = []
+        for header in headers:
+            match = READ_NAME.match(header)
+            names.append(match.group(1) if match else header)
+
+        return names
+
+# --------------------------------------------------
+def find_nth(buf, sep, num, start=0):
+    """Find up to num seps in buf from start, return (found, offset)
+
+    The offset is just past the newline that starts the last sep found,
+    or start if there were none.
+    """
+    window = 1 << 16
+    found = 0
+    pos = start
+    size = len(buf)
+    while found < num and pos < size:
+        stop = min(pos + window, size)
+        # count the seps that begin inside [pos, stop)
+        here = buf.count(sep, pos, stop + len(sep) - 1)
+        if found + here < num:
+            found += here
+            pos = stop
+            continue
+
+        for _ in range(num - found):
+            idx = buf.find(sep, pos)
+            pos = idx + len(sep)
+
+        return num, idx + 1
+
+    if not found:
+        return 0, start
+
+    return found, buf.rfind(sep, start) + 1
 
 # from biopython.org/wiki/Split_large_file
 # --------------------------------------------------
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""A genome store shared by all runs, with a size cap and LRU eviction"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+from locking import FileLock
+
+# bytes hashed per read
+BLOCK_SIZE = 1 << 20
+
+# off unless asked for: the store should be on the file system the genomes
+# are downloaded to (e.g. under $WORK), or every genome is copied into it
+DEFAULT_STORE = os.getenv('RADCOT_GENOME_STORE', '')
+
+# gigabytes the store may grow to before the least recently used genomes
+# are evicted, 0 for no cap
+DEFAULT_MAX_GB = 50
+
+# --------------------------------------------------
+def get_args():
+    """get args"""
+    parser = argparse.ArgumentParser(
+        description='Show, check or trim the shared genome store',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-s', '--store',
+                        help='Store directory (default $RADCOT_GENOME_STORE)',
+                        metavar='DIR',
+                        type=str,
+                        default=DEFAULT_STORE)
+
+    parser.add_argument('-l', '--list',
+                        help='List the genomes, least recently used first',
+                        action='store_true')
+
+    parser.add_argument('-v', '--verify',
+                        help='Checksum every file, dropping genomes with '
+                        'a damaged one',
+                        action='store_true')
+
+    parser.add_argument('-m', '--max_gb',
+                        help='Evict genomes until the store is this small',
+                        metavar='float',
+                        type=float,
+                        default=None)
+
+    return parser.parse_args()
+
+# --------------------------------------------------
+def main():
+    """main"""
+    args = get_args()
+
+    if not args.store:
+        print('No store, give -s or set $RADCOT_GENOME_STORE',
+              file=sys.stderr)
+        sys.exit(1)
+    if not os.path.isdir(args.store):
+        print('"{}" is not a directory'.format(args.store), file=sys.stderr)
+        sys.exit(1)
+
+    store = GenomeStore(args.store)
+    if args.verify:
+        for key in store.verify():
+            print('Dropped damaged genome {}'.format(key), file=sys.stderr)
+
+    if args.max_gb is not None:
+        for key in store.evict(int(args.max_gb * 1e9)):
+            print('Evicted {}'.format(key), file=sys.stderr)
+
+    if args.list:
+        for key, entry in store.entries():
+            print('{}\t{}\t{}'.format(key, entry['bytes'],
+                                      time.ctime(entry['used'])))
+
+    num, total = store.usage()
+    print('{} genome{}, {:.2f} GB in "{}"'.format(
+        num, '' if num == 1 else 's', total / 1e9, args.store),
+          file=sys.stderr)
+
+# --------------------------------------------------
+def checksum(path):
+    """sha256 hex digest of a file"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as in_fh:
+        for block in iter(lambda: in_fh.read(BLOCK_SIZE), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+# --------------------------------------------------
+def link(src, dest, symlink=False):
+    """Hard link src to dest (a symlink across file systems or if asked)"""
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        return
+    if os.path.lexists(dest):
+        os.remove(dest)
+    if not symlink:
+        try:
+            os.link(src, dest)
+            return
+        except OSError:
+            pass
+    os.symlink(os.path.abspath(src), dest)
+
+# --------------------------------------------------
+class GenomeStore:
+    """Genome files kept once on disk and linked into run directories
+
+    A genome is stored under its PATRIC genome ID and annotation type (the
+    .fna and the annotation files downloaded with it). Files are content
+    addressed, objects/ab/abcd... named after their sha256, so the .fna a
+    genome's RefSeq and PATRIC entries share is stored once. index.json
+    records each genome's files, checksums, size and when it was last used;
+    it is updated under a lock and replaced atomically, so any number of
+    runs may share the store.
+
+    Once the files of all genomes add up to more than max_bytes the least
+    recently used genomes are evicted. Run directories hold hard links, so
+    an evicted genome stays usable in them, but its space only comes back
+    once they are deleted too.
+    """
+
+    def __init__(self, root, max_bytes=0, symlink=False):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.symlink = symlink
+        self.index_file = os.path.join(root, 'index.json')
+        self.lock = os.path.join(root, 'index.lock')
+
+    @staticmethod
+    def key(genome_id, annotation):
+        """Index key of a genome"""
+        return '{}/{}'.format(genome_id, annotation)
+
+    def object_path(self, digest):
+        """Where the file with a checksum lives"""
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    def get(self, genome_id, annotation, dest_dir):
+        """Link a stored genome's files into dest_dir
+
+        Returns their paths, None if the genome is not in the store (or a
+        file of it is missing or the wrong size, then it is dropped).
+        """
+        with FileLock(self.lock):
+            index = self.load()
+            entry = index.get(self.key(genome_id, annotation))
+            if entry is None:
+                return None
+
+            for name, meta in entry['files'].items():
+                obj = self.object_path(meta['sha256'])
+                if not os.path.isfile(obj) or \
+                   os.path.getsize(obj) != meta['bytes']:
+                    self.drop(index, self.key(genome_id, annotation))
+                    self.save(index)
+                    return None
+
+            paths = []
+            for name, meta in entry['files'].items():
+                path = os.path.join(dest_dir, name)
+                link(self.object_path(meta['sha256']), path, self.symlink)
+                paths.append(path)
+
+            entry['used'] = time.time()
+            self.save(index)
+
+        return paths
+
+    def put(self, genome_id, annotation, paths):
+        """Add a genome's files, then evict down to max_bytes
+
+        The files are checksummed and linked into the store, and left where
+        they are. Across file systems they have to be copied, which doubles
+        the space they take, and a warning says so.
+        """
+        digests = [(path, checksum(path)) for path in paths]
+
+        with FileLock(self.lock):
+            files = {}
+            for path, digest in digests:
+                obj = self.object_path(digest)
+                if not os.path.isfile(obj):
+                    os.makedirs(os.path.dirname(obj), exist_ok=True)
+                    tmp = '{}.{}.tmp'.format(obj, os.getpid())
+                    try:
+                        os.link(path, tmp)
+                    except OSError:
+                        print('Warning: copying "{}" into the genome store '
+                              '"{}", it is on another file system so it can '
+                              'not be linked'.format(path, self.root),
+                              file=sys.stderr)
+                        shutil.copyfile(path, tmp)
+                    os.replace(tmp, obj)
+                files[os.path.basename(path)] = {
+                    'sha256': digest, 'bytes': os.path.getsize(obj)}
+
+            index = self.load()
+            index[self.key(genome_id, annotation)] = {
+                'files': files,
+                'bytes': sum(meta['bytes'] for meta in files.values()),
+                'used': time.time()}
+            evicted = self.trim(index, self.max_bytes)
+            self.save(index)
+
+        return evicted
+
+    def evict(self, max_bytes):
+        """Drop least recently used genomes until the store fits max_bytes
+
+        Returns the keys of the evicted genomes.
+        """
+        with FileLock(self.lock):
+            index = self.load()
+            evicted = self.trim(index, max_bytes)
+            self.save(index)
+
+        return evicted
+
+    def verify(self):
+        """Checksum all stored files, drop the genomes with a bad one"""
+        with FileLock(self.lock):
+            index = self.load()
+            bad = []
+            for key, entry in index.items():
+                for meta in entry['files'].values():
+                    obj = self.object_path(meta['sha256'])
+                    if not os.path.isfile(obj) or \
+                       checksum(obj) != meta['sha256']:
+                        bad.append(key)
+                        break
+            for key in bad:
+                self.drop(index, key)
+            self.save(index)
+
+        return bad
+
+    def entries(self):
+        """(key, entry) of every genome, least recently used first"""
+        return sorted(self.load().items(), key=lambda item: item[1]['used'])
+
+    def usage(self):
+        """Number of genomes and bytes of the distinct files they use"""
+        index = self.load()
+        return len(index), self.size(index)
+
+    @staticmethod
+    def size(index):
+        """Bytes of the distinct files of the genomes in index"""
+        objects = {meta['sha256']: meta['bytes'] for entry in index.values()
+                   for meta in entry['files'].values()}
+
+        return sum(objects.values())
+
+    def trim(self, index, max_bytes):
+        """Drop genomes from index, oldest use first, to fit max_bytes"""
+        evicted = []
+        if not max_bytes:
+            return evicted
+
+        by_age = sorted(index, key=lambda key: index[key]['used'])
+        while by_age and self.size(index) > max_bytes:
+            key = by_age.pop(0)
+            self.drop(index, key)
+            evicted.append(key)
+
+        return evicted
+
+    def drop(self, index, key):
+        """Remove a genome from index, and the files no other genome uses"""
+        entry = index.pop(key)
+        used = set(meta['sha256'] for other in index.values()
+                   for meta in other['files'].values())
+        for meta in entry['files'].values():
+            obj = self.object_path(meta['sha256'])
+            if meta['sha256'] not in used and os.path.isfile(obj):
+                os.remove(obj)
+
+    def load(self):
+        """The index {key: {files, bytes, used}}, empty if there is none"""
+        try:
+            with open(self.index_file) as in_fh:
+                return json.load(in_fh)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, index):
+        """Atomically replace the index"""
+        os.makedirs(self.root, exist_ok=True)
+        tmp_file = '{}.{}.tmp'.format(self.index_file, os.getpid())
+        with open(tmp_file, 'w') as out_fh:
+            json.dump(index, out_fh)
+        os.replace(tmp_file, self.index_file)
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""Advisory file locks shared by concurrent runs"""
+
+import fcntl
+import os
+
+# --------------------------------------------------
+class FileLock:
+    """flock on a file for the length of a with block
+
+    The directory of the lock file is made if need be. Lock files are left
+    in place, removing them would race with the next run taking them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.handle = None
+
+    def __enter__(self):
+        lock_dir = os.path.dirname(self.path)
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+        self.handle = open(self.path, 'a')
+        fcntl.flock(self.handle, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.handle, fcntl.LOCK_UN)
+        self.handle.close()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""Resolve NCBI taxIDs to PATRIC genome IDs, with a persistent cache"""
+
+import abc
+import argparse
+import csv
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict, namedtuple
+
+from locking import FileLock
+
+# taxIDs per p3-all-genomes query, to keep its request a sane size
+QUERY_SIZE = 200
+
+# seconds to wait between attempts at a failed query
+RETRY_WAIT = 5
+
+# what PATRIC says about a genome: reference is "Reference",
+# "Representative" or "", status "Complete", "WGS" or "Plasmid", length
+# and contigs are 0 when not known
+Genome = namedtuple('Genome', ['genome_id', 'reference', 'status', 'length',
+                               'contigs'])
+Genome.__new__.__defaults__ = ('', '', 0, 0)
+
+# p3-all-genomes attributes of each Genome field
+P3_ATTRS = ['genome_id', 'reference_genome', 'genome_status', 'genome_length',
+            'contigs']
+
+DEFAULT_CACHE = os.path.join(
+    os.getenv('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'),
+                                             '.cache')),
+    'radcot', 'patric_genome_ids.json')
+
+# --------------------------------------------------
+def get_args():
+    """get args"""
+    parser = argparse.ArgumentParser(
+        description='Resolve NCBI taxIDs to PATRIC genome IDs',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('tax_ids',
+                        help='NCBI taxIDs',
+                        metavar='int',
+                        type=int,
+                        nargs='+')
+
+    parser.add_argument('-t', '--table',
+                        help='Resolve from a taxID<TAB>genome_id file '
+                        '(optionally followed by reference, status, length '
+                        'and contigs columns) instead of p3-all-genomes',
+                        metavar='FILE',
+                        type=str,
+                        default='')
+
+    parser.add_argument('-c', '--cache',
+                        help='Cache file, "" for none',
+                        metavar='FILE',
+                        type=str,
+                        default=DEFAULT_CACHE)
+
+    parser.add_argument('--ttl',
+                        help='Days a cached answer is good for',
+                        metavar='float',
+                        type=float,
+                        default=30)
+
+    return parser.parse_args()
+
+# --------------------------------------------------
+def main():
+    """main"""
+    args = get_args()
+
+    resolver = make_resolver(args.table, args.cache, args.ttl)
+    genomes = resolver.resolve(args.tax_ids)
+    for tax_id in args.tax_ids:
+        for genome in genomes.get(tax_id, []):
+            print('\t'.join(map(str, (tax_id,) + genome)))
+
+# --------------------------------------------------
+def make_resolver(table='', cache=DEFAULT_CACHE, ttl_days=30):
+    """The resolver the command line options ask for"""
+    resolver = TableResolver(table) if table else P3Resolver()
+    if cache:
+        resolver = CachedResolver(resolver, cache, ttl_days * 86400)
+
+    return resolver
+
+# --------------------------------------------------
+def make_genome(flds):
+    """A Genome from its fields as strings, missing numbers are 0"""
+    flds = list(flds) + [''] * (len(Genome._fields) - len(flds))
+    genome_id, reference, status, length, contigs = flds[:len(Genome._fields)]
+
+    return Genome(genome_id, reference, status,
+                  int(length) if length.isdigit() else 0,
+                  int(contigs) if contigs.isdigit() else 0)
+
+# --------------------------------------------------
+class GenomeResolver(abc.ABC):
+    """Maps NCBI taxIDs to the PATRIC genome IDs filed under them"""
+
+    @abc.abstractmethod
+    def resolve(self, tax_ids):
+        """Return {taxID: [Genomes]} for all the taxIDs at once
+
+        A taxID with no genomes maps to an empty list. Raises IOError if
+        the answer can not be had.
+        """
+
+# --------------------------------------------------
+class P3Resolver(GenomeResolver):
+    """Ask the PATRIC CLI, QUERY_SIZE taxIDs per p3-all-genomes call"""
+
+    def __init__(self, command='p3-all-genomes', attempts=3):
+        self.command = command
+        self.attempts = attempts
+
+    def resolve(self, tax_ids):
+        tax_ids = sorted(set(tax_ids))
+        genomes = {tax_id: [] for tax_id in tax_ids}
+        for i in range(0, len(tax_ids), QUERY_SIZE):
+            query = tax_ids[i:i + QUERY_SIZE]
+            for tax_id, genome in self.query(query):
+                if tax_id in genomes:
+                    genomes[tax_id].append(genome)
+
+        return genomes
+
+    def query(self, tax_ids):
+        """(taxID, Genome) rows of one p3-all-genomes call"""
+        cmd = [self.command, '--in',
+               'taxon_id,' + ','.join(map(str, tax_ids)), '-a', 'taxon_id']
+        for attr in P3_ATTRS[1:]:
+            cmd += ['-a', attr]
+        for attempt in range(1, self.attempts + 1):
+            try:
+                out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE,
+                                     universal_newlines=True).stdout
+                break
+            except (OSError, subprocess.CalledProcessError) as err:
+                print('Attempt {} of {} at {} taxIDs failed: {}'.format(
+                    attempt, self.attempts, len(tax_ids), err),
+                      file=sys.stderr)
+                if attempt == self.attempts:
+                    raise IOError('p3-all-genomes failed, patricbrc.org or '
+                                  'p3.theseed.org might be down')
+                time.sleep(RETRY_WAIT)
+
+        rows = csv.DictReader(out.splitlines(), delimiter='\t')
+        return [(int(row['genome.taxon_id']),
+                 make_genome([row.get('genome.' + attr) or ''
+                              for attr in P3_ATTRS]))
+                for row in rows if row.get('genome.genome_id')]
+
+# --------------------------------------------------
+class TableResolver(GenomeResolver):
+    """Look genomes up in a taxID<TAB>genome_id file, for offline tests
+
+    Reference, status, length and contigs columns may follow the genome ID.
+    """
+
+    def __init__(self, table):
+        self.genomes = defaultdict(list)
+        with open(table) as in_fh:
+            for line in in_fh:
+                flds = line.rstrip('\n').split('\t')
+                if len(flds) >= 2 and flds[0].isdigit():
+                    self.genomes[int(flds[0])].append(make_genome(flds[1:6]))
+
+    def resolve(self, tax_ids):
+        return {tax_id: list(self.genomes.get(tax_id, []))
+                for tax_id in tax_ids}
+
+# --------------------------------------------------
+class CachedResolver(GenomeResolver):
+    """Keep another resolver's answers in a JSON file for ttl seconds
+
+    Only the taxIDs missing from the cache, or cached more than ttl seconds
+    ago, go to the wrapped resolver, all in one call. The file is shared by
+    every run (and project) pointing at it: it is updated under a lock and
+    replaced atomically.
+    """
+
+    def __init__(self, resolver, cache_file, ttl):
+        self.resolver = resolver
+        self.cache_file = cache_file
+        self.ttl = ttl
+
+    def resolve(self, tax_ids):
+        now = time.time()
+        cache = self.load()
+        stale = sorted(set(tax_id for tax_id in tax_ids
+                           if not self.fresh(cache.get(str(tax_id), {}), now)))
+        if stale:
+            print('Resolving {} of {} taxIDs, the rest are cached in "{}"'.
+                  format(len(stale), len(set(tax_ids)), self.cache_file),
+                  file=sys.stderr)
+            found = self.resolver.resolve(stale)
+            with FileLock(self.cache_file + '.lock'):
+                cache = self.load()
+                for tax_id in stale:
+                    cache[str(tax_id)] = {
+                        'genomes': [list(genome)
+                                    for genome in found.get(tax_id, [])],
+                        'time': now}
+                self.save(cache)
+
+        return {tax_id: [Genome(*genome)
+                         for genome in cache[str(tax_id)]['genomes']]
+                for tax_id in tax_ids}
+
+    def fresh(self, entry, now):
+        """Whether a cache entry is recent and has all the Genome fields
+
+        Entries of older versions, holding only genome IDs, are stale.
+        """
+        return now - entry.get('time', 0) <= self.ttl and \
+            all(isinstance(genome, list) and len(genome) == len(Genome._fields)
+                for genome in entry.get('genomes', []))
+
+    def load(self):
+        """The cached {taxID: {genomes, time}}, empty if there is none"""
+        try:
+            with open(self.cache_file) as in_fh:
+                return json.load(in_fh)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, cache):
+        """Atomically replace the cache file"""
+        tmp_file = '{}.{}.tmp'.format(self.cache_file, os.getpid())
+        with open(tmp_file, 'w') as out_fh:
+            json.dump(cache, out_fh)
+        os.replace(tmp_file, self.cache_file)
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
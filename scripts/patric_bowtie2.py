@@ -40,8 +40,15 @@ import sys
 import subprocess
 import argparse
 import itertools
+import io
+import shutil
+import tempfile
 from pprint import pprint
-from Bio import SeqIO
+
+import bt2_index
+import featurecount
+import runner
+import samerge
 
 #WORK env var will be present on TACC
 #But may not be set when testing locally
@@ -114,6 +121,39 @@ gen_opts.add_argument('-n', '--bam-name',
         help="Filename to use for output bam. \n"
         "This is usually defined by the calling script \n"
         "based on the input read names")
+
+gen_opts.add_argument('--tmp-dir', dest='tmp_dir', metavar='DIRECTORY',
+        default=os.getenv('TMPDIR') or None,
+        help="Where samtools sort spills the alignments it can not keep\n"
+        "in memory, best on node-local scratch.\n"
+        "[ Default = $TMPDIR, else the system temp directory ]")
+
+gen_opts.add_argument('--sort-mem', dest='sort_mem', metavar='STRING',
+        default='768M',
+        help="Memory samtools sort may use per thread before spilling\n"
+        "to --tmp-dir (samtools sort -m), e.g. 2G. [ Default = 768M ]")
+
+count_opts = parser.add_argument_group('Counting Options',
+        "With --counts the reads are counted per feature while they\n"
+        "are aligned, as htseq-count would count the bam, and the bam\n"
+        "is only written with --keep-bam.")
+
+count_opts.add_argument('--counts', dest='counts', metavar='FILENAME',
+        default='',
+        help="Write the htseq-count style counts here.")
+
+count_opts.add_argument('--count-gff', dest='count_gff', metavar='FILENAME',
+        default='',
+        help="GFF of the features to count, as given to htseq-count.")
+
+count_opts.add_argument('--count-opts', dest='count_opts', metavar='STRING',
+        default='',
+        help="htseq-count options to count with (-t, -i, -a, -s),\n"
+        "htseq-count's defaults for those left out.\n"
+        "Give them as --count-opts='-t CDS -i ID'.")
+
+count_opts.add_argument('--keep-bam', dest='keep_bam', action='store_true',
+        help="Also write the name-sorted bam when counting.")
 ###
 bowtie2_opts = parser.add_argument_group('Bowtie2 Alignment Options')
 
@@ -198,6 +238,9 @@ if args.align_type == "local":
 if args.input_fmt not in ['fasta', 'fastq', 'fq']:
     error('ERROR: Input format must be either fasta or fastq formatted')
 
+if args.counts and not args.count_gff:
+    parser.error('--counts needs the --count-gff to count on')
+
 ###############
 # FUNCTIONS ###
 ###############
@@ -213,22 +256,6 @@ def die(msg='Something went wrong'):
     warn('Error: {}'.format(msg))
     sys.exit(1)
 
-# --------------------------------------------------
-def execute(command):
-
-    print('Executing {}'.format(command) + os.linesep)
-    process = subprocess.Popen(command,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=True)
-    (stdout, stderr) = process.communicate()
-    print(stdout.decode() + os.linesep)
-    print(stderr.decode() + os.linesep)
-
-    return process.returncode
-
-
 def bowtie(bowtie2_db):
     
     inFmt = False
@@ -254,42 +281,174 @@ def bowtie(bowtie2_db):
         error("Something is wrong in how the input string is formatted\n"
         "Did you only enter forward reads? Did you only enter reverse reads?\n")
 
-    bowtie2_cmd = 'bowtie2 {} --phred33 --{} --{} -p {} -I {} -X {} --no-unal {} -x {} {}'.format(
-        inFmt, args.align_type, preset, args.threads, args.minins, 
-        args.maxins, args.more_args, bowtie2_db, input_cmd)
-
     bam_out = os.path.join(args.out_dir, args.bam_name)
 
-    return [(bowtie2_cmd, bam_out)]
+    if len(bowtie2_db) == 1:
+        bowtie2_cmd = 'bowtie2 {} --phred33 --{} --{} -p {} -I {} -X {} --no-unal {} -x {} {}'.format(
+            inFmt, args.align_type, preset, args.threads, args.minins, 
+            args.maxins, args.more_args, bowtie2_db[0], input_cmd)
 
-def to_bam(cmd2run):
+        return [(bowtie2_cmd, bam_out)]
 
-    processCall = ''
+    #one bowtie2 per shard, sharing the threads, every read in the same
+    #order in each so their outputs can be merged read by read
+    threads = max(1, args.threads // len(bowtie2_db))
+    bowtie2_cmds = ['bowtie2 {} --phred33 --{} --{} -p {} -I {} -X {} --reorder {} -x {} {}'.format(
+        inFmt, args.align_type, preset, threads, args.minins,
+        args.maxins, args.more_args, shard, input_cmd) for shard in bowtie2_db]
 
-    for (bowtie2, bam_out) in cmd2run:
-        
-        #DEBUG#
-        warn('Running bowtie2 and converting to bam' + os.linesep)
+    return [(bowtie2_cmds, bam_out)]
 
-        convert_to_bam = '{} | samtools view --threads {} -bT {} - > {}'.format( bowtie2, args.threads, args.bt2_idx + '.fna', bam_out + '.tmp')
+def log_file(bam_out, step):
+    """Where a step of making bam_out logs its output, in out_dir/logs"""
+    log_dir = os.path.join(args.out_dir, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
 
-        return_code = execute(convert_to_bam)
+    return os.path.join(log_dir, '{}.{}'.format(os.path.basename(bam_out), step))
 
-        if return_code != 0:
-            die()
+def name_sort(bam_out):
+    """Start samtools sort -n reading SAM on stdin into bam_out.tmp
 
-        #Debug#
-        warn('Sorting bam by position' + os.linesep)
-        
-        sort_bam = 'samtools sort --threads {} -n {} > {}'.format(args.threads, bam_out + '.tmp', bam_out)
+    Returns its Runner and its directory of temporary files.
+    """
+    if args.tmp_dir:
+        os.makedirs(args.tmp_dir, exist_ok=True)
+    sort_tmp = tempfile.mkdtemp(prefix=os.path.basename(bam_out) + '.',
+                                dir=args.tmp_dir)
+    cmd = 'samtools sort -n --threads {} -m {} -T {} -O bam -o {} -'.format(
+        args.threads, args.sort_mem, os.path.join(sort_tmp, 'part'),
+        bam_out + '.tmp')
+
+    sort = runner.Runner(cmd, log_file=log_file(bam_out, 'sort.log'),
+                         stdin=subprocess.PIPE)
 
-        return_code = execute(sort_bam)
+    return sort, sort_tmp
 
-        if return_code != 0:
-            die()
+def finish_bam(bam_out, return_codes, sort_tmp):
+    """Move the sorted bam into place if every step of the pipe worked"""
 
-        if os.path.isfile(bam_out):
+    shutil.rmtree(sort_tmp, ignore_errors=True)
+    if any(return_codes):
+        if os.path.isfile(bam_out + '.tmp'):
             os.remove(bam_out + '.tmp')
+        die('Aligning and sorting into {} failed'.format(bam_out))
+
+    os.replace(bam_out + '.tmp', bam_out)
+
+def align(bowtie2_cmd, sort, bam_out):
+    """Run bowtie2 into the sort, return the return codes and bowtie2's
+    summary"""
+
+    bowtie2 = runner.Runner(bowtie2_cmd,
+                            log_file=log_file(bam_out, 'bowtie2.log'),
+                            parsers=[runner.bowtie2_metrics],
+                            stdout=sort.proc.stdin)
+    sort.proc.stdin.close()
+    bowtie2_run, sort_run = bowtie2.wait(), sort.wait()
+
+    return [bowtie2_run.returncode, sort_run.returncode], bowtie2_run.metrics
+
+def align_stream(bowtie2_cmd, sam_out, bam_out):
+    """Run bowtie2 with its SAM passed through sam_out, return the return
+    codes and bowtie2's summary"""
+
+    bowtie2 = runner.Runner(bowtie2_cmd,
+                            log_file=log_file(bam_out, 'bowtie2.log'),
+                            parsers=[runner.bowtie2_metrics],
+                            stdout=subprocess.PIPE)
+    try:
+        with sam_out:
+            sam_out.writelines(io.TextIOWrapper(bowtie2.proc.stdout))
+    except BrokenPipeError as err:
+        warn(str(err))
+        bowtie2.proc.kill()
+
+    bowtie2_run = bowtie2.wait()
+
+    return [bowtie2_run.returncode], bowtie2_run.metrics
+
+def align_shards(bowtie2_cmds, sam_out, bam_out):
+    """Run bowtie2 on every shard at once, merge the best hits into sam_out,
+    return the return codes and the shards' summaries and the merge's"""
+
+    shards = [runner.Runner(cmd,
+                            log_file=log_file(bam_out,
+                                              'shard{}.bowtie2.log'.format(i)),
+                            parsers=[runner.bowtie2_metrics],
+                            stdout=subprocess.PIPE)
+              for i, cmd in enumerate(bowtie2_cmds)]
+
+    streams = [io.TextIOWrapper(shard.proc.stdout) for shard in shards]
+    reads, aligned, tied = 0, 0, 0
+    try:
+        with sam_out:
+            reads, aligned, tied = samerge.merge(streams, sam_out,
+                                                 no_unal=True)
+    except (ValueError, BrokenPipeError) as err:
+        warn(str(err))
+        for shard in shards:
+            shard.proc.kill()
+
+    runs = [shard.wait() for shard in shards]
+    metrics = {'reads': reads, 'aligned': aligned, 'tied': tied}
+    for i, shard_run in enumerate(runs):
+        for name, value in shard_run.metrics.items():
+            metrics['shard{}.{}'.format(i, name)] = value
+
+    print('{} reads, {} aligned, {} equally well to more than one shard'.format(
+        reads, aligned, tied) + os.linesep)
+
+    return [run.returncode for run in runs], metrics
+
+def to_bam(cmd2run, features=None):
+    """Align straight into a sort by read name, or a feature count, or both
+
+    The SAM is never written out, unsorted, to be read back: samtools sort
+    takes it from a pipe, keeping --sort-mem per thread before spilling to
+    --tmp-dir. The bam is written as .tmp and renamed once complete.
+
+    Given features (--counts) the reads are counted on them as the SAM
+    streams past, as htseq-count would count the bam, and no bam is made
+    unless --keep-bam.
+    """
+
+    for (bowtie2, bam_out) in cmd2run:
+        
+        sort, sort_tmp, sam_out = None, None, None
+        if features is None or args.keep_bam:
+            #DEBUG#
+            warn('Running bowtie2 and sorting by read name' + os.linesep)
+            sort, sort_tmp = name_sort(bam_out)
+
+        if features is None and not isinstance(bowtie2, list):
+            #nothing to do in between, bowtie2 writes to the sort itself
+            return_codes, metrics = align(bowtie2, sort, bam_out)
+        else:
+            if sort is not None:
+                sam_out = io.TextIOWrapper(sort.proc.stdin)
+            if features is not None:
+                warn('Counting reads per feature into {}'.format(args.counts)
+                     + os.linesep)
+                counter = featurecount.FeatureCounter(
+                    features, args.count_opts['stranded'],
+                    args.count_opts['minaqual'])
+                sam_out = featurecount.CountingWriter(counter, sam_out)
+
+            if isinstance(bowtie2, list):
+                return_codes, metrics = align_shards(bowtie2, sam_out, bam_out)
+            else:
+                return_codes, metrics = align_stream(bowtie2, sam_out, bam_out)
+            if sort is not None:
+                return_codes.append(sort.wait().returncode)
+
+        runner.write_metrics(metrics, log_file(bam_out, 'bowtie2.tsv'))
+        if sort is not None:
+            finish_bam(bam_out, return_codes, sort_tmp)
+        elif any(return_codes):
+            die('Aligning {} failed'.format(bam_out))
+
+        if features is not None:
+            counter.save(args.counts)
 
 ##################
 # THE MAIN LOOP ##
@@ -309,14 +468,26 @@ if __name__ == '__main__':
 #    pprint(os.listdir(args.genome_dir))
     #END DEBUG#
     
-    if os.path.isfile(args.bt2_idx + '.1.bt2') or os.path.isfile(args.bt2_idx + '.1.bt2l'):
-        print('Bowtie2 index found: {}'.format(args.bt2_idx) + os.linesep)
-        bt2_db_base = args.bt2_idx
+    bt2_db_base = bt2_index.ShardedIndex.existing(args.bt2_idx).prefixes()
+    if bt2_db_base:
+        print('Bowtie2 index found: {} ({} shard(s))'.format(
+            args.bt2_idx, len(bt2_db_base)) + os.linesep)
     else:
-        error('No bowtie2 index, cannot continue!')
+        die('No bowtie2 index, cannot continue!')
+
+    features = None
+    if args.counts:
+        try:
+            args.count_opts = featurecount.htseq_options(args.count_opts)
+            features = featurecount.Features.from_gff(
+                args.count_gff, args.count_opts['feature_type'],
+                args.count_opts['id_attr'],
+                stranded=args.count_opts['stranded'] != 'no')
+        except (ValueError, OSError) as e:
+            die('Can not count features of {}: {}'.format(args.count_gff, e))
 
     cmd_and_bam = bowtie(bt2_db_base)
 
-    to_bam(cmd_and_bam)
+    to_bam(cmd_and_bam, features)
 
     print('Program Complete, Hopefully it Worked!')
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""Pick the genomes of a taxon that go into the alignment reference"""
+
+import argparse
+import math
+import sys
+
+import numpy as np
+
+from abundance import splitmix64
+
+POLICIES = ['all', 'reference', 'complete', 'dereplicate']
+
+# k-mer length and number of hashes kept per MinHash sketch
+SKETCH_K = 21
+SKETCH_SIZE = 1000
+
+# genomes closer than this Mash distance (about 1 - ANI) are redundant
+MAX_DIST = 0.01
+
+# 2-bit codes of the bases, 4 for anything else (N, IUPAC codes, newlines)
+CODES = np.full(256, 4, dtype=np.uint8)
+for code, bases in enumerate([b'Aa', b'Cc', b'Gg', b'Tt']):
+    for base in bases:
+        CODES[base] = code
+
+# --------------------------------------------------
+def get_args():
+    """get args"""
+    parser = argparse.ArgumentParser(
+        description='Dereplicate genomes by MinHash (Mash) distance',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('fastas',
+                        help='Genome FASTA files, best first',
+                        metavar='FILE',
+                        nargs='+')
+
+    parser.add_argument('-d', '--max_dist',
+                        help='Mash distance below which a genome is '
+                        'redundant',
+                        metavar='float',
+                        type=float,
+                        default=MAX_DIST)
+
+    return parser.parse_args()
+
+# --------------------------------------------------
+def main():
+    """main"""
+    args = get_args()
+
+    keep = dereplicate([(fasta, fasta) for fasta in args.fastas],
+                       args.max_dist)
+    for fasta in keep:
+        print(fasta)
+    print('Kept {} of {} genomes'.format(len(keep), len(args.fastas)),
+          file=sys.stderr)
+
+# --------------------------------------------------
+def rank(genomes):
+    """Genomes best first
+
+    Reference before representative before other genomes, then complete
+    before draft, then fewest contigs and longest.
+    """
+    def key(genome):
+        return ({'Reference': 0, 'Representative': 1}.get(genome.reference, 2),
+                genome.status != 'Complete',
+                genome.contigs or float('inf'),
+                -genome.length,
+                genome.genome_id)
+
+    return sorted(genomes, key=key)
+
+# --------------------------------------------------
+def select(genomes, policy='all', top_n=5, max_candidates=100):
+    """The patric.Genomes of one taxon to get, best first
+
+    reference keeps the reference and representative genomes, or the best
+    genome if there are none, so the taxon is never dropped. complete keeps
+    the top_n complete genomes, topped up with the best drafts if there are
+    fewer. dereplicate returns the best max_candidates (0 for all) to be
+    dereplicated once their sequences are in.
+    """
+    if policy == 'all':
+        return list(genomes)
+
+    ranked = rank(genomes)
+    if policy == 'reference':
+        refs = [genome for genome in ranked if genome.reference]
+        return refs or ranked[:1]
+
+    if policy == 'complete':
+        return ranked[:top_n] if top_n else ranked
+
+    if policy == 'dereplicate':
+        return ranked[:max_candidates] if max_candidates else ranked
+
+    raise ValueError('Unknown genome selection policy "{}"'.format(policy))
+
+# --------------------------------------------------
+def read_fasta(fasta):
+    """The sequences of a FASTA file as one bytes, contigs joined by N"""
+    seqs, seq = [], []
+    with open(fasta, 'rb') as in_fh:
+        for line in in_fh:
+            if line.startswith(b'>'):
+                if seq:
+                    seqs.append(b''.join(seq))
+                seq = []
+            else:
+                seq.append(line.rstrip())
+    if seq:
+        seqs.append(b''.join(seq))
+
+    return b'N'.join(seqs)
+
+# --------------------------------------------------
+def sketch(seq, k=SKETCH_K, size=SKETCH_SIZE):
+    """Bottom-size MinHash sketch of the canonical k-mers of seq
+
+    k-mers with a base other than ACGT are skipped, so contigs joined by an
+    N do not make k-mers across their ends.
+    """
+    codes = CODES[np.frombuffer(seq, dtype=np.uint8)]
+    num = len(codes) - k + 1
+    if num < 1:
+        return np.array([], dtype=np.uint64)
+
+    bad = np.concatenate([[0], np.cumsum(codes == 4)])
+    valid = bad[k:] - bad[:num] == 0
+
+    bases = np.where(codes == 4, 0, codes).astype(np.uint64)
+    fwd = np.zeros(num, dtype=np.uint64)
+    rev = np.zeros(num, dtype=np.uint64)
+    for j in range(k):
+        window = bases[j:j + num]
+        fwd = (fwd << np.uint64(2)) | window
+        rev |= (np.uint64(3) - window) << np.uint64(2 * j)
+
+    hashes = splitmix64(np.minimum(fwd, rev)[valid])
+
+    # only the smallest hashes matter, pick more than size of them in
+    # case of repeats and take them all if that was not enough
+    pick = 4 * size
+    while True:
+        if pick < len(hashes):
+            low = np.partition(hashes, pick)[:pick]
+        else:
+            low = hashes
+        low = np.sort(low)
+        low = low[np.r_[True, low[1:] != low[:-1]]]
+        if len(low) >= size or pick >= len(hashes):
+            return low[:size]
+        pick *= 4
+
+# --------------------------------------------------
+def distance(sketch_a, sketch_b, k=SKETCH_K, size=SKETCH_SIZE):
+    """Mash distance of two sketches, 1.0 if they share nothing"""
+    union = np.union1d(sketch_a, sketch_b)[:size]
+    if not len(union):
+        return 1.0
+
+    shared = np.intersect1d(np.intersect1d(sketch_a, sketch_b,
+                                           assume_unique=True),
+                            union, assume_unique=True)
+    jaccard = len(shared) / len(union)
+    if not jaccard:
+        return 1.0
+
+    return max(0.0, -math.log(2 * jaccard / (1 + jaccard)) / k)
+
+# --------------------------------------------------
+def dereplicate(genomes, max_dist=MAX_DIST, k=SKETCH_K, size=SKETCH_SIZE):
+    """Greedily keep the genomes not within max_dist of a kept one
+
+    genomes are (name, FASTA file) pairs, best first, so each cluster of
+    near-identical genomes is represented by its best member. Returns the
+    names kept.
+    """
+    kept, sketches = [], []
+    for name, fasta in genomes:
+        this = sketch(read_fasta(fasta), k, size)
+        if all(distance(this, other, k, size) > max_dist
+               for other in sketches):
+            kept.append(name)
+            sketches.append(this)
+
+    return kept
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -44,17 +44,24 @@ and feeds them to each of the steps
 #BOWTIMG="bowtie-sam.img"
 #HTSQIMG="count-deseq.img"
 
-import os, sys, argparse, glob, subprocess
+import os, sys, argparse, glob, shlex, subprocess
 import pandas as pd
-import tempfile as tmp
 from pprint import pprint
-from Bio import SeqIO
+
+import bt2_index
+import genome_store
+import runner
+import scheduler
 
 #WORK env var will be present on TACC
 #But may not be set when testing locally
 if os.getenv('WORK') is None:
     os.environ['WORK'] = './' #this is how we could set launcher variables, etc.
 
+#where count-deseq.py puts the gffs of all the genomes together, then
+#filtered down to the CDS in [name]-CDS.gff
+GFF_FILE = os.path.join(os.getenv('WORK'), 'all.RefSeq.gff')
+
 ####################
 # ARGUMENTS ########
 ####################
@@ -92,6 +99,23 @@ inputs.add_argument('-g', '--genome-dir',
         "keep the default in all steps\n"
         " [ Default = $WORK/genomes ]")
 
+inputs.add_argument('--genome-store',
+        dest='genome_store', metavar='DIRECTORY',
+        default=genome_store.DEFAULT_STORE,
+        help="Genome store shared by all runs and projects.\n"
+        "Genomes already in it are linked into --genome-dir\n"
+        "instead of downloaded again, \"\" for none. Put it on the\n"
+        "file system of --genome-dir (e.g. under $WORK) so genomes\n"
+        "are linked into it, not copied.\n"
+        " [ Default = $RADCOT_GENOME_STORE, or none ]")
+
+inputs.add_argument('--store-max-gb',
+        dest='store_max_gb', metavar='FLOAT',
+        type=float, default=genome_store.DEFAULT_MAX_GB,
+        help="Size the genome store may grow to before the least\n"
+        "recently used genomes are evicted, 0 for no cap.\n"
+        " [ Default = {} ]".format(genome_store.DEFAULT_MAX_GB))
+
 inputs.add_argument('-x', '--bt2-idx', 
         dest='bt2_idx', metavar='FILENAME', 
         default=os.path.join(os.getenv('WORK'),'bt2_index/','genome'),
@@ -99,6 +123,23 @@ inputs.add_argument('-x', '--bt2-idx',
         "This will also be the name of the fasta file, E.g. [bt2-idx].fna\n"
         "NOTE: Bowtie 1 and Bowtie 2 indexes are not compatible.")
 
+inputs.add_argument('--index-shards',
+        dest='index_shards', metavar='INT',
+        type=int, default=1,
+        help="Split the bowtie2 index into this many shards of genomes.\n"
+        "Only shards whose genomes changed are rebuilt, --procs of\n"
+        "them at once, and reads are aligned to all shards in parallel.\n"
+        "Changing the number rebuilds every shard. [ Default = 1 ]")
+
+inputs.add_argument('--index-cache',
+        dest='index_cache', metavar='DIRECTORY',
+        default=bt2_index.DEFAULT_CACHE,
+        help="Cache of bowtie2 shard indexes, keyed by the contents of\n"
+        "their genomes, shared by the indexes using it. A shard of\n"
+        "the same genomes is never built twice, and shards no index\n"
+        "uses any more are pruned. [ Default = $RADCOT_INDEX_CACHE,\n"
+        "or bt2_index_cache next to --bt2-idx ]")
+
 inputs.add_argument('-m', '--metadata', 
         dest='metadata', metavar='FILENAME',
         default=os.path.join(os.getenv('WORK'),'metadata.txt'),
@@ -159,6 +200,26 @@ step_three.add_argument('-D', '--deseq2-opts',
         "-o2 option2\n"
         "[ Default = $WORK/deseq2-opts.txt ]")
 
+step_three.add_argument('--fused-counts',
+        dest='fused_counts', action='store_true',
+        help="Count the RNA reads per feature while they are aligned,\n"
+        "with the htseq-count options, instead of writing a bam\n"
+        "per sample for htseq-count to read back.")
+
+step_three.add_argument('--keep-bams',
+        dest='keep_bams', action='store_true',
+        help="With --fused-counts, write the bams as well.")
+
+step_three.add_argument('--single-pass',
+        dest='single_pass', action='store_true',
+        help="Count the bams of every sample in one run that indexes\n"
+        "the gff once, and also write a feature x sample matrix.")
+
+step_three.add_argument('--counter',
+        dest='counter', choices=['numpy', 'htseq'], default='numpy',
+        help="Count the bams with featurecount.py (numpy) or with\n"
+        "htseq-count (htseq). [ Default = numpy ]")
+
 gen_opts = parser.add_argument_group('General Options') 
 
 gen_opts.add_argument('-d', '--debug', action='store_true',
@@ -173,8 +234,14 @@ gen_opts.add_argument('-t', '--threads',
 gen_opts.add_argument('-P', '--procs',
         dest='procs', metavar='INT',
         type=int, default=1,
-        help="Number of parallel processes to launch\n"
-        "with gnu-parallel (this multiplies with threaded programs).\n"
+        help="Max number of parallel processes to launch\n"
+        "(each reserves --threads cores, jobs wait for free cores).\n"
+        " [ Default = 1 ] ")
+
+gen_opts.add_argument('--retries',
+        dest='retries', metavar='INT',
+        type=int, default=1,
+        help="Times to rerun a failed job before giving up.\n"
         " [ Default = 1 ] ")
 
 gen_opts.add_argument('--skip-centrifuge',
@@ -213,16 +280,6 @@ def module_load(module_name):
         os.environ[key] = value.rstrip('\n')
     proc.communicate()
 
-def cat_fasta(genome_dir,bt2_idx):
-    file_list = glob.glob(genome_dir + "/*.fna")
-    with open(bt2_idx+'.fna','w') as w_file:
-        for filen in file_list:
-            with open(filen, 'rU') as o_file:
-                seq_records = SeqIO.parse(o_file, 'fasta')
-                SeqIO.write(seq_records, w_file, 'fasta')
-
-        return w_file.name
-
 #basic checker, check that options file exists and then check that each line begins with a '-', then parse
 def parse_options_text(options_txt_path):
     if not (os.path.isfile(options_txt_path)):
@@ -243,19 +300,12 @@ def parse_options_text(options_txt_path):
 
     return options_string
 
-def execute(command):
-
-    print('Executing {}'.format(command) + os.linesep)
-    process = subprocess.Popen(command,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=True)
-    (stdout, stderr) = process.communicate()
-    print(stdout.decode() + os.linesep)
-    print(stderr.decode() + os.linesep)
+def log_file(step):
+    """Where a step logs its output, rotated as it grows"""
+    log_dir = os.path.join(args.out_dir, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
 
-    return process.returncode
+    return os.path.join(log_dir, step + '.log')
 
 # --------------------------------------------------
 def warn(msg):
@@ -268,33 +318,6 @@ def die(msg='Something went wrong'):
     warn('Error: {}'.format(msg))
     sys.exit(1)
 
-# --------------------------------------------------
-def line_count(fname):
-    """Count the number of lines in a file"""
-    n = 0
-    for _ in open(fname):
-        n += 1
-
-    return n
-
-# --------------------------------------------------
-def run_job_file(jobfile, msg='Running job', procs=1):
-    """Run a job file if there are jobs"""
-    num_jobs = line_count(jobfile)
-    warn('{} (# jobs = {})'.format(msg, num_jobs))
-#--halt now,fail=1 causes parallel to exit with code 1 if any subjobs exit with code 1
-    if num_jobs > 0:
-        cmd = 'parallel --halt now,fail=1 -P {} < {}'.format(procs, jobfile)
-        warn(cmd)
-        completed_process = subprocess.run(cmd, shell=True)
-    else:
-        warn('No jobs to run!')
-        return 0
-
-    os.remove(jobfile)
-
-    return completed_process.returncode
-
 #############################
 # Script-specific Functions #
 #############################
@@ -334,6 +357,10 @@ def run_centrifuge(reads, cent_opts, patric_opts):
 
     options_string = parse_options_text(cent_opts) + parse_options_text(patric_opts)
 
+    #the genomes go where the later steps look for them, via the store
+    options_string = '-g {} --genome_store "{}" --store_max_gb {} {}'.format(
+        args.genome_dir, args.genome_store, args.store_max_gb, options_string)
+
     #If we are using this from the metadata txt
     #we will have either paired + unpaired
     #or just paired
@@ -356,7 +383,8 @@ def run_centrifuge(reads, cent_opts, patric_opts):
         command = '{} -1 {} -2 {} -o {} {}'.format(cent_script, f_reads,
                     r_reads, args.out_dir, options_string)
 
-        returncode = execute(command)
+        returncode = runner.run(command,
+                                log_file=log_file('run_centrifuge')).returncode
 
         if returncode == 0:
             print('{} ran sucessfully, continuing...'.format(cent_script))
@@ -368,7 +396,8 @@ def run_centrifuge(reads, cent_opts, patric_opts):
         command = '{} -1 {} -2 {} -U {} -o {} {}'.format(cent_script, f_reads,
                     r_reads, u_reads, args.out_dir, options_string)
 
-        returncode = execute(command)
+        returncode = runner.run(command,
+                                log_file=log_file('run_centrifuge')).returncode
 
         if returncode == 0:
             print('{} ran sucessfully, continuing...'.format(cent_script))
@@ -380,7 +409,8 @@ def run_centrifuge(reads, cent_opts, patric_opts):
         command = '{} -U {} -o {} {}'.format(cent_script, u_reads,
                     args.out_dir, options_string)
 
-        returncode = execute(command)
+        returncode = runner.run(command,
+                                log_file=log_file('run_centrifuge')).returncode
 
         if returncode == 0:
             print('{} ran sucessfully, continuing...'.format(cent_script))
@@ -392,35 +422,62 @@ def run_centrifuge(reads, cent_opts, patric_opts):
 
 def prepare_bowtie_db(genome_dir, bt2_idx):
 
-    bt2_db_fasta = args.bt2_idx + '.fna'
-    db_dir = os.path.dirname(args.bt2_idx) #E.g. /vagrant/bt2_idx
-    # Ensure there's a genome.fna file or make one if not
-    if not os.path.isfile(bt2_db_fasta): #E.g. /vagrant/bt2_idx/genome.fna
-        pprint("No input bowtie2 db specified," \
-               + " concatenating fastas in {}".format(args.genome_dir))
-        #make the directory for the bt2 index if not there
-        if not os.path.isdir(db_dir): 
-            os.makedirs(db_dir) #E.g. mkdir /vagrant/bt2_idx
-        bt2_db_fasta = cat_fasta(args.genome_dir,args.bt2_idx)
-        pprint("Created a combined genome for you: {}".format(bt2_db_fasta))
-
-    bowtie_db_cmd = 'bowtie2-build --threads {} -f {} {}'.format(args.threads, bt2_db_fasta, args.bt2_idx)
-    return_code = execute(bowtie_db_cmd)
+    #only the shards whose genomes are not in the cache are built, --procs at a time
+    index = bt2_index.ShardedIndex(bt2_idx, args.index_shards, args.index_cache)
+    pprint("Updating the bowtie2 index {} ({} shard(s)) of the genomes in {}".format(
+        bt2_idx, args.index_shards, genome_dir))
+    try:
+        built = index.update(genome_dir, threads=args.threads,
+                               procs=args.procs, retries=args.retries)
+    except ValueError as e:
+        die("Something went wrong with building the bowtie2 db: {}".format(e))
+    pprint("Built {} of {} shard(s), the rest were in {}".format(
+        len(built), args.index_shards, index.cache_dir))
 
-    if return_code != 0:
-        die("Something went wrong with building the bowtie2 db")
+    #the shards of genomes no index uses any more
+    pruned = index.prune()
+    if pruned:
+        pprint("Pruned {} old shard(s) from {}".format(len(pruned),
+            index.cache_dir))
+
+    return bt2_idx
+
+def cds_gff():
+
+    #the name count-deseq.py gives the filtered GFF_FILE
+    gff_name, ext = os.path.splitext(GFF_FILE)
+
+    return gff_name + '-CDS' + ext
 
-    return args.bt2_idx
+def prepare_gff(genome_dir):
+
+    #the features have to be there before the reads are, to count them
+    bin_dir = os.path.dirname(os.path.realpath(__file__))
+    cmd = '{} --gff-dir {} --gff-file {} --out-dir {} --gff-only'.format(
+            os.path.join(bin_dir, 'count-deseq.py'), genome_dir, GFF_FILE,
+            args.out_dir)
+    return_code = runner.run(cmd, log_file=log_file('prepare-gff')).returncode
+
+    if return_code != 0:
+        die("Something went wrong making the gff to count on")
 
 def run_rna_align(genome_dir, metadata, options, procs):
 
     options_string = parse_options_text(options)
+
+    #counted as htseq-count would, while aligning
+    count_string = ''
+    if args.fused_counts:
+        count_string = '--count-gff {} --count-opts={}'.format(cds_gff(),
+                shlex.quote(parse_options_text(args.htseq_count_opts) or ''))
+        if args.keep_bams:
+            count_string += ' --keep-bam'
     
-    jobfile = tmp.NamedTemporaryFile(delete=False, mode='wt')
+    jobs = []
     bin_dir = os.path.dirname(os.path.realpath(__file__))
     bowt_script = os.path.join(bin_dir, 'patric_bowtie2.py')
 
-    tmpl = '{0} -g {1} -1 {2} -2 {3} -U {4} -O {5} -n {6} {7}\n'
+    tmpl = '{0} -g {1} -1 {2} -2 {3} -U {4} -O {5} -n {6} -t {7} -x {9} {8}'
    
     conditioned = metadata.groupby('condition')
 
@@ -440,24 +497,31 @@ def run_rna_align(genome_dir, metadata, options, procs):
             if row[1]['rna_unpaired']: 
                 u_read = os.path.join(args.in_dir,row[1]['rna_unpaired'])
 
-            jobfile.write(tmpl.format(bowt_script, #0
+            bam = os.path.join(args.in_dir,row[1]['bam_files'])
+            cmd = tmpl.format(bowt_script, #0
                 genome_dir, #1
                 f_read, #2
                 r_read, #3
                 u_read, #4
                 args.out_dir, #5
-                os.path.join(args.in_dir,row[1]['bam_files']), #6
-                options_string)) #7
-
-    jobfile.close()
+                bam, #6
+                args.threads, #7
+                options_string, #8
+                args.bt2_idx) #9
+            if count_string:
+                cmd += ' --counts {}.counts {}'.format(bam, count_string)
+
+            jobs.append(scheduler.Job(cmd, cpus=args.threads))
     
     if args.debug:
         print("These are the commands I'm running:\n")
-        execute('cat {}'.format(jobfile.name))
+        for job in jobs:
+            print(job.cmd)
   
-    return_code = run_job_file(jobfile=jobfile.name, msg='Running RNA alignments', procs=procs)
+    results = scheduler.run_jobs(jobs, msg='Running RNA alignments',
+                                 procs=procs, retries=args.retries)
 
-    if return_code != 0:
+    if scheduler.failed(results):
         die()
 
 def run_htseq(genome_dir, metadata_file, htseq_count_opts, deseq2_opts, procs):
@@ -474,7 +538,12 @@ def run_htseq(genome_dir, metadata_file, htseq_count_opts, deseq2_opts, procs):
 
     tmpl = '{0} --gff-dir {1} --bams-dir {2} --metadata {3} --out-dir {4} \
             --threads {5} --htseq-count-options {6} --deseq2-options {7} \
-            --procs {8}'
+            --procs {8} --retries {9} --gff-file {10}'
+    if args.fused_counts:
+        tmpl += ' --fused-counts'
+    elif args.single_pass:
+        tmpl += ' --single-pass'
+    tmpl += ' --counter {}'.format(args.counter)
    
     metadata = parse_metadata(metadata_file)
     reps = metadata.groupby(['condition','replicate'])
@@ -493,8 +562,10 @@ def run_htseq(genome_dir, metadata_file, htseq_count_opts, deseq2_opts, procs):
             args.threads, #5
             htseq_count_opts, #6
             deseq2_opts, #7
-            procs) #8
-    return_code = execute(cmd)
+            procs, #8
+            args.retries, #9
+            GFF_FILE) #10
+    return_code = runner.run(cmd, log_file=log_file('count-deseq')).returncode
 
     if return_code != 0:
         die("Something went wrong running count-deseq.py")
@@ -531,14 +602,14 @@ if __name__ == '__main__':
     if not args.skip_rna:
         print("Running bowtie2 alignment for RNA reads")
 
-        if os.path.isfile(args.bt2_idx + '.1.bt2') or os.path.isfile(args.bt2_idx + '.1.bt2l'):
-            print('Bowtie2 index, {}, already exists... assuming its ok'.format(args.bt2_idx) + os.linesep)
-            bt2_db_base = args.bt2_idx
-        else:
-            bt2_db_base = prepare_bowtie_db(args.genome_dir, args.bt2_idx)
+        #always checked against the genomes, a cached index is found at once
+        bt2_db_base = prepare_bowtie_db(args.genome_dir, args.bt2_idx)
 
         print('Bowtie2 base db: {}'.format(bt2_db_base) + os.linesep)
 
+        if args.fused_counts:
+            prepare_gff(args.genome_dir)
+
         run_rna_align(args.genome_dir, metadata, args.bowtie2_opts, args.procs)
     
     #Run htseq-count and deseq2
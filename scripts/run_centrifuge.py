@@ -2,15 +2,28 @@
 """Run Centrifuge"""
 
 import argparse
-import csv
+import errno
 import glob
 import os
-import re
+import queue
 import subprocess
 import sys
 import tempfile as tmp
+import threading
+import time
 from pprint import pprint
 
+import collapse
+import fxsplit
+import genome_store
+import representatives
+import scheduler
+import split_batch
+
+# batches are made big enough that loading the index takes at most this
+# share of their runtime
+LOAD_SHARE = 0.1
+
 #WORK env var will be present on TACC
 #But may not be set when testing locally
 if os.getenv('WORK') is None:
@@ -95,6 +108,72 @@ def get_args():
                         type=int,
                         default=1000000)
 
+    parser.add_argument('-B', '--bases_per_file',
+                        help='Also end a split file once it holds this\n'
+                        'many bases, 0 to only use --max_seqs_per_file',
+                        metavar='int',
+                        type=int,
+                        default=0)
+
+    parser.add_argument('--auto_split',
+                        help='Ignore --max_seqs_per_file/--bases_per_file\n'
+                        'and split the (estimated) total bases into\n'
+                        '--procs x --waves equal chunks',
+                        action='store_true')
+
+    parser.add_argument('--waves',
+                        help='Chunks per --procs slot for --auto_split',
+                        metavar='int',
+                        type=int,
+                        default=2)
+
+    parser.add_argument('--stream',
+                        help='Do not split at all, stream blocks of reads\n'
+                        'from each input into --procs centrifuge\n'
+                        'workers through named pipes',
+                        action='store_true')
+
+    parser.add_argument('-V', '--virtual_split',
+                        help='Only index the inputs into record-aligned\n'
+                        'byte ranges instead of writing split files,\n'
+                        'centrifuge reads each range through a pipe\n'
+                        '(gzipped inputs are still split into files)',
+                        action='store_true')
+
+    parser.add_argument('-s', '--sum_format',
+                        help='Format of the collapsed per-read\n'
+                        'classifications: text, or a compressed parquet\n'
+                        'store that can be queried by taxID (needs pyarrow)',
+                        metavar='str',
+                        type=str,
+                        choices=['text', 'parquet'],
+                        default='text')
+
+    parser.add_argument('-A', '--abundance',
+                        help='Abundance column of the collapsed reports:\n'
+                        'share of numReads (rounded, the old way), or\n'
+                        'estimated from the per-read classifications\n'
+                        'with multi-assigned reads split by unique reads\n'
+                        'or by EM; --min_abundance filters on it',
+                        metavar='str',
+                        type=str,
+                        choices=['reads', 'unique', 'em'],
+                        default='unique')
+
+    parser.add_argument('-b', '--batch',
+                        help='Chunks classified per centrifuge run, to\n'
+                        'load the index fewer times, 0 to measure the\n'
+                        'index load and per-base times and choose',
+                        metavar='int',
+                        type=int,
+                        default=0)
+
+    parser.add_argument('--mm',
+                        help='Memory-map the index (centrifuge --mm) so\n'
+                        'that concurrent runs share one copy of it in\n'
+                        'the page cache, more --procs then fit in memory',
+                        action='store_true')
+
     parser.add_argument('-t', '--threads',
                         help='Num of threads per instance of centrifuge',
                         metavar='int',
@@ -106,6 +185,12 @@ def get_args():
                         metavar='int',
                         type=int,
                         default=1)
+
+    parser.add_argument('--retries',
+                        help='Times to rerun a failed job before giving up',
+                        metavar='int',
+                        type=int,
+                        default=1)
     
     parser.add_argument("-m", "--min_abundance", action="store", \
                         help="Minimum abundance needed to download a species\' genome", \
@@ -118,6 +203,44 @@ def get_args():
                         "NOTE2: patric annotations will generally include refseq genes. " \
                         "Default is \"refseq\" as it is generally better curated.")
 
+    parser.add_argument('--genome_store',
+                        help='Genome store shared by all runs, genomes in it\n'
+                        'are linked into --genome-dir instead of downloaded,\n'
+                        '"" for none, best on the file system of --genome-dir\n'
+                        '(default $RADCOT_GENOME_STORE, or none)',
+                        metavar='DIRECTORY',
+                        type=str,
+                        default=genome_store.DEFAULT_STORE)
+
+    parser.add_argument('--store_max_gb',
+                        help='Size of the genome store before the least\n'
+                        'recently used genomes are evicted, 0 for no cap',
+                        metavar='float',
+                        type=float,
+                        default=genome_store.DEFAULT_MAX_GB)
+
+    parser.add_argument('--select',
+                        help='Which genomes of a taxID to get: all, the\n'
+                        'reference/representative ones, the --top_n most\n'
+                        'complete, or dereplicated by Mash distance',
+                        metavar='str',
+                        type=str,
+                        choices=representatives.POLICIES,
+                        default='all')
+
+    parser.add_argument('--top_n',
+                        help='Genomes per taxID for --select complete',
+                        metavar='int',
+                        type=int,
+                        default=5)
+
+    parser.add_argument('--max_dist',
+                        help='Mash distance under which --select\n'
+                        'dereplicate considers two genomes the same',
+                        metavar='float',
+                        type=float,
+                        default=representatives.MAX_DIST)
+
     return parser.parse_args()
 
 # --------------------------------------------------
@@ -147,166 +270,659 @@ def find_input_files(query):
     return files
 
 # --------------------------------------------------
-def line_count(fname):
-    """Count the number of lines in a file"""
-    n = 0
-    for _ in open(fname):
-        n += 1
+def split_files(out_dir, files, max_seqs, file_format, procs, virtual=False,
+                mates=None, max_bases=0, retries=0):
+    """Split input files by max_sequences, return the fxsplit.Chunks
+
+    With mates (reverse reads in the same order as files) each pair is
+    split in lockstep and (forward, reverse) Chunk tuples are returned.
+    """
+    split_dir = os.path.join(out_dir, 'split')
+
+    if not os.path.isdir(split_dir):
+        os.makedirs(split_dir)
+
+    jobs = []
+    bin_dir = os.path.dirname(os.path.realpath(__file__))
+    tmpl = '{}/fxsplit.py -i {} -f {} -o {} -n {} -b {} --index {}{}'
+    mate_tmpl = ' -2 {} --mate_index {}'
+
+    index_files = []
+    for i, input_file in enumerate(files):
+        out_file = os.path.join(split_dir, os.path.basename(input_file))
+        index_file = out_file + '.idx'
+        extra_args = ''
+
+        if mates:
+            mate_index = os.path.join(split_dir,
+                                      os.path.basename(mates[i]) + '.idx')
+            index_files.append((index_file, mate_index))
+            extra_args = mate_tmpl.format(mates[i], mate_index)
+        else:
+            index_files.append((index_file,))
+
+        pair = [input_file] + (mates[i:i + 1] if mates else [])
+        if virtual and any(f.endswith('.gz') for f in pair):
+            warn('Can not index "{}" in place, splitting it'.format(input_file))
+        elif virtual:
+            extra_args += ' --virtual'
+
+        if not os.path.isfile(index_files[-1][-1]):
+            jobs.append(tmpl.format(bin_dir,
+                                    input_file,
+                                    file_format,
+                                    out_file,
+                                    max_seqs,
+                                    max_bases,
+                                    index_file,
+                                    extra_args))
+
+    results = scheduler.run_jobs(jobs, msg='Splitting input files',
+                                 procs=procs, retries=retries)
+
+    if scheduler.failed(results):
+        die()
+
+    chunks = []
+    for indexes in index_files:
+        chunk_lists = [fxsplit.read_index(index) for index in indexes]
+        chunks.extend(zip(*chunk_lists) if mates else chunk_lists[0])
+
+    return chunks
+
+# --------------------------------------------------
+def auto_split(files, file_format, procs, waves):
+    """Return (max_seqs, max_bases) making procs * waves equal chunks"""
+    total = sum(fxsplit.estimate_bases(f, file_format) for f in files)
+    num_chunks = max(1, procs * waves)
+    max_bases = max(1, -(-total // num_chunks))
+    warn('About {} bases in {} file{}, splitting into ~{} chunks of {} '
+         'bases'.format(total, len(files), '' if len(files) == 1 else 's',
+                        num_chunks, max_bases))
 
-    return n
+    return sys.maxsize, max_bases
 
 # --------------------------------------------------
-def run_job_file(jobfile, msg='Running job', procs=1):
-    """Run a job file if there are jobs"""
-    num_jobs = line_count(jobfile)
-    warn('{} (# jobs = {})'.format(msg, num_jobs))
-#--halt now,fail=1 causes parallel to exit with code 1 if any subjobs exit with code 1
-    if num_jobs > 0:
-        cmd = 'parallel --halt now,fail=1 -P {} < {}'.format(procs, jobfile)
-        warn(cmd)
-        completed_process = subprocess.run(cmd, shell=True)
-    else:
-        warn('No jobs to run!')
-        return 0
+def chunk_pipe(chunk):
+    """Shell command printing a chunk that is a byte range of a bigger file
 
-    os.remove(jobfile)
+    Returns an empty string for a chunk that is a whole file by itself.
+    """
+    if chunk.start == 0 and chunk.end == os.path.getsize(chunk.path):
+        return ''
 
-    return completed_process.returncode
+    return 'tail -c +{} {} | head -c {}'.format(chunk.start + 1,
+                                                chunk.path,
+                                                chunk.end - chunk.start)
 
 # --------------------------------------------------
-def split_files(out_dir, files, max_seqs, file_format, procs):
-    """Split input files by max_sequences"""
-    split_dir = os.path.join(out_dir, 'split')
+def batch_pipe(chunks):
+    """Return (pipe, paths) giving the reads of consecutive chunks
 
-    if not os.path.isdir(split_dir):
-        os.makedirs(split_dir)
+    Chunks that are whole files have no pipe, paths lists them
+    comma-separated for centrifuge to read directly. Consecutive byte ranges
+    of one file are printed by a single pipe over their whole span.
+    """
+    if not any(map(chunk_pipe, chunks)):
+        return '', ','.join(chunk.path for chunk in chunks)
 
-    jobfile = tmp.NamedTemporaryFile(delete=False, mode='wt')
-    bin_dir = os.path.dirname(os.path.realpath(__file__))
-    tmpl = '{}/fxsplit.py -i {} -f {} -o {} -n {}\n'
+    span = chunks[0]._replace(end=chunks[-1].end)
 
-    for input_file in files:
-        out_file = os.path.join(split_dir, os.path.basename(input_file))
-        if not os.path.isdir(out_file):
-            jobfile.write(tmpl.format(bin_dir,
-                                      input_file,
-                                      file_format,
-                                      out_file,
-                                      max_seqs))
+    return chunk_pipe(span), span.path
 
+# --------------------------------------------------
+def chunk_input(chunks):
+    """Return (pipe, path) to give centrifuge the reads of consecutive chunks
 
-    jobfile.close()
+    Byte ranges of a bigger file are piped in on STDIN, whole files are
+    read directly.
+    """
+    pipe, paths = batch_pipe(chunks)
+    if not pipe:
+        return '', paths
 
-    return_code = run_job_file(jobfile=jobfile.name, msg='Splitting input files', procs=procs)
+    return pipe + ' | ', '-'
 
-    if return_code != 0:
-        die()
+# --------------------------------------------------
+def group_batches(units, size):
+    """Group consecutive (chunk, [mate]) units into batches of up to size
+
+    A batch is either all whole files or one unbroken byte range per mate,
+    so that a single centrifuge run can read it (see batch_pipe).
+    """
+    def joins(prev, unit):
+        for last, chunk in zip(prev, unit):
+            if chunk_pipe(last) or chunk_pipe(chunk):
+                if last.path != chunk.path or last.end != chunk.start:
+                    return False
+        return True
+
+    batches = []
+    for unit in units:
+        if batches and len(batches[-1]) < size and joins(batches[-1][-1], unit):
+            batches[-1].append(unit)
+        else:
+            batches.append([unit])
 
-    return list(filter(os.path.isfile,
-                       glob.iglob(split_dir + '/**', recursive=True)))
+    return batches
+
+# --------------------------------------------------
+def batch_size(load_secs, secs, units, procs):
+    """Chunks per batch from a run of units[0] that took secs
+
+    Batches get big enough that loading the index (load_secs) is at most
+    LOAD_SHARE of their runtime, but small enough that every --procs slot
+    still gets one of the other units.
+    """
+    bases = [sum(chunk.bases for chunk in unit) for unit in units]
+    per_base = max(secs - load_secs, 0) / max(bases[0], 1)
+    mean_bases = sum(bases[1:]) / max(len(bases) - 1, 1)
+    if per_base and mean_bases:
+        want = load_secs * (1 - LOAD_SHARE) / LOAD_SHARE / per_base
+        size = int(-(-want // mean_bases))
+    else:
+        size = len(bases)
+    size = max(1, min(size, -(-(len(bases) - 1) // procs)))
+
+    warn('Loading the index takes {:.1f}s, classifying {:.3g}s per base, '
+         'running {} chunk{} per centrifuge'.format(load_secs, per_base, size,
+                                                   '' if size == 1 else 's'))
+
+    return size
+
+# --------------------------------------------------
+def split_cmd(batch, prefix, reports_dir):
+    """Shell command splitting the reports of a batch into its chunks'"""
+    if len(batch) == 1:
+        return ''
+
+    #a batch whose counts do not split (split_batch.UNSPLIT) succeeds without
+    #its chunks' reports, run_chunk_jobs then runs those chunks one by one
+    bin_dir = os.path.dirname(os.path.realpath(__file__))
+    return ' && {{ {}/split_batch.py -s {}.sum -r {}.tsv -n {} {} || ' \
+        '[ $? -eq {} ]; }}'.format(
+            bin_dir, prefix, prefix,
+            ','.join(str(unit[0].records) for unit in batch),
+            ' '.join(os.path.join(reports_dir, unit[0].name) for unit in batch),
+            split_batch.UNSPLIT)
 
 # --------------------------------------------------
-def run_centrifuge(file_format, files, exclude_ids, 
-        index_name, index_dir, out_dir, threads, procs):
+def probe_job(file_format, index_name, index_dir, threads, mm=False):
+    """A Job running centrifuge on a single read, so it just loads the index"""
+    seq = 'ACGT' * 25
+    if file_format == 'fasta':
+        read = '>probe\\n{}\\n'.format(seq)
+    else:
+        read = '@probe\\n{}\\n+\\n{}\\n'.format(seq, 'I' * len(seq))
+
+    cmd = "printf '{}' | CENTRIFUGE_INDEXES={} centrifuge {}{}-p {} -x {} " \
+        "-U - -S /dev/null --report-file /dev/null".format(
+            read, index_dir, '--mm ' if mm else '',
+            '-f ' if file_format == 'fasta' else '', threads, index_name)
+
+    return index_job(cmd, 'index_probe', threads, index_dir, index_name, mm)
+
+# --------------------------------------------------
+def run_centrifuge(file_format, chunks, exclude_ids,
+        index_name, index_dir, out_dir, threads, procs,
+        collapser=None, retries=0, mm=False, batch=1):
     """Run Centrifuge"""
     reports_dir = os.path.join(out_dir, 'reports')
 
     if not os.path.isdir(reports_dir):
         os.makedirs(reports_dir)
 
-    jobfile = tmp.NamedTemporaryFile(delete=False, mode='wt')
     exclude_arg = '--exclude-taxids ' + exclude_ids if exclude_ids else ''
+    exclude_arg += ' --mm' if mm else ''
     if file_format == 'fasta':
-        tmpl = 'CENTRIFUGE_INDEXES={} centrifuge {} -f -p {} -x {} -U {} -S {} --report-file {}\n'
+        tmpl = '{}CENTRIFUGE_INDEXES={} centrifuge {} -f -p {} -x {} -U {} -S {} --report-file {}'
     elif file_format == 'fastq':
-        tmpl = 'CENTRIFUGE_INDEXES={} centrifuge {} -p {} -x {} -U {} -S {} --report-file {}\n'
+        tmpl = '{}CENTRIFUGE_INDEXES={} centrifuge {} -p {} -x {} -U {} -S {} --report-file {}'
     else:
         die('Need to specifiy read format for centrifuge to work')
 
-    for file in files:
-        basename = os.path.basename(file)
-        tsv_file = os.path.join(reports_dir, basename + '.tsv')
-        sum_file = os.path.join(reports_dir, basename + '.sum')
-        if not os.path.isfile(tsv_file):
-            jobfile.write(tmpl.format(index_dir,
-                                      exclude_arg,
-                                      threads,
-                                      index_name,
-                                      file,
-                                      sum_file,
-                                      tsv_file))
-    jobfile.close()
-
-    return_code = run_job_file(jobfile=jobfile.name, msg='Running Centrifuge', procs=procs)
-    
-    if return_code != 0:
-        die()
+    if collapser:
+        collapser.expect([chunk.name for chunk in chunks])
+
+    units = []
+    for chunk in chunks:
+        tsv_file = os.path.join(reports_dir, chunk.name + '.tsv')
+        if os.path.isfile(tsv_file):
+            if collapser:
+                collapser.add(tsv_file)
+        else:
+            units.append((chunk,))
+
+    def batch_job(batch):
+        name = batch[0][0].name
+        prefix = os.path.join(reports_dir, name)
+        if len(batch) > 1:
+            prefix += '.batch'
+        pipe, reads = chunk_input([chunk for chunk, in batch])
+        cmd = tmpl.format(pipe,
+                          index_dir,
+                          exclude_arg + (' --reorder' if len(batch) > 1 else ''),
+                          threads,
+                          index_name,
+                          reads,
+                          prefix + '.sum',
+                          prefix + '.tsv')
+        return index_job(cmd + split_cmd(batch, prefix, reports_dir), name,
+                         threads, index_dir, index_name, mm)
+
+    probe = probe_job(file_format, index_name, index_dir, threads, mm) if not batch and len(units) > procs else None
+    run_chunk_jobs(units, batch_job, out_dir, procs, collapser, retries,
+                   batch, probe)
 
     return list(filter(os.path.isfile,
                        glob.iglob(reports_dir + '/**', recursive=True)))
 
-def run_cent_paired(file_format, paired_reads, exclude_ids, 
-        index_name, index_dir, out_dir, threads, procs):
-    """Run Centrifuge"""
+def run_cent_paired(file_format, paired_chunks, exclude_ids,
+        index_name, index_dir, out_dir, threads, procs,
+        collapser=None, retries=0, mm=False, batch=1):
+    """Run Centrifuge on (forward, reverse) chunks"""
     reports_dir = os.path.join(out_dir, 'reports')
 
     if not os.path.isdir(reports_dir):
         os.makedirs(reports_dir)
 
-    jobfile = tmp.NamedTemporaryFile(delete=False, mode='wt')
     exclude_arg = '--exclude-taxids ' + exclude_ids if exclude_ids else ''
+    exclude_arg += ' --mm' if mm else ''
     if file_format == 'fasta':
-        tmpl = 'CENTRIFUGE_INDEXES={} centrifuge {} -f -p {} -x {} -1 {} -2 {} -S {} --report-file {}\n'
+        tmpl = 'CENTRIFUGE_INDEXES={} centrifuge {} -f -p {} -x {} -1 {} -2 {} -S {} --report-file {}'
     elif file_format == 'fastq':
-        tmpl = 'CENTRIFUGE_INDEXES={} centrifuge {} -p {} -x {} -1 {} -2 {} -S {} --report-file {}\n'
+        tmpl = 'CENTRIFUGE_INDEXES={} centrifuge {} -p {} -x {} -1 {} -2 {} -S {} --report-file {}'
     else:
         die('Need to specifiy read format for centrifuge to work')
 
-    for f, r in paired_reads:
-        basename = os.path.basename(f)
-        tsv_file = os.path.join(reports_dir, basename + '.tsv')
-        sum_file = os.path.join(reports_dir, basename + '.sum')
-        if not os.path.isfile(tsv_file):
-            jobfile.write(tmpl.format(index_dir,
-                                      exclude_arg,
-                                      threads,
-                                      index_name,
-                                      f,
-                                      r,
-                                      sum_file,
-                                      tsv_file))
-    jobfile.close()
-
-    return_code = run_job_file(jobfile=jobfile.name, msg='Running Centrifuge', procs=procs)
-
-    if return_code != 0:
-        die()
+    #NOTE: reports get named after the forward chunk
+    if collapser:
+        collapser.expect([fwd.name for fwd, _ in paired_chunks])
+
+    units = []
+    for fwd, rev in paired_chunks:
+        tsv_file = os.path.join(reports_dir, fwd.name + '.tsv')
+        if os.path.isfile(tsv_file):
+            if collapser:
+                collapser.add(tsv_file)
+        else:
+            units.append((fwd, rev))
+
+    def batch_job(batch):
+        name = batch[0][0].name
+        prefix = os.path.join(reports_dir, name)
+        if len(batch) > 1:
+            prefix += '.batch'
+        #byte ranges go in through process substitution, jobs run in bash
+        reads = []
+        for mate in zip(*batch):
+            pipe, paths = batch_pipe(mate)
+            reads.append('<({})'.format(pipe) if pipe else paths)
+        cmd = tmpl.format(index_dir,
+                          exclude_arg + (' --reorder' if len(batch) > 1 else ''),
+                          threads,
+                          index_name,
+                          reads[0],
+                          reads[1],
+                          prefix + '.sum',
+                          prefix + '.tsv')
+        return index_job(cmd + split_cmd(batch, prefix, reports_dir), name,
+                         threads, index_dir, index_name, mm)
+
+    probe = probe_job(file_format, index_name, index_dir, threads, mm) if not batch and len(units) > procs else None
+    run_chunk_jobs(units, batch_job, out_dir, procs, collapser, retries,
+                   batch, probe)
+
+    return list(filter(os.path.isfile,
+                       glob.iglob(reports_dir + '/**', recursive=True)))
+
+# --------------------------------------------------
+def run_chunk_jobs(units, batch_job, out_dir, procs, collapser=None,
+                   retries=0, batch=1, probe=None):
+    """Run centrifuge over the (chunk, [mate]) units in batches
+
+    batch_job(batch) gives the Job classifying a list of units. Each
+    chunk's report is folded into the collapser as soon as its batch
+    succeeds. Jobs are held back while their threads and the memory of the
+    index do not fit next to the running ones (see index_job).
+
+    With batch 0 the first unit runs alone next to the probe Job, which
+    only loads the index, and batch_size picks the batch size for the rest
+    from their runtimes. The chunks of a batch whose counts could not be
+    split over them (see split_batch) are run again one by one.
+    """
+    reports_dir = os.path.join(out_dir, 'reports')
+    runs = []
+
+    def report(unit):
+        return os.path.join(reports_dir, unit[0].name + '.tsv')
+
+    def run(batches, extra=()):
+        jobs = [batch_job(b) for b in batches]
+
+        def fold(i, result):
+            if collapser and i < len(batches):
+                for unit in batches[i]:
+                    if os.path.isfile(report(unit)):
+                        collapser.add(report(unit))
+
+        results = scheduler.run_jobs(jobs + list(extra),
+                                     msg='Running Centrifuge', procs=procs,
+                                     retries=retries, on_done=fold)
+
+        if scheduler.failed(results):
+            die()
+
+        runs.extend(zip(batches, results))
+        unsplit = [unit for b in batches if len(b) > 1 for unit in b
+                   if not os.path.isfile(report(unit))]
+        if unsplit:
+            warn('The counts of {} chunks did not add up in their batches, '
+                 'running them one by one'.format(len(unsplit)))
+            run([[unit] for unit in unsplit])
+        return results[len(jobs):]
+
+    if not batch:
+        batch = 1
+        if probe and units:
+            load = run([units[:1]], [probe])[0]
+            batch = batch_size(load.secs, runs[0][1].secs, units, procs)
+            units = units[1:]
+
+    run(group_batches(units, batch))
+
+    report_runtimes([(result.name, sum(chunk.bases for unit in units
+                                       for chunk in unit))
+                     for units, result in runs],
+                    {i: (result.start, result.secs)
+                     for i, (_, result) in enumerate(runs, start=1)},
+                    procs, os.path.join(out_dir, 'chunk_runtimes.tsv'))
+
+# --------------------------------------------------
+def index_job(cmd, name, threads, index_dir, index_name, mm=False):
+    """A scheduler.Job for a centrifuge command, sized by its index
+
+    A plain run reads its own copy of the index into memory. With mm
+    (centrifuge --mm) the index is memory-mapped, so every run on the node
+    shares the same page-cache copy and the scheduler only counts it once.
+    """
+    size = index_size(index_dir, index_name)
+    if mm:
+        return scheduler.Job(cmd, name=name, cpus=threads,
+                             shared=(os.path.join(index_dir, index_name),
+                                     size))
+
+    return scheduler.Job(cmd, name=name, cpus=threads, mem=size)
+
+# --------------------------------------------------
+def index_size(index_dir, index_name):
+    """Bytes of the centrifuge index files, what a run loads into memory"""
+    return sum(os.path.getsize(f) for f in
+               glob.iglob(os.path.join(index_dir, index_name + '.*.cf')))
+
+# --------------------------------------------------
+def stream_centrifuge(file_format, files, exclude_ids, index_name, index_dir,
+                      out_dir, threads, procs, mates=None, collapser=None,
+                      mm=False):
+    """Stream each input straight into centrifuge without split files
+
+    Every input (or forward/reverse pair) gets procs centrifuge workers
+    reading from named pipes. Blocks of whole records go through a bounded
+    queue to whichever worker is free, so splitting overlaps classifying
+    and memory stays at a few blocks per worker. Worker k writes the
+    reports of chunk k, which collapse_reports picks up as usual.
+    """
+    reports_dir = os.path.join(out_dir, 'reports')
+
+    if not os.path.isdir(reports_dir):
+        os.makedirs(reports_dir)
+
+    exclude_arg = '--exclude-taxids ' + exclude_ids if exclude_ids else ''
+    exclude_arg += ' --mm' if mm else ''
+    fmt_arg = '-f ' if file_format == 'fasta' else ''
+    tmpl = 'centrifuge {} {}-p {} -x {} {} -S {} --report-file {}'
+    env = dict(os.environ, CENTRIFUGE_INDEXES=index_dir)
+
+    jobs, runs = [], {}
+    for i, input_file in enumerate(files):
+        inputs = [input_file] + ([mates[i]] if mates else [])
+        report_name = fxsplit.chunk_namer(input_file, reports_dir)
+        tsv_files = [report_name(k) + '.tsv' for k in range(1, procs + 1)]
+        if collapser:
+            collapser.expect([os.path.basename(report_name(k))
+                              for k in range(1, procs + 1)])
+        if all(map(os.path.isfile, tsv_files)):
+            for tsv_file in tsv_files:
+                if collapser:
+                    collapser.add(tsv_file)
+            continue
+
+        warn('Streaming "{}" to {} centrifuge worker{}'.format(
+            '" + "'.join(inputs), procs, '' if procs == 1 else 's'))
+        fifo_dir = tmp.mkdtemp()
+        blocks = queue.Queue(maxsize=2 * procs)
+        failed = threading.Event()
+        workers = []
+        for k in range(1, procs + 1):
+            fifos = [os.path.join(fifo_dir, '{}.{}'.format(k, m))
+                     for m in range(len(inputs))]
+            for fifo in fifos:
+                os.mkfifo(fifo)
+            reads = '-U {}'.format(*fifos) if len(fifos) == 1 else \
+                '-1 {} -2 {}'.format(*fifos)
+            proc = subprocess.Popen(tmpl.format(exclude_arg, fmt_arg, threads,
+                                                index_name, reads,
+                                                report_name(k) + '.sum',
+                                                report_name(k) + '.tsv'),
+                                    shell=True, env=env)
+            worker = {'proc': proc, 'bases': 0, 'start': time.time()}
+            worker['threads'] = feed_worker(proc, fifos, blocks, failed,
+                                            worker)
+            workers.append(worker)
+
+        try:
+            stream_blocks(inputs, file_format, blocks, failed)
+        except ValueError as err:
+            warn(err)
+            failed.set()
+        finally:
+            for _ in workers:
+                blocks.put(None)
+
+        for k, worker in enumerate(workers, start=1):
+            for thread in worker['threads']:
+                thread.join()
+            if worker['proc'].wait() != 0:
+                failed.set()
+            jobs.append((os.path.basename(report_name(k)), worker['bases']))
+            runs[len(jobs)] = (worker['start'], time.time() - worker['start'])
+
+        for fifo in os.listdir(fifo_dir):
+            os.remove(os.path.join(fifo_dir, fifo))
+        os.rmdir(fifo_dir)
+
+        if failed.is_set():
+            for k in range(1, procs + 1):
+                for ext in ['.tsv', '.sum']:
+                    if os.path.isfile(report_name(k) + ext):
+                        os.remove(report_name(k) + ext)
+            die('Streaming "{}" to centrifuge failed'.format(input_file))
+
+        for tsv_file in tsv_files:
+            if collapser:
+                collapser.add(tsv_file)
+
+    report_runtimes(jobs, runs, procs,
+                    os.path.join(out_dir, 'chunk_runtimes.tsv'))
 
     return list(filter(os.path.isfile,
                        glob.iglob(reports_dir + '/**', recursive=True)))
 
-def get_genomes(reports_dir, genome_dir, min_abundance, annotation_type, procs):
+# --------------------------------------------------
+def stream_blocks(inputs, file_format, blocks, failed, max_records=10000):
+    """Put tuples of lockstep record blocks of the inputs on the queue"""
+    handles = [fxsplit.open_input(f) for f in inputs]
+    readers = [fxsplit.RecordReader(h, file_format) for h in handles]
+    lead = readers[0]
+    try:
+        while not failed.is_set():
+            data, count = lead.read(max_records)
+            if not count:
+                for mate, infile in zip(readers[1:], inputs[1:]):
+                    if mate.read(1)[1]:
+                        raise ValueError('"{}" has more reads than "{}"'.format(
+                            infile, inputs[0]))
+                break
+
+            block = [data]
+            for mate, infile in zip(readers[1:], inputs[1:]):
+                block.append(mate.read_exactly(count, infile))
+                fxsplit.check_mates(lead.names(data), mate.names(block[-1]),
+                                    lead.records - count)
+            bases = sum(r.bases(b) for r, b in zip(readers, block))
+
+            # keep checking for dead workers while the queue is full
+            while not failed.is_set():
+                try:
+                    blocks.put((bases, block), timeout=1)
+                    break
+                except queue.Full:
+                    pass
+    finally:
+        for handle in handles:
+            handle.close()
+
+# --------------------------------------------------
+def feed_worker(proc, fifos, blocks, failed, worker):
+    """Start threads writing the blocks a worker takes into its fifos
+
+    Each mate gets its own writer thread so that centrifuge can read the
+    two files of a pair in any order.
+    """
+    mate_queues = [queue.Queue(maxsize=2) for _ in fifos]
+
+    def take():
+        while True:
+            item = blocks.get()
+            if item is None or failed.is_set():
+                break
+            bases, block = item
+            worker['bases'] += bases
+            for mate_queue, data in zip(mate_queues, block):
+                mate_queue.put(data)
+        for mate_queue in mate_queues:
+            mate_queue.put(None)
+
+    def write(fifo, mate_queue):
+        out_fd = None
+        try:
+            out_fd = open_fifo(fifo, proc)
+            while True:
+                data = mate_queue.get()
+                if data is None:
+                    break
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(out_fd, view):]
+        except OSError as err:
+            warn('Could not feed centrifuge: {}'.format(err))
+            failed.set()
+            # let take() finish its put
+            while mate_queue.get() is not None:
+                pass
+        finally:
+            if out_fd is not None:
+                os.close(out_fd)
+
+    threads = [threading.Thread(target=take)]
+    threads += [threading.Thread(target=write, args=(fifo, mate_queue))
+                for fifo, mate_queue in zip(fifos, mate_queues)]
+    for thread in threads:
+        thread.start()
+
+    return threads
+
+# --------------------------------------------------
+def open_fifo(fifo, proc):
+    """Open a fifo for writing once proc opens it, fail if proc exits"""
+    while True:
+        try:
+            out_fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+            os.set_blocking(out_fd, True)
+            return out_fd
+        except OSError as err:
+            if err.errno != errno.ENXIO:
+                raise
+        if proc.poll() is not None:
+            raise OSError(errno.EPIPE, 'centrifuge exited before reading',
+                          fifo)
+        time.sleep(0.1)
+
+# --------------------------------------------------
+def report_runtimes(jobs, runs, procs, out_file):
+    """Compare the predicted and actual runtime of each (name, bases) job
+
+    runs maps the 1-based job number to its (start, seconds). The
+    prediction scales each chunk's bases by the seconds per base of the
+    whole run, so it shows how evenly the chunks split the work: the
+    predicted and actual finish of the slowest --procs slot should be close
+    to the total time divided by --procs.
+    """
+    total_bases = sum(bases for _, bases in jobs)
+    total_secs = sum(secs for _, secs in runs.values())
+    if not runs or not total_bases:
+        return
+
+    per_base = total_secs / total_bases
+    slots = [0.0] * procs
+    with open(out_file, 'w') as out_fh:
+        out_fh.write('\t'.join(['chunk', 'bases', 'predicted_secs',
+                                'actual_secs']) + '\n')
+        for seq, (name, bases) in enumerate(jobs, start=1):
+            predicted = bases * per_base
+            # the scheduler hands each job to the first slot to free up
+            slots[slots.index(min(slots))] += predicted
+            actual = runs[seq][1] if seq in runs else float('nan')
+            out_fh.write('{}\t{}\t{:.1f}\t{:.1f}\n'.format(name, bases,
+                                                          predicted, actual))
+
+    start = min(begin for begin, _ in runs.values())
+    finish = max(begin + secs for begin, secs in runs.values())
+    warn('Chunk runtimes in "{}": predicted finish {:.1f}s, '
+         'actual {:.1f}s, perfect balance {:.1f}s'.format(
+             out_file, max(slots), finish - start, total_secs / procs))
+
+# --------------------------------------------------
+def get_genomes(reports_dir, genome_dir, min_abundance, annotation_type, procs,
+                retries=0, store='', store_max_gb=0, select='all', top_n=5,
+                max_dist=representatives.MAX_DIST):
     """Get genomes from PATRIC"""
 
     if not os.path.isdir(genome_dir):
         os.makedirs(genome_dir)
     
-    jobfile = tmp.NamedTemporaryFile(delete=False, mode='wt')
+    # one job over all the reports, so a genome several samples share is
+    # only looked up and downloaded once (downloads run concurrently in it)
+    jobs = []
     bin_dir = os.path.dirname(os.path.realpath(__file__))
-    tmpl='{}/cfuge_to_genome.py --report {} --output {} --min_abundance {} --annotation_type {}\n'
-
-    for report in glob.iglob(reports_dir + '/*.tsv'):
-        jobfile.write(tmpl.format(bin_dir,
-                                  report,
-                                  genome_dir,
-                                  min_abundance,
-                                  annotation_type))
-
-    jobfile.close()
-
-    return_code = run_job_file(jobfile=jobfile.name, msg='Getting genomes', procs=procs)
-    
-    if return_code != 0:
+    tmpl='{}/cfuge_to_genome.py --report {} --output {} --min_abundance {} --annotation_type {} --genome_store "{}" --store_max_gb {} --select {} --top_n {} --max_dist {}'
+
+    if glob.glob(reports_dir + '/*.tsv'):
+        jobs.append(tmpl.format(bin_dir,
+                                reports_dir,
+                                genome_dir,
+                                min_abundance,
+                                annotation_type,
+                                store,
+                                store_max_gb,
+                                select,
+                                top_n,
+                                max_dist))
+
+    results = scheduler.run_jobs(jobs, msg='Getting genomes', procs=procs,
+                                 retries=retries)
+
+    if scheduler.failed(results):
         die()
 
 
@@ -325,96 +941,15 @@ def get_excluded_tax(ids):
     return ','.join(tax_ids)
 
 # --------------------------------------------------
-def collapse_reports(input_files, reports, out_dir):
+def collapse_reports(input_files, reports, out_dir, sum_format='text',
+                     method='unique'):
     """Collapse the split reports"""
     collapse_dir = os.path.join(out_dir, 'collapsed')
     if not os.path.isdir(collapse_dir):
         os.makedirs(collapse_dir)
 
-    for i, filename in enumerate(input_files):
-        basename = os.path.basename(filename)
-        print('{:4}: {}'.format(i + 1, basename))
-        basename, ext = os.path.splitext(basename)
-        splits = {'tsv': [], 'sum': []}
-
-        for report in reports:
-            regex = r'{}\.(\d+)\.{}\.(tsv|sum)'.format(basename, ext[1:])
-            match = re.match(regex, os.path.basename(report))
-
-            if match:
-                num, type_ext = match.groups()
-                # storing a tuple with the num first for sorting
-                splits[type_ext].append((int(num), report))
-
-        for file_type in splits:
-            # sort on the fst of the tuple but take the snd
-            files = [a[1] for a in \
-                     sorted(splits[file_type], key=lambda a: a[0])]
-
-            if len(files) < 1:
-                msg = 'WARNING: No files ending with "{}" for "{}"'
-                print(msg.format(file_type, basename))
-            else:
-                out_path = os.path.join(collapse_dir,
-                                        basename + '.' + file_type)
-
-                if os.path.isfile(out_path):
-                    print('      "{}" exists, skipping'.format(out_path))
-                else:
-                    print('      Writing to "{}"'.format(out_path))
-                    func = write_tsv if file_type == 'tsv' else write_sum
-                    func(files, open(out_path, 'w'))
-
-
-    return collapse_dir
-
-# --------------------------------------------------
-def write_tsv(files, out_fh):
-    """collapse tsv files"""
-    tax = dict()
-    num_flds = ['numReads', 'numUniqueReads']
-
-    for fnum, file in enumerate(files):
-        print('    {:4}: {}'.format(fnum + 1, os.path.basename(file)))
-        with open(file) as csvfile:
-            reader = csv.DictReader(csvfile, delimiter='\t')
-            for row in reader:
-                tax_id = row['taxID']
-                if not tax_id in tax:
-                    tax[tax_id] = dict()
-                    for fld in row.keys():
-                        tax[tax_id][fld] = int(row[fld]) \
-                                if fld in num_flds else row[fld]
-                else:
-                    for fld in num_flds:
-                        tax[tax_id][fld] += int(row[fld])
-
-    # Write the headers
-    flds = ['name', 'taxID', 'taxRank', 'genomeSize'] + \
-            num_flds + ['abundance']
-    out_fh.write("\t".join(flds) + '\n')
-
-    total_reads = sum([tax[s]['numReads'] for s in tax])
-
-    for tax_id in sorted(tax.keys(), key=int):
-        species = tax[tax_id]
-
-        species['abundance'] = round(species['numReads'] / total_reads, 2)
-
-        out_fh.write('\t'.join([str(species[f]) for f in flds]) + '\n')
-
-# --------------------------------------------------
-def write_sum(files, out_fh):
-    """collapse sum files"""
-    for fnum, file in enumerate(files):
-        print('    {:4}: {}'.format(fnum + 1, os.path.basename(file)))
-        in_fh = open(file, 'r')
-        hdr = in_fh.readline()
-        if fnum == 0:
-            out_fh.write(hdr)
-
-        for line in in_fh:
-            out_fh.write(line)
+    return collapse.collapse_reports(input_files, reports, collapse_dir,
+                                     sum_format=sum_format, method=method)
 
 # --------------------------------------------------
 def make_bubble(collapse_dir, out_dir):
@@ -463,6 +998,26 @@ def main():
 
     exclude_ids = get_excluded_tax(args.exclude_taxids)
 
+    if args.sum_format == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            die('--sum_format parquet needs pyarrow')
+
+    # samples are collapsed as soon as their last chunk is classified
+    collapser = collapse.RunningCollapse(
+        collapse_dir=os.path.join(out_dir, 'collapsed'),
+        state_dir=os.path.join(out_dir, 'collapse_state'),
+        sum_format=args.sum_format,
+        method=args.abundance)
+
+    max_seqs, max_bases = args.max_seqs_per_file, args.bases_per_file
+    if args.auto_split:
+        inputs = find_input_files(args.query) if args.query else \
+            [f for f in [args.unpaired, args.forward, args.reverse] if f]
+        max_seqs, max_bases = auto_split(','.join(inputs).split(','),
+                                         args.format, args.procs, args.waves)
+
     if args.query or args.unpaired:
         if args.query and not args.unpaired:
             input_files = find_input_files(args.query)
@@ -479,29 +1034,46 @@ def main():
         if num_files == 0:
             die('No usable files from --query')
 
-        split_file_names = split_files(out_dir=out_dir,
-                                       files=input_files,
-                                       file_format=args.format,
-                                       max_seqs=args.max_seqs_per_file,
-                                       procs=args.procs)
-
-        reports = run_centrifuge(file_format=args.format,
-                                 files=split_file_names,
-                                 out_dir=out_dir,
-                                 exclude_ids=exclude_ids,
-                                 index_dir=index_dir,
-                                 index_name=index_name,
-                                 threads=args.threads,
-                                 procs=args.procs)
+        if args.stream:
+            reports = stream_centrifuge(file_format=args.format,
+                                        files=input_files,
+                                        out_dir=out_dir,
+                                        exclude_ids=exclude_ids,
+                                        index_dir=index_dir,
+                                        index_name=index_name,
+                                        threads=args.threads,
+                                        procs=args.procs,
+                                        mm=args.mm,
+                                        collapser=collapser)
+        else:
+            chunks = split_files(out_dir=out_dir,
+                                 files=input_files,
+                                 file_format=args.format,
+                                 max_seqs=max_seqs,
+                                 max_bases=max_bases,
+                                 procs=args.procs,
+                                 retries=args.retries,
+                                 virtual=args.virtual_split)
+
+            reports = run_centrifuge(file_format=args.format,
+                                     chunks=chunks,
+                                     out_dir=out_dir,
+                                     exclude_ids=exclude_ids,
+                                     index_dir=index_dir,
+                                     index_name=index_name,
+                                     threads=args.threads,
+                                     procs=args.procs,
+                                     retries=args.retries,
+                                     mm=args.mm,
+                                     batch=args.batch,
+                                     collapser=collapser)
 
         collapse_dir = collapse_reports(input_files=input_files,
                                         reports=reports,
-                                        out_dir=out_dir)
-
-        fig_dir = make_bubble(collapse_dir=collapse_dir, out_dir=out_dir)
+                                        out_dir=out_dir,
+                                        sum_format=args.sum_format,
+        method=args.abundance)
 
-        print('Done, reports in "{}", figures in "{}"'.format(collapse_dir,
-                                                              fig_dir))
     elif args.forward and args.reverse:
 
         f_list = args.forward.split(',')
@@ -518,27 +1090,49 @@ def main():
         if num_files == 0:
             die('No usable files from -1/-2')
 
-        paired = [] #list of tuples (forward_read,reverse_read)
-        for read in f_list:
-            paired.append((read, r_list[f_list.index(read)]))
-
         #NOTE: reports get named after the forward reads so that also has to be the input
         #for "collapsing"
-        reports = run_cent_paired(file_format=args.format,
-                                 paired_reads=paired,
-                                 out_dir=out_dir,
-                                 exclude_ids=exclude_ids,
-                                 index_dir=index_dir,
-                                 index_name=index_name,
-                                 threads=args.threads,
-                                 procs=args.procs)
-
-        reports_dir = os.path.dirname(reports[0])
-        warn('Reports dir: {}'.format(reports_dir))
-        fig_dir = make_bubble(collapse_dir=reports_dir, out_dir=out_dir)
-
-#        print('Done, reports in "{}", figures in "{}"'.format(reports_dir,
-#                                                              fig_dir))
+        if args.stream:
+            reports = stream_centrifuge(file_format=args.format,
+                                        files=f_list,
+                                        mates=r_list,
+                                        out_dir=out_dir,
+                                        exclude_ids=exclude_ids,
+                                        index_dir=index_dir,
+                                        index_name=index_name,
+                                        threads=args.threads,
+                                        procs=args.procs,
+                                        mm=args.mm,
+                                        collapser=collapser)
+        else:
+            paired_chunks = split_files(out_dir=out_dir,
+                                        files=f_list,
+                                        mates=r_list,
+                                        file_format=args.format,
+                                        max_seqs=max_seqs,
+                                        max_bases=max_bases,
+                                        procs=args.procs,
+                                        retries=args.retries,
+                                        virtual=args.virtual_split)
+
+            reports = run_cent_paired(file_format=args.format,
+                                      paired_chunks=paired_chunks,
+                                      out_dir=out_dir,
+                                      exclude_ids=exclude_ids,
+                                      index_dir=index_dir,
+                                      index_name=index_name,
+                                      threads=args.threads,
+                                      procs=args.procs,
+                                      retries=args.retries,
+                                      mm=args.mm,
+                                      batch=args.batch,
+                                      collapser=collapser)
+
+        collapse_dir = collapse_reports(input_files=f_list,
+                                        reports=reports,
+                                        out_dir=out_dir,
+                                        sum_format=args.sum_format,
+        method=args.abundance)
 
     else:
         die('Need a query or paired forward and reverse reads\n' +
@@ -546,15 +1140,27 @@ def main():
                 'forward {}\n'.format(args.forward) +
                 'reverse {}\n'.format(args.reverse) +
                 'unpaired {}\n'.format(args.unpaired))
+
+    fig_dir = make_bubble(collapse_dir=collapse_dir, out_dir=out_dir)
+
+    print('Done, reports in "{}", figures in "{}"'.format(collapse_dir,
+                                                          fig_dir))
+
     #getting genomes using cfuge_to_genome.py 
     min_abundance = args.min_abundance
     annotation_type = args.annotation_type
     genome_dir = args.genome_dir
-    get_genomes(reports_dir=reports_dir,
+    get_genomes(reports_dir=collapse_dir,
                             genome_dir=genome_dir,
                             min_abundance=min_abundance,
                             annotation_type=annotation_type,
-                            procs=args.procs)
+                            procs=args.procs,
+                            retries=args.retries,
+                            store=args.genome_store,
+                            store_max_gb=args.store_max_gb,
+                            select=args.select,
+                            top_n=args.top_n,
+                            max_dist=args.max_dist)
 
         
 # --------------------------------------------------
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Run tools with their output streamed line by line to rotating logs"""
+
+import logging
+import logging.handlers
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+
+# longest piece of a line read at once, so a tool writing without newlines
+# is never held in memory whole
+LINE_MAX = 1 << 16
+
+# size a log grows to before it is rotated and how many old ones are kept
+LOG_BYTES = 10 << 20
+LOG_BACKUPS = 3
+
+# how a command went: metrics are what the parsers made of its output
+Run = namedtuple('Run', ['cmd', 'returncode', 'secs', 'metrics'])
+
+# bowtie2's summary, "10000 reads; of these:" and so on
+BOWTIE2_SUMMARY = [
+    ('reads', re.compile(r'^(\d+) reads; of these:')),
+    ('paired', re.compile(r'^\s*(\d+) \([\d.]+%\) were paired; of these:')),
+    ('unpaired', re.compile(r'^\s*(\d+) \([\d.]+%\) were unpaired; of these:')),
+    ('concordant_once',
+     re.compile(r'^\s*(\d+) \([\d.]+%\) aligned concordantly exactly 1 time')),
+    ('concordant_multi',
+     re.compile(r'^\s*(\d+) \([\d.]+%\) aligned concordantly >1 times')),
+    ('aligned_once',
+     re.compile(r'^\s*(\d+) \([\d.]+%\) aligned exactly 1 time')),
+    ('aligned_multi', re.compile(r'^\s*(\d+) \([\d.]+%\) aligned >1 times')),
+    ('overall_rate', re.compile(r'^([\d.]+)% overall alignment rate')),
+]
+
+# --------------------------------------------------
+def bowtie2_metrics(line, metrics):
+    """Add what a line of bowtie2's summary says to metrics
+
+    Reads and alignments are counted, the overall alignment rate is a
+    percentage. aligned_once and aligned_multi are of unpaired reads, the
+    same lines about the mates of pairs that did not align as pairs come
+    before bowtie2 gets to the unpaired reads, and are left out.
+    """
+    if 'overall_rate' in metrics:
+        return
+    for name, pattern in BOWTIE2_SUMMARY:
+        if name.startswith('aligned_') and 'unpaired' not in metrics:
+            continue
+        match = pattern.match(line)
+        if match and name not in metrics:
+            value = match.group(1)
+            metrics[name] = float(value) if '.' in value else int(value)
+            return
+
+# --------------------------------------------------
+def write_metrics(metrics, out_file):
+    """Write metrics as name<TAB>value lines"""
+    with open(out_file, 'w') as out_fh:
+        for name, value in metrics.items():
+            out_fh.write('{}\t{}\n'.format(name, value))
+
+# --------------------------------------------------
+class Runner:
+    """A shell command whose stdout and stderr are streamed as they come
+
+    Each stream is read on its own thread, a line at a time (at most
+    LINE_MAX bytes of it), and every line is echoed to this process's
+    stdout or stderr, appended to log_file, rotated once it reaches
+    max_bytes, and handed to each parser as parser(line, metrics). Nothing
+    is kept once it has been passed on, however much the tool writes.
+
+    stdout may be a file or pipe the command writes to instead, as when
+    bowtie2 feeds a sort, and then only its stderr is streamed;
+    subprocess.PIPE leaves the stdout in proc.stdout for the caller to read.
+    """
+
+    def __init__(self, cmd, log_file='', echo=True, parsers=(), stdin=None,
+                 stdout=None, max_bytes=LOG_BYTES, backups=LOG_BACKUPS):
+        self.cmd = cmd
+        self.echo = echo
+        self.parsers = parsers
+        self.metrics = {}
+        self.handler = None
+        if log_file:
+            self.handler = logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=max_bytes, backupCount=backups)
+            self.handler.terminator = ''
+
+        print('Executing {}'.format(cmd), flush=True)
+        self.start = time.time()
+        self.proc = subprocess.Popen(
+            cmd, shell=True, executable='/bin/bash', stdin=stdin,
+            stdout=subprocess.PIPE if stdout is None else stdout,
+            stderr=subprocess.PIPE)
+
+        self.threads = [threading.Thread(target=self.stream,
+                                         args=(self.proc.stderr, sys.stderr))]
+        if stdout is None:
+            self.threads.append(threading.Thread(
+                target=self.stream, args=(self.proc.stdout, sys.stdout)))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stream(self, pipe, echo_fh):
+        """Pass on the lines of one of the command's pipes until it closes"""
+        with pipe:
+            for raw in iter(lambda: pipe.readline(LINE_MAX), b''):
+                line = raw.decode(errors='replace')
+                if self.echo:
+                    echo_fh.write(line)
+                    echo_fh.flush()
+                if self.handler:
+                    self.handler.handle(logging.makeLogRecord({'msg': line}))
+                for parser in self.parsers:
+                    parser(line, self.metrics)
+
+    def wait(self):
+        """Wait for the command and its output, return its Run"""
+        returncode = self.proc.wait()
+        for thread in self.threads:
+            thread.join()
+        if self.handler:
+            self.handler.close()
+
+        return Run(self.cmd, returncode, time.time() - self.start,
+                   self.metrics)
+
+# --------------------------------------------------
+def run(cmd, log_file='', echo=True, parsers=(), stdin=None, stdout=None):
+    """Run a shell command with its output streamed, return its Run"""
+    return Runner(cmd, log_file, echo, parsers, stdin, stdout).wait()
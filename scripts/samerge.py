@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""Merge the SAM output of one read set aligned to several index shards"""
+
+import argparse
+import sys
+
+# alignment flags
+UNMAPPED = 0x4
+NOT_PRIMARY = 0x100 | 0x800
+
+# MAPQ given to a read whose best alignment score is matched in another
+# shard, as bowtie2 does for a read with an equally good second hit
+TIED_MAPQ = 1
+
+# --------------------------------------------------
+def get_args():
+    """get args"""
+    parser = argparse.ArgumentParser(
+        description='Merge SAM files of the same reads (bowtie2 --reorder) '
+        'aligned to different shards, keeping the best alignment of each',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('sams',
+                        help='SAM files, or pipes, one per shard',
+                        metavar='FILE',
+                        nargs='+')
+
+    parser.add_argument('-o', '--outfile',
+                        help='Output SAM',
+                        metavar='FILE',
+                        type=argparse.FileType('wt'),
+                        default=sys.stdout)
+
+    parser.add_argument('--no-unal',
+                        dest='no_unal',
+                        help='Leave out reads that aligned nowhere',
+                        action='store_true')
+
+    return parser.parse_args()
+
+# --------------------------------------------------
+def main():
+    """main"""
+    args = get_args()
+
+    in_fhs = [open(sam) for sam in args.sams]
+    try:
+        stats = merge(in_fhs, args.outfile, no_unal=args.no_unal)
+    except ValueError as err:
+        print('Error: {}'.format(err), file=sys.stderr)
+        sys.exit(1)
+    finally:
+        for in_fh in in_fhs:
+            in_fh.close()
+
+    print('{} reads, {} aligned, {} tied between shards'.format(*stats),
+          file=sys.stderr)
+
+# --------------------------------------------------
+def read_header(in_fh):
+    """The header lines of a SAM stream and its first record line"""
+    header = []
+    for line in in_fh:
+        if not line.startswith('@'):
+            return header, line
+        header.append(line)
+
+    return header, ''
+
+# --------------------------------------------------
+def merge_headers(headers):
+    """One header: @HD of the first, every shard's @SQ, then the rest of the
+    first"""
+    first = headers[0]
+    merged = [line for line in first if line.startswith('@HD')]
+    for header in headers:
+        merged += [line for line in header if line.startswith('@SQ')]
+    merged += [line for line in first
+               if not line.startswith(('@HD', '@SQ'))]
+
+    return merged
+
+# --------------------------------------------------
+def groups(in_fh, line):
+    """(read name, [records]) of the consecutive records of each read
+
+    line is the first record, already read past the header.
+    """
+    name, group = None, []
+    while line:
+        flds = line.split('\t', 2)
+        if flds[0] != name:
+            if group:
+                yield name, group
+            name, group = flds[0], []
+        group.append(line)
+        line = in_fh.readline()
+    if group:
+        yield name, group
+
+# --------------------------------------------------
+def score(group):
+    """How good a read's alignment is: (mates aligned, alignment score)"""
+    aligned, total = 0, 0
+    for line in group:
+        flds = line.split('\t')
+        flag = int(flds[1])
+        if flag & (UNMAPPED | NOT_PRIMARY):
+            continue
+        aligned += 1
+        for tag in flds[11:]:
+            if tag.startswith('AS:i:'):
+                total += int(tag[5:])
+                break
+
+    return aligned, total
+
+# --------------------------------------------------
+def set_mapq(line, mapq):
+    """line with its MAPQ at most mapq"""
+    flds = line.split('\t')
+    if flds[4] != '255' and int(flds[4]) > mapq:
+        flds[4] = str(mapq)
+
+    return '\t'.join(flds)
+
+# --------------------------------------------------
+def merge(in_fhs, out_fh, no_unal=False):
+    """Write the best alignment of each read among the shards' SAM streams
+
+    Every stream must hold every read, in the same order (bowtie2 --reorder
+    and without --no-unal). A read is taken from the shard where most of
+    its mates aligned, with the highest alignment score (summed over the
+    mates), the first such shard on a tie. A tie lowers its MAPQ to
+    TIED_MAPQ, as the read aligns equally well elsewhere. Returns the number
+    of reads, of aligned reads and of tied reads.
+    """
+    headers, readers = [], []
+    for in_fh in in_fhs:
+        header, line = read_header(in_fh)
+        headers.append(header)
+        readers.append(groups(in_fh, line))
+    out_fh.writelines(merge_headers(headers))
+
+    reads, aligned, tied = 0, 0, 0
+    while True:
+        hits = [next(reader, None) for reader in readers]
+        if all(hit is None for hit in hits):
+            break
+        if any(hit is None for hit in hits) or \
+           len(set(name for name, _ in hits)) != 1:
+            raise ValueError('The shards do not have the same reads in the '
+                             'same order at read {}, align with --reorder and '
+                             'without --no-unal'.format(reads + 1))
+
+        reads += 1
+        scores = [score(group) for _, group in hits]
+        best = max(range(len(hits)), key=lambda i: (scores[i], -i))
+        group = hits[best][1]
+        if not scores[best][0]:
+            if not no_unal:
+                out_fh.writelines(group)
+            continue
+
+        aligned += 1
+        if scores.count(scores[best]) > 1:
+            tied += 1
+            group = [set_mapq(line, TIED_MAPQ) for line in group]
+        out_fh.writelines(group)
+
+    return reads, aligned, tied
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Run shell jobs in parallel on a budget of cores and memory"""
+
+import os
+import subprocess
+import sys
+import time
+from collections import deque, namedtuple
+
+# a shell command and what it needs: cores, bytes of memory and how many
+# times to run it again if it fails. shared is a (key, bytes) pair for
+# memory that all running jobs with the same key share, like a memory-mapped
+# index, which is only counted once however many of them run.
+Job = namedtuple('Job', ['cmd', 'name', 'cpus', 'mem', 'retries', 'shared'])
+Job.__new__.__defaults__ = ('', 1, 0, None, None)
+
+# how a job went: returncode is None for a job that never ran, start and
+# secs are those of the last attempt, maxrss is its peak RSS in KB
+Result = namedtuple('Result', ['name', 'cmd', 'returncode', 'attempts',
+                               'start', 'secs', 'maxrss'])
+
+# --------------------------------------------------
+def warn(msg):
+    """Print a message to STDERR"""
+    print(msg, file=sys.stderr)
+
+# --------------------------------------------------
+def node_cpus():
+    """Cores this process may run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+# --------------------------------------------------
+def node_mem():
+    """Bytes of memory available on the node, 0 if unknown"""
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError):
+        return 0
+
+# --------------------------------------------------
+class Scheduler:
+    """Run jobs as processes while their cpus and mem fit the budget
+
+    At most procs jobs run at once, and a job only starts when its cpus and
+    mem fit next to the jobs already running (a job bigger than the whole
+    budget still runs, alone). The shared memory of a job is reserved by the
+    first running job with its key and freed with the last one. A failed job
+    is run again up to its retries.
+    Once a job has failed for good no new jobs are started unless
+    keep_going, but the running ones are left to finish.
+    """
+
+    def __init__(self, procs=None, cpus=None, mem=None, retries=0,
+                 keep_going=False, poll=0.1):
+        self.cpus = cpus or node_cpus()
+        self.mem = node_mem() if mem is None else mem
+        self.procs = procs or self.cpus
+        self.retries = retries
+        self.keep_going = keep_going
+        self.poll = poll
+
+    def run(self, jobs, on_done=None):
+        """Run the jobs, return their Results in the same order
+
+        on_done is called with the index and Result of each job that
+        succeeds, as soon as it does.
+        """
+        jobs = [job if isinstance(job, Job) else Job(job) for job in jobs]
+        results = [Result(job.name, job.cmd, None, 0, None, None, None)
+                   for job in jobs]
+        pending = deque(range(len(jobs)))
+        running = {}
+        used_cpus, used_mem = 0, 0
+        # key -> [bytes, running jobs using it]
+        shared = {}
+        halted = False
+
+        while running or (pending and not halted):
+            while pending and not halted and len(running) < self.procs:
+                job = jobs[pending[0]]
+                cpus = min(job.cpus, self.cpus)
+                mem = job.mem
+                if job.shared and job.shared[0] not in shared:
+                    mem += job.shared[1]
+                fits = used_cpus + cpus <= self.cpus and \
+                    (not self.mem or used_mem + mem <= self.mem)
+                if running and not fits:
+                    break
+
+                i = pending.popleft()
+                proc = subprocess.Popen(job.cmd, shell=True,
+                                        executable='/bin/bash')
+                running[proc.pid] = (i, proc, time.time(), cpus)
+                used_cpus += cpus
+                used_mem += mem
+                if job.shared:
+                    shared.setdefault(job.shared[0], [job.shared[1], 0])[1] += 1
+
+            time.sleep(self.poll)
+            for pid in list(running):
+                waited, status, rusage = os.wait4(pid, os.WNOHANG)
+                if not waited:
+                    continue
+
+                i, proc, start, cpus = running.pop(pid)
+                proc.returncode = os.waitstatus_to_exitcode(status)
+                job, attempts = jobs[i], results[i].attempts + 1
+                used_cpus -= cpus
+                used_mem -= job.mem
+                if job.shared:
+                    shared[job.shared[0]][1] -= 1
+                    if not shared[job.shared[0]][1]:
+                        used_mem -= shared.pop(job.shared[0])[0]
+                results[i] = Result(job.name, job.cmd, proc.returncode,
+                                    attempts, start, time.time() - start,
+                                    rusage.ru_maxrss)
+
+                retries = self.retries if job.retries is None else job.retries
+                if proc.returncode == 0:
+                    if on_done:
+                        on_done(i, results[i])
+                elif attempts <= retries:
+                    warn('Job "{}" failed ({}), retry {} of {}'.format(
+                        job.name or job.cmd, proc.returncode, attempts,
+                        retries))
+                    pending.appendleft(i)
+                else:
+                    warn('Job "{}" failed ({})'.format(job.name or job.cmd,
+                                                       proc.returncode))
+                    halted = not self.keep_going
+
+        return results
+
+# --------------------------------------------------
+def failed(results):
+    """The Results of the jobs that failed or never ran"""
+    return [result for result in results if result.returncode != 0]
+
+# --------------------------------------------------
+def run_jobs(jobs, msg='Running job', procs=1, cpus=None, mem=None,
+             retries=0, keep_going=False, on_done=None):
+    """Run jobs (Jobs or shell commands), return their Results"""
+    warn('{} (# jobs = {})'.format(msg, len(jobs)))
+    if not jobs:
+        warn('No jobs to run!')
+        return []
+
+    scheduler = Scheduler(procs=procs, cpus=cpus, mem=mem, retries=retries,
+                          keep_going=keep_going)
+    results = scheduler.run(jobs, on_done=on_done)
+    bad = failed(results)
+    if bad:
+        warn('{} of {} job{} did not finish'.format(
+            len(bad), len(results), '' if len(results) == 1 else 's'))
+
+    return results
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""Split the reports of a batched centrifuge run into per-chunk reports"""
+
+import argparse
+import csv
+import os
+import sys
+from collections import defaultdict
+
+from collapse import TSV_FLDS
+
+# exit status when the chunks' counts do not add up to the batch's, the
+# batch is fine otherwise and its chunks are to be run one by one
+UNSPLIT = 3
+
+# --------------------------------------------------
+class CountMismatch(ValueError):
+    """The counts of the chunks do not add up to those of the batch"""
+
+# --------------------------------------------------
+def get_args():
+    """get args"""
+    parser = argparse.ArgumentParser(
+        description='Split the .sum/.tsv reports of a centrifuge run over '
+        'several chunks into the reports of each chunk',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('prefixes',
+                        help='Report path minus .sum/.tsv of each chunk',
+                        metavar='PREFIX',
+                        nargs='+')
+
+    parser.add_argument('-s', '--sum_file',
+                        help='Classifications of the batch (--reorder)',
+                        metavar='FILE',
+                        type=str,
+                        required=True)
+
+    parser.add_argument('-r', '--report',
+                        help='Report (--report-file) of the batch',
+                        metavar='FILE',
+                        type=str,
+                        required=True)
+
+    parser.add_argument('-n', '--records',
+                        help='Comma-separated reads (pairs) in each chunk',
+                        metavar='str',
+                        type=str,
+                        required=True)
+
+    return parser.parse_args()
+
+# --------------------------------------------------
+def main():
+    """main"""
+    args = get_args()
+    records = [int(num) for num in args.records.split(',')]
+    if len(records) != len(args.prefixes):
+        print('Need one --records number per prefix', file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        split_batch(args.sum_file, args.report, records, args.prefixes)
+    except CountMismatch as err:
+        print('Error: {}'.format(err), file=sys.stderr)
+        os.remove(args.sum_file)
+        os.remove(args.report)
+        sys.exit(UNSPLIT)
+    except ValueError as err:
+        print('Error: {}'.format(err), file=sys.stderr)
+        sys.exit(1)
+
+    os.remove(args.sum_file)
+    os.remove(args.report)
+
+# --------------------------------------------------
+def split_batch(sum_file, report, records, prefixes):
+    """Write the .sum and .tsv of each chunk of a batch
+
+    Centrifuge writes every read, classified or not, as consecutive rows in
+    input order (with --reorder), so chunk k is the next records[k] reads.
+    The counts of each chunk's report are taken from its rows, the name,
+    rank and genome size from the batch report. The .tsv files are only
+    written once all the counts add up to those of the batch, as a .tsv
+    marks a chunk as done, CountMismatch is raised if they do not.
+    """
+    with open(report) as in_fh:
+        taxa = {row['taxID']: row
+                for row in csv.DictReader(in_fh, delimiter='\t')}
+
+    chunk_counts = []
+    try:
+        with open(sum_file) as in_fh:
+            header = in_fh.readline()
+            line = in_fh.readline()
+            for num, prefix in zip(records, prefixes):
+                # taxID -> [numReads, numUniqueReads]
+                counts = defaultdict(lambda: [0, 0])
+                reads, last, seen = 0, None, set()
+                with open(prefix + '.sum', 'w') as out_fh:
+                    out_fh.write(header)
+                    while line:
+                        flds = line.rstrip('\n').split('\t')
+                        if flds[0] != last:
+                            if reads == num:
+                                break
+                            reads, last, seen = reads + 1, flds[0], set()
+                        out_fh.write(line)
+                        if flds[2] != '0' and flds[2] not in seen:
+                            seen.add(flds[2])
+                            counts[flds[2]][0] += 1
+                            counts[flds[2]][1] += flds[7] == '1'
+                        line = in_fh.readline()
+
+                if reads != num:
+                    raise ValueError('"{}" has {} reads for "{}", expected '
+                                     '{}'.format(sum_file, reads, prefix, num))
+                chunk_counts.append(counts)
+
+            if line:
+                raise ValueError('"{}" has more reads than its {} chunks'.format(
+                    sum_file, len(prefixes)))
+
+        for tax_id, row in taxa.items():
+            total = sum(counts.get(tax_id, [0])[0]
+                        for counts in chunk_counts)
+            if total != int(row['numReads']):
+                raise CountMismatch('taxID {} has {} reads in "{}" but {} in '
+                                    '"{}", run the chunks one by one'.format(
+                                        tax_id, total, sum_file,
+                                        row['numReads'], report))
+    except ValueError:
+        for prefix in prefixes:
+            if os.path.isfile(prefix + '.sum'):
+                os.remove(prefix + '.sum')
+        raise
+
+    for counts, prefix in zip(chunk_counts, prefixes):
+        write_report(taxa, counts, prefix + '.tsv')
+
+# --------------------------------------------------
+def write_report(taxa, counts, out_file):
+    """Write the report of one chunk in the order of the batch report
+
+    The abundance column is the chunk's share of classified reads, the
+    batch's own estimate does not split over chunks (and collapsing does not
+    read it).
+    """
+    total = sum(num for num, _ in counts.values()) or 1
+    with open(out_file + '.tmp', 'w') as out_fh:
+        out_fh.write('\t'.join(TSV_FLDS) + '\n')
+        for tax_id, row in taxa.items():
+            if tax_id not in counts:
+                continue
+            num, unique = counts[tax_id]
+            out_fh.write('\t'.join([row['name'], tax_id, row['taxRank'],
+                                    row['genomeSize'], str(num), str(unique),
+                                    str(round(num / total, 4))]) + '\n')
+
+    os.rename(out_file + '.tmp', out_file)
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()